@@ -60,11 +60,44 @@ origin_array = np.array([origin_longitude, origin_latitude])
 inv_basis = np.array([[ 0.49561711, -0.19418992],
                       [ 0.34376351,  0.27997109]])
 
+def pgps_to_xy_array(lon, lat):
+    ''' pgps_to_xy over arrays: projects N points in one call.
+        Returns x, y as float64 arrays of the same shape as lon, lat.'''
+    dlon = np.asarray(lon, dtype=np.float64) - origin_array[0]
+    dlat = np.asarray(lat, dtype=np.float64) - origin_array[1]
+    # Written out rather than with np.matmul, so that the result is
+    # bit-for-bit the same as the scalar pgps_to_xy.
+    return (dlon*inv_basis[0, 0] + dlat*inv_basis[1, 0],
+            dlon*inv_basis[0, 1] + dlat*inv_basis[1, 1])
+
+# Plain-float copies of the prebaked values, for the scalar version
+_origin_lon, _origin_lat = origin_array.tolist()
+(_ib00, _ib01), (_ib10, _ib11) = inv_basis.tolist()
+
 def pgps_to_xy(lon, lat):
-    ''' gps_to_xy, using prebaked values to increase performance.'''
-    x = (lon, lat) - origin_array
-    c = np.matmul(x, inv_basis)
-    return c[0], c[1]
+    ''' gps_to_xy, using prebaked values to increase performance.
+        (Scalar version of pgps_to_xy_array; avoids numpy overhead.)'''
+    dlon = lon - _origin_lon
+    dlat = lat - _origin_lat
+    return dlon*_ib00 + dlat*_ib10, dlon*_ib01 + dlat*_ib11
+
+
+# Mean radius of the Earth, for both versions of gps_distance
+earth_radius_km = 6371
+
+def gps_distance_array(lat1, lon1, lat2, lon2):
+    ''' gps_distance over arrays: the Haversine distance, in meters,
+        between each pair of points (lat1, lon1) and (lat2, lon2).
+        Performs the same operations as gps_distance, element-wise.'''
+    dlat = np.radians(np.subtract(lat2, lat1))
+    dlon = np.radians(np.subtract(lon2, lon1))
+    a = (np.sin(dlat / 2) * np.sin(dlat / 2) +
+         np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) *
+         np.sin(dlon / 2) * np.sin(dlon / 2))
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    d = earth_radius_km * c
+
+    return d*1000
 
 
 def gps_distance(origin, destination):
@@ -92,7 +125,6 @@ def gps_distance(origin, destination):
     """
     lat1, lon1 = origin
     lat2, lon2 = destination
-    radius = 6371  # km
 
     dlat = radians(lat2 - lat1)
     dlon = radians(lon2 - lon1)
@@ -100,6 +132,6 @@ def gps_distance(origin, destination):
          cos(radians(lat1)) * cos(radians(lat2)) *
          sin(dlon / 2) * sin(dlon / 2))
     c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    d = radius * c
+    d = earth_radius_km * c
     
     return d*1000
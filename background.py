@@ -0,0 +1,118 @@
+''' Background threads for main.py --pipeline: reading the input ahead,
+and saving the output, while the main thread parses and aggregates.
+
+Both hand data over through bounded queues, so at most a few blocks of
+input and one day of output are held on top of the day being processed.
+'''
+
+import queue
+import threading
+import collections
+import concurrent.futures
+
+class PrefetchReader:
+    ''' Reads an open file ahead in a background thread.
+
+    Supports read(size), as used by utils.read_chunks, and closing (also
+    as a context manager), which closes read_f.
+
+    # Arguments:
+        read_f: The open file to read.
+        block_size: Integer, the number of characters read at a time.
+        depth: Integer, the number of blocks read ahead at most.
+    '''
+    def __init__(self, read_f, block_size=1 << 22, depth=2):
+        self.read_f = read_f
+        self.block_size = block_size
+        self._blocks = queue.Queue(maxsize=max(1, depth))
+        self._buffer = read_f.read(0) # '' or b'', matching the file
+        self._eof = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                block = self.read_f.read(self.block_size)
+                self._blocks.put(block)
+                if not block:
+                    return
+        except Exception as error:
+            self._blocks.put(error)
+
+    def _next_block(self):
+        block = self._blocks.get()
+        if isinstance(block, Exception):
+            raise block
+        if not block:
+            self._eof = True
+        return block
+
+    def read(self, size=-1):
+        ''' Returns the next size characters (all the rest if size < 0),
+            or fewer at the end of the file.'''
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            self._buffer += self._next_block()
+        if size < 0:
+            (data, self._buffer) = (self._buffer, self._buffer[:0])
+        else:
+            (data, self._buffer) = (self._buffer[:size], self._buffer[size:])
+        return data
+
+    def close(self):
+        ''' Stops the reading thread and closes the file.'''
+        self._stop.set()
+        while self._thread.is_alive():
+            # Unblock the thread if the queue is full
+            try:
+                self._blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.read_f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class OrderedWorker:
+    ''' Runs functions one at a time, in the order they are submitted, on
+        a background thread.
+
+    submit blocks while depth functions are already waiting or running,
+    and raises the error of any function that failed. Use as a context
+    manager; leaving it waits for all the functions to finish.
+
+    # Arguments:
+        depth: Integer, the number of functions that can be pending.
+    '''
+    def __init__(self, depth=1):
+        self.depth = max(1, depth)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending = collections.deque()
+
+    def submit(self, function, *args, **kwargs):
+        ''' Queues function(*args, **kwargs).'''
+        while len(self._pending) >= self.depth:
+            self._pending.popleft().result()
+        self._pending.append(self._executor.submit(function, *args, **kwargs))
+
+    def wait(self):
+        ''' Waits for every pending function; raises the first error.'''
+        try:
+            while self._pending:
+                self._pending.popleft().result()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.wait()
+        else:
+            # Already failing; finish what was queued, but keep that error
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,208 @@
+''' A chunked file format for fdata, for partial reads.
+
+A dense fdata, (2, T, w, h, w, h), saved in an .npz is one compressed
+blob: reading one hour or one origin cell inflates all of it. A .fchunks
+file instead splits fdata into chunks of time_chunk time slots (and,
+with by_origin, of one origin cell), each compressed on its own:
+
+    b"FCHUNK1\n"
+    chunk 0, chunk 1, ...       zlib-compressed C-order bytes
+    index                       JSON: shape, dtype, time_chunk,
+                                by_origin and, for each chunk,
+                                [t0, t1, x, y, offset, length]
+    length of the index         8 bytes, little-endian
+
+Reading a slice (see ChunkedArray) only inflates the chunks it touches.
+The chunks are compressed in parallel threads when saving.
+
+As the index comes last, append_chunked adds time slots at the end in
+place: the new chunks go over the old index, and a new index follows.
+'''
+
+import os
+import json
+import zlib
+import concurrent.futures
+import numpy as np
+
+MAGIC = b"FCHUNK1\n"
+
+def _chunk_bounds(shape, time_chunk, by_origin):
+    # (t0, t1, x, y) of each chunk, with x = y = -1 for all origins
+    bounds = []
+    for t0 in range(0, shape[1], time_chunk):
+        t1 = min(t0 + time_chunk, shape[1])
+        if by_origin:
+            bounds += [(t0, t1, x, y) for x in range(shape[2]) for y in range(shape[3])]
+        else:
+            bounds.append((t0, t1, -1, -1))
+    return bounds
+
+def _chunk(fdata, bounds):
+    (t0, t1, x, y) = bounds
+    if x < 0:
+        return fdata[:, t0:t1]
+    return fdata[:, t0:t1, x:x + 1, y:y + 1]
+
+def _write_chunks(write_f, fdata, bounds, offset, level, workers, t_offset=0):
+    # Compresses the chunks of fdata in parallel and writes them from
+    # offset. Returns their index entries, with t shifted by t_offset.
+    def compress(chunk_bounds):
+        return zlib.compress(np.ascontiguousarray(_chunk(fdata, chunk_bounds)).tobytes(), level)
+
+    chunks = []
+    write_f.seek(offset)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # map keeps the order, so chunks are written as they are ready
+        for ((t0, t1, x, y), data) in zip(bounds, executor.map(compress, bounds)):
+            write_f.write(data)
+            chunks.append([t0 + t_offset, t1 + t_offset, x, y, offset, len(data)])
+            offset += len(data)
+    return chunks
+
+def _write_index(write_f, index):
+    data = json.dumps(index).encode("UTF-8")
+    write_f.write(data)
+    write_f.write(np.array(len(data), dtype="<u8").tobytes())
+    write_f.truncate()
+
+def _read_index(read_f, filename):
+    # Returns the index, and its offset in the file
+    if read_f.read(len(MAGIC)) != MAGIC:
+        raise ValueError(filename + " is not a .fchunks file")
+    read_f.seek(-8, os.SEEK_END)
+    length = int(np.frombuffer(read_f.read(8), dtype="<u8")[0])
+    offset = read_f.seek(-8 - length, os.SEEK_END)
+    return json.loads(read_f.read(length).decode("UTF-8")), offset
+
+def save_chunked(filename, fdata, time_chunk=4, by_origin=False, level=6, workers=4):
+    ''' Saves fdata (a dense array, or a memory map) to filename in the
+        .fchunks format, replacing it atomically.
+
+    # Arguments:
+        time_chunk: Integer, the number of time slots per chunk.
+        by_origin: Boolean; if True, also split the chunks by origin
+            cell (axes 2 and 3).
+        level: Integer, the zlib level, from 1 (fastest) to 9 (smallest).
+        workers: Integer, the number of threads compressing chunks.
+    '''
+    fdata = np.asarray(fdata)
+    bounds = _chunk_bounds(fdata.shape, time_chunk, by_origin)
+    with open(filename + ".tmp", "wb") as write_f:
+        write_f.write(MAGIC)
+        chunks = _write_chunks(write_f, fdata, bounds, len(MAGIC), level, workers)
+        _write_index(write_f, {'shape': list(fdata.shape), 'dtype': fdata.dtype.str,
+                               'time_chunk': time_chunk, 'by_origin': by_origin,
+                               'chunks': chunks})
+    os.replace(filename + ".tmp", filename)
+
+def append_chunked(filename, fdata, level=6, workers=4):
+    ''' Appends fdata to the end of the time axis (1) of a .fchunks file,
+        in place, in chunks like the ones already there. Only the new
+        chunks and the index are written.
+
+    fdata must match the file on every other axis, and the file must
+    end on a whole chunk. If writing fails, the file is restored.
+    Returns the new shape.
+
+    # Arguments:
+        level, workers: As for save_chunked.
+    '''
+    fdata = np.asarray(fdata)
+    with open(filename, "r+b") as write_f:
+        (index, offset) = _read_index(write_f, filename)
+        shape = index['shape']
+        if fdata.dtype.str != index['dtype'] or list(fdata.shape[:1] + fdata.shape[2:]) != shape[:1] + shape[2:]:
+            raise ValueError("Can't append %s %s to %s %s" % (fdata.dtype, fdata.shape, np.dtype(index['dtype']), tuple(shape)))
+        if shape[1] % index['time_chunk']:
+            raise ValueError(filename + " doesn't end on a whole chunk")
+        write_f.seek(offset)
+        old_tail = write_f.read()
+        try:
+            bounds = _chunk_bounds(fdata.shape, index['time_chunk'], index['by_origin'])
+            index['chunks'] += _write_chunks(write_f, fdata, bounds, offset, level, workers, t_offset=shape[1])
+            index['shape'][1] += fdata.shape[1]
+            _write_index(write_f, index)
+        except BaseException:
+            write_f.seek(offset)
+            write_f.write(old_tail)
+            write_f.truncate()
+            raise
+    return tuple(index['shape'])
+
+def _relative(key, size):
+    ''' For an integer or slice key along an axis of length size,
+        returns (lo, hi, key') such that array[key] equals
+        array[lo:hi][key'].'''
+    if isinstance(key, (int, np.integer)):
+        index = int(key) + size if key < 0 else int(key)
+        if not 0 <= index < size:
+            raise IndexError("Index %d out of range for size %d" % (key, size))
+        return index, index + 1, 0
+    indices = range(size)[key]
+    if len(indices) == 0:
+        return 0, 0, slice(0, 0)
+    (lo, hi) = (min(indices), max(indices) + 1)
+    stop = indices.stop - lo
+    return lo, hi, slice(indices.start - lo, stop if stop >= 0 else None, indices.step)
+
+class ChunkedArray:
+    ''' Reads a file saved by save_chunked like a read-only array.
+
+    Indexing with integers or slices on the time and origin axes
+    (1, 2 and 3), e.g. fdata[:, t0:t1], only reads and inflates the
+    chunks involved. The other axes take any numpy index.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as read_f:
+            (index, _) = _read_index(read_f, filename)
+        self.shape = tuple(index['shape'])
+        self.dtype = np.dtype(index['dtype'])
+        self.ndim = len(self.shape)
+        self.time_chunk = index['time_chunk']
+        self.by_origin = index['by_origin']
+        self.chunks = index['chunks']
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[...]
+        return array if dtype is None else array.astype(dtype)
+
+    def read(self, t0, t1, x0=0, x1=None, y0=0, y1=None):
+        ''' Returns fdata[:, t0:t1, x0:x1, y0:y1], reading only the
+            chunks that overlap it.'''
+        x1 = self.shape[2] if x1 is None else x1
+        y1 = self.shape[3] if y1 is None else y1
+        out = np.zeros((self.shape[0], t1 - t0, x1 - x0, y1 - y0) + self.shape[4:], dtype=self.dtype)
+        with open(self.filename, "rb") as read_f:
+            for (c0, c1, x, y, offset, length) in self.chunks:
+                if c1 <= t0 or c0 >= t1:
+                    continue
+                if x >= 0 and not (x0 <= x < x1 and y0 <= y < y1):
+                    continue
+                read_f.seek(offset)
+                (cx0, cx1, cy0, cy1) = (0, self.shape[2], 0, self.shape[3]) if x < 0 else (x, x + 1, y, y + 1)
+                chunk = np.frombuffer(zlib.decompress(read_f.read(length)), dtype=self.dtype)
+                chunk = chunk.reshape((self.shape[0], c1 - c0, cx1 - cx0, cy1 - cy0) + self.shape[4:])
+                # The overlap, in chunk and in output coordinates
+                (lt, ht) = (max(c0, t0), min(c1, t1))
+                (lx, hx) = (max(cx0, x0), min(cx1, x1))
+                (ly, hy) = (max(cy0, y0), min(cy1, y1))
+                out[:, lt - t0:ht - t0, lx - x0:hx - x0, ly - y0:hy - y0] = \
+                    chunk[:, lt - c0:ht - c0, lx - cx0:hx - cx0, ly - cy0:hy - cy0]
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(item is Ellipsis for item in key):
+            at = key.index(Ellipsis)
+            key = key[:at] + (slice(None),)*(self.ndim - len(key) + 1) + key[at + 1:]
+        key = key + (slice(None),)*(self.ndim - len(key))
+        (t0, t1, tkey) = _relative(key[1], self.shape[1])
+        (x0, x1, xkey) = _relative(key[2], self.shape[2])
+        (y0, y1, ykey) = _relative(key[3], self.shape[3])
+        return self.read(t0, t1, x0, x1, y0, y1)[(key[0], tkey, xkey, ykey) + key[4:]]
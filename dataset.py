@@ -0,0 +1,101 @@
+''' Random access to the compiled STDN arrays, for training.
+
+script_pipeline.py (and script_compile_STDN.py) save the whole range as
+STDN-volume.npy, (T, w, h, 2), and STDN-flow.npy, (2, T, w, h, w, h).
+STDNDataset memory-maps them, so reading vdata[t0:t1] or
+fdata[:, t0:t1] only reads those time slots from disk, however long the
+range is:
+
+    dataset = STDNDataset("data")
+    volume = dataset.volume(100, 200)     # vdata[100:200]
+    flow = dataset.flow(100, 200)         # fdata[:, 100:200]
+    for (t, volume, flow, target) in dataset.windows(look_back=7):
+        ...
+
+Older stores saved as STDN-volume.npz / STDN-flow.npz (array 'arr_0')
+are memory-mapped too if they were saved uncompressed (np.savez);
+compressed ones have to be loaded whole, once. Without STDN-flow.npy,
+the STDN-flow.fchunks of script_pipeline.py --chunked is read instead,
+inflating only the chunks of the slots asked for.
+'''
+
+import os
+import numpy as np
+import utils
+import chunkstore
+import script_pipeline
+
+def open_array(filename, key='arr_0'):
+    ''' Opens a .npy file, or array key of an .npz file, for reading
+        slices: memory-mapped if it is uncompressed, else loaded whole.'''
+    if filename.endswith(".npy"):
+        return np.load(filename, mmap_mode="r")
+    if filename.endswith(".fchunks"):
+        return chunkstore.ChunkedArray(filename)
+    return utils.npz_memmap(filename, key)
+
+def _find(directory, filename):
+    # The .npy store, or else the chunked one, or the older .npz (which
+    # script_pipeline.append leaves stale)
+    path = os.path.join(directory, filename)
+    if not os.path.exists(path):
+        for extension in (".fchunks", ".npz"):
+            other = os.path.splitext(path)[0] + extension
+            if os.path.exists(other):
+                return other
+        raise FileNotFoundError("No " + path + " (or .fchunks, .npz); build it with script_pipeline.py")
+    return path
+
+class STDNDataset:
+    ''' Reads time slots of the compiled STDN arrays.
+
+    # Arguments:
+        directory: String, the folder with the compiled arrays.
+        volume_filename, flow_filename: Strings, their names. The
+            .fchunks (or else .npz) of the same name is used if the .npy
+            doesn't exist.
+    '''
+    def __init__(self, directory="data", volume_filename=script_pipeline.VOLUME_FILENAME, flow_filename=script_pipeline.FLOW_FILENAME):
+        self.directory = directory
+        self.vdata = open_array(_find(directory, volume_filename))
+        self.fdata = open_array(_find(directory, flow_filename))
+        if self.vdata.shape[0] != self.fdata.shape[1]:
+            raise ValueError("Volume has %d time slots, but flow has %d" % (self.vdata.shape[0], self.fdata.shape[1]))
+        self.manifest = script_pipeline.load_manifest(directory)
+
+    def __len__(self):
+        ''' The number of time slots.'''
+        return self.vdata.shape[0]
+
+    def volume(self, t0, t1):
+        ''' Returns vdata[t0:t1] as an array in memory.'''
+        return np.array(self.vdata[t0:t1])
+
+    def flow(self, t0, t1):
+        ''' Returns fdata[:, t0:t1] as an array in memory.'''
+        return np.array(self.fdata[:, t0:t1])
+
+    def day_slots(self, year, month, day):
+        ''' Returns (t0, t1), the time slots of the given day, according
+            to the manifest saved by script_pipeline.py.'''
+        if self.manifest is None:
+            raise ValueError("No manifest in " + self.directory + "; build the arrays with script_pipeline.py")
+        filename = os.path.basename(script_pipeline.day_filename("", year, month, day))
+        for entry in self.manifest['files']:
+            if os.path.basename(entry['filename']) == filename:
+                return entry['offset'], entry['offset'] + entry['length']
+        raise KeyError("%04d-%02d-%02d is not in the dataset" % (year, month, day))
+
+    def windows(self, look_back=7, start=None, stop=None, step=1):
+        ''' Yields (t, volume, flow, target) for sliding look-back windows:
+            volume = vdata[t - look_back:t], flow = fdata[:, t - look_back:t]
+            and target = vdata[t], for t from start (default look_back)
+            to stop (default len(self)), every step slots.
+
+        Each window is read as it is needed, so the first one comes
+        right away however long the dataset is.
+        '''
+        start = look_back if start is None else max(start, look_back)
+        stop = len(self) if stop is None else min(stop, len(self))
+        for t in range(start, stop, step):
+            yield (t, self.volume(t - look_back, t), self.flow(t - look_back, t), self.volume(t, t + 1)[0])
@@ -0,0 +1,140 @@
+''' A precomputed lookup from GPS coordinates to grid cells.
+
+Mapping a point to its cell takes pgps_to_xy, a floor per axis and the
+inside/outside checks. GridIndex instead rasterizes the bounding box of
+the grid once per (w, h): each pixel holds the cell that contains all
+of it, or OUTSIDE. Looking up a point is then a single gather. Pixels
+that straddle a cell edge are marked UNKNOWN, and only the points in
+them go through the exact change-of-basis math.
+'''
+
+import os
+import numpy as np
+from GPSUtils import pgps_to_xy_array, origin_array, inv_basis
+
+OUTSIDE = -1 # Cell id of points outside the grid
+UNKNOWN = -2 # Pixels that overlap more than one cell
+
+def exact_cells(lon, lat, w, h):
+    ''' Cell ids of the points (lon, lat): gx*h + gy, or OUTSIDE. Uses
+        the same math as utils.update_data and update_data_bulk.'''
+    (x, y) = pgps_to_xy_array(lon, lat)
+    inside = (0 <= x) & (x <= 1) & (0 <= y) & (y <= 1)
+    gx = np.minimum(np.floor(np.where(inside, x, 0)*w), w - 1).astype(np.int64)
+    gy = np.minimum(np.floor(np.where(inside, y, 0)*h), h - 1).astype(np.int64)
+    return np.where(inside, gx*h + gy, OUTSIDE)
+
+class GridIndex:
+    ''' Raster lookup from (lon, lat) to the cell of a w x h grid.
+
+    Gives the same cells as exact_cells for every point.
+
+    # Arguments:
+        w, h: Integers, the grid size.
+        step: Float, the size of a pixel in degrees.
+        table, lon0, lat0: The raster and the coordinates of its corner,
+            as saved by save. Built from scratch if table is None.
+    '''
+    # Corners closer than this to a cell edge (in cells) don't count as
+    # inside the cell; covers the rounding of pgps_to_xy.
+    margin = 1e-9
+
+    def __init__(self, w, h, step=0.002, table=None, lon0=None, lat0=None):
+        self.w = int(w)
+        self.h = int(h)
+        self.step = float(step)
+        if table is None:
+            (table, lon0, lat0) = self._build()
+        self.table = table
+        self.lon0 = float(lon0)
+        self.lat0 = float(lat0)
+
+    def _build(self):
+        # The grid is the parallelogram spanned by the rows of the basis
+        basis = np.linalg.inv(inv_basis)
+        corners = origin_array + np.array([[0, 0], [1, 0], [0, 1], [1, 1]]) @ basis
+        # Two pixels of padding: the edge pixels are past the grid, so
+        # points off the raster can be clamped to them.
+        lon0 = corners[:, 0].min() - 2*self.step
+        lat0 = corners[:, 1].min() - 2*self.step
+        nlon = int(np.ceil((corners[:, 0].max() - lon0)/self.step)) + 2
+        nlat = int(np.ceil((corners[:, 1].max() - lat0)/self.step)) + 2
+
+        # The grid coordinates of the pixel corners
+        (x, y) = pgps_to_xy_array((lon0 + np.arange(nlon + 1)*self.step)[:, None],
+                                  (lat0 + np.arange(nlat + 1)*self.step)[None, :])
+        (xw, yh) = (x*self.w, y*self.h)
+        clear = ((np.abs(xw - np.round(xw)) > self.margin) &
+                 (np.abs(yh - np.round(yh)) > self.margin))
+        inside = (0 <= x) & (x <= 1) & (0 <= y) & (y <= 1)
+        cell = np.where(inside & clear,
+                        np.floor(xw).astype(np.int64)*self.h + np.floor(yh).astype(np.int64), UNKNOWN)
+
+        def pixel_corners(array):
+            return (array[:-1, :-1], array[1:, :-1], array[:-1, 1:], array[1:, 1:])
+
+        # A cell is convex, so a pixel is inside it if all of its corners are.
+        c = pixel_corners(cell)
+        same_cell = (c[0] != UNKNOWN) & (c[0] == c[1]) & (c[0] == c[2]) & (c[0] == c[3])
+        # Likewise, a pixel is outside if all its corners are past the same edge.
+        outside = np.zeros(same_cell.shape, dtype=bool)
+        for past_edge in (x < 0, x > 1, y < 0, y > 1):
+            past_edge = past_edge & clear
+            p = pixel_corners(past_edge)
+            outside |= p[0] & p[1] & p[2] & p[3]
+
+        dtype = np.int16 if self.w*self.h <= np.iinfo(np.int16).max else np.int32
+        table = np.where(same_cell, c[0], np.where(outside, OUTSIDE, UNKNOWN)).astype(dtype)
+        return table, lon0, lat0
+
+    def cells(self, lon, lat):
+        ''' Cell ids (gx*h + gy, or OUTSIDE) of float arrays lon, lat.'''
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        (nlon, nlat) = self.table.shape
+        # Points off the raster are clamped to its edge (NaN to 0), which is outside the grid
+        i = np.fmin(np.fmax((lon - self.lon0)/self.step, 0), nlon - 1).astype(np.int64)
+        j = np.fmin(np.fmax((lat - self.lat0)/self.step, 0), nlat - 1).astype(np.int64)
+        cells = self.table.reshape(-1).take(i*nlat + j).astype(np.int64)
+        unknown = cells == UNKNOWN
+        if unknown.any():
+            cells[unknown] = exact_cells(lon[unknown], lat[unknown], self.w, self.h)
+        return cells
+
+    def cell(self, lon, lat):
+        ''' Scalar version of cells.'''
+        return int(self.cells(np.array([lon]), np.array([lat]))[0])
+
+    def save(self, filename):
+        ''' Saves the index to filename (.npz), replacing it atomically.'''
+        np.savez(filename + ".tmp.npz", table=self.table, w=self.w, h=self.h, step=self.step,
+                 lon0=self.lon0, lat0=self.lat0, origin=origin_array, inv_basis=inv_basis)
+        os.replace(filename + ".tmp.npz", filename)
+
+    @classmethod
+    def load(cls, filename):
+        ''' Loads an index saved with save. Returns None if the file is
+            missing or was built for a different basis.'''
+        if not os.path.exists(filename):
+            return None
+        with np.load(filename) as data:
+            if not (np.array_equal(data['origin'], origin_array) and np.array_equal(data['inv_basis'], inv_basis)):
+                return None
+            return cls(data['w'], data['h'], step=data['step'], table=data['table'],
+                       lon0=data['lon0'], lat0=data['lat0'])
+
+    @classmethod
+    def cached(cls, w, h, step=0.002, directory="."):
+        ''' Returns the index for a w x h grid, loading it from
+            directory/grid-index-WxH.npz, or building and saving it
+            there if needed.'''
+        filename = cache_filename(w, h, directory)
+        index = cls.load(filename)
+        if index is None or (index.w, index.h, index.step) != (w, h, step):
+            index = cls(w, h, step=step)
+            index.save(filename)
+        return index
+
+def cache_filename(w, h, directory="."):
+    ''' The file GridIndex.cached keeps the index for a w x h grid in.'''
+    return os.path.join(directory, "grid-index-%dx%d.npz" % (w, h))
@@ -1,14 +1,393 @@
+import os
+import json
 import datetime
 import argparse
+import contextlib
+import functools
+import multiprocessing
 import utils
+import metrics
+import gridindex
+import triptable
+import writers
+import background
+import sharding
 import numpy as np
+from sparseflow import SparseFlow
 
 EMPTY_ID = "EMPTY_ID"
+CHECKPOINT_FILENAME = "checkpoint.json"
 
 def print_time():
     ''' Print the current time. '''
     print("  Timestamp:", datetime.datetime.now().strftime("%Y/%m/%d, %H:%M:%S"))
 
+def process_lines_by_entry(read_f, year, month, day, vdata, fdata, vdata_next_mo, fdata_next_mo, trips, width, height, n, V, chunk_size, tz_offset=utils.TZ_OFFSET, grid=None, times=metrics.NO_TIMES, table=None):
+    ''' The 'line' engine: parses the file one line at a time with
+        utils.process_entry. Returns (invalid_count, unparsable_count, line_number).
+        (Cells are always computed exactly, so grid is not used.)
+        If table (a triptable.TripTable) is given, adds every trip to it.'''
+    invalid_count = 0    # Entries that are parsable, but are not a valid trip
+    unparsable_count = 0 # Entries that raise an error on parsing
+    line_number = 0
+    start_entry = utils.Entry(id=EMPTY_ID)
+    start_prefix = None # The driver and order fields of the start entry's line
+
+    for (line, is_last) in times.iterate("read", utils.iter_lines(read_f, chunk_size=chunk_size)):
+        line_number += 1
+        if V and ((line_number % 1000000) == 0):
+            print("    Line", line_number)
+        if start_prefix is not None and not is_last and line.startswith(start_prefix):
+            continue # Same id as the start entry; process_entry would skip it
+        try:
+            # This is where the processing happens.
+            with times.stage("parse"):
+                (entry, is_next) = utils.process_entry(line=line, start_entry=start_entry, n=n, is_last=is_last, tz_offset=tz_offset)
+            if is_next:
+                if not start_entry.id == EMPTY_ID:
+                    with times.stage("validate"):
+                        valid = utils.check_valid(entry=entry, start_entry=start_entry, year=year, month=month, day=day)
+                    if table is not None:
+                        table.add_one(start_entry, entry, valid)
+                    if valid:
+                        with times.stage("aggregate"):
+                            utils.update_data(entry=entry,
+                                            start_entry=start_entry,
+                                            vdata=vdata,
+                                            fdata=fdata,
+                                            vdata_next_mo=vdata_next_mo,
+                                            fdata_next_mo=fdata_next_mo,
+                                            trips=trips,
+                                            w=width,
+                                            h=height,
+                                            n=n)
+                    else:
+                        invalid_count += 1
+
+                start_entry = entry
+                start_prefix = utils.key_prefix(line)
+        except:
+            unparsable_count += 1
+            print("  ERROR - could not parse line", line_number)
+
+    return (invalid_count, unparsable_count, line_number)
+
+def add_entries(entries, last_entry, year, month, day, vdata, fdata, vdata_next_mo, fdata_next_mo, trips, width, height, n, grid=None, times=metrics.NO_TIMES, table=None):
+    ''' Adds the trips between consecutive entries (a columnar entry dict,
+        see utils.make_entries) to the given arrays, starting with the
+        trip from last_entry (the last entry before them, or None).
+        Returns (invalid_count, last_entry), to carry on with.'''
+    if last_entry is not None:
+        entries = utils.concat_entries(last_entry, entries)
+    if len(entries['id']) == 0:
+        return (0, last_entry)
+
+    # Each entry ends the trip started by the entry before it.
+    start_entries = utils.select_entries(entries, slice(None, -1))
+    end_entries = utils.select_entries(entries, slice(1, None))
+    with times.stage("validate"):
+        valid = utils.check_valid_bulk(entries=end_entries, start_entries=start_entries,
+                                       year=year, month=month, day=day)
+    if table is not None:
+        table.add(start_entries, end_entries, valid)
+    with times.stage("aggregate"):
+        utils.update_data_bulk(entries=utils.select_entries(end_entries, valid),
+                               start_entries=utils.select_entries(start_entries, valid),
+                               vdata=vdata,
+                               fdata=fdata,
+                               vdata_next_mo=vdata_next_mo,
+                               fdata_next_mo=fdata_next_mo,
+                               trips=trips,
+                               w=width,
+                               h=height,
+                               n=n,
+                               grid=grid)
+    return (int(np.count_nonzero(~valid)), utils.select_entries(entries, slice(-1, None)))
+
+def process_lines_numpy(read_f, year, month, day, vdata, fdata, vdata_next_mo, fdata_next_mo, trips, width, height, n, V, chunk_size, tz_offset=utils.TZ_OFFSET, grid=None, times=metrics.NO_TIMES, table=None):
+    ''' The 'numpy' engine: parses the file a chunk at a time into
+        columnar arrays (see utils.parse_lines), and only builds entries
+        for the lines that start a new trip.
+        Returns (invalid_count, unparsable_count, line_number).
+        If table (a triptable.TripTable) is given, adds every trip to it.'''
+    invalid_count = 0
+    unparsable_count = 0
+    line_number = 0
+    start_key = EMPTY_ID
+    last_entry = None # The last entry of the previous chunk
+
+    for (lines, is_last) in times.iterate("read", utils.read_chunks(read_f, chunk_size=chunk_size)):
+        with times.stage("parse"):
+            batch = utils.parse_lines(lines)
+            (boundary, unparsable, start_key) = utils.find_boundaries(batch, start_key=start_key, is_last=is_last)
+
+        for index in np.flatnonzero(unparsable):
+            unparsable_count += 1
+            print("  ERROR - could not parse line", line_number + index + 1)
+        if V and ((line_number + len(lines)) // 1000000) > (line_number // 1000000):
+            print("    Line", line_number + len(lines))
+        line_number += len(lines)
+
+        with times.stage("parse"):
+            entries = utils.make_entries(batch, np.flatnonzero(boundary), n=n, tz_offset=tz_offset)
+        (invalid, last_entry) = add_entries(entries, last_entry, year=year, month=month, day=day,
+                                            vdata=vdata, fdata=fdata,
+                                            vdata_next_mo=vdata_next_mo, fdata_next_mo=fdata_next_mo,
+                                            trips=trips, width=width, height=height, n=n,
+                                            grid=grid, times=times, table=table)
+        invalid_count += invalid
+
+    return (invalid_count, unparsable_count, line_number)
+
+def process_file_sharded(filename, year, month, day, vdata, fdata, vdata_next_mo, fdata_next_mo, trips, width, height, n, V, chunk_size, shards, tz_offset=utils.TZ_OFFSET, grid=None, times=metrics.NO_TIMES, table=None, pool=None):
+    ''' Parses an uncompressed GPS file in shards processes (see
+        sharding.parse_file), in pool if given, and adds the trips as the
+        numpy engine does. Returns (invalid_count, unparsable_count, line_number).
+        The read and parse times are summed over the processes.'''
+    invalid_count = 0
+    unparsable_count = 0
+    line_number = 0
+    last_entry = None # The last entry of the previous shard
+
+    results = sharding.parse_file(filename, shards=shards, n=n, tz_offset=tz_offset, chunk_size=chunk_size,
+                                  pool=pool, times=times, V=V)
+    for (entries, unparsable_lines, line_count) in results:
+        for index in unparsable_lines:
+            unparsable_count += 1
+            if index is None:
+                print("  ERROR - could not parse a line") # Partitioned, so out of order
+            else:
+                print("  ERROR - could not parse line", line_number + index + 1)
+        line_number += line_count
+        (invalid, last_entry) = add_entries(entries, last_entry, year=year, month=month, day=day,
+                                            vdata=vdata, fdata=fdata,
+                                            vdata_next_mo=vdata_next_mo, fdata_next_mo=fdata_next_mo,
+                                            trips=trips, width=width, height=height, n=n,
+                                            grid=grid, times=times, table=table)
+        invalid_count += invalid
+    return (invalid_count, unparsable_count, line_number)
+
+ENGINES = {"line": process_lines_by_entry,
+           "numpy": process_lines_numpy}
+
+def day_filename(year, month, day):
+    ''' The GPS file of the given day: ./gps_YYYYMMDD.text, or if there is
+        none, the same compressed (gps_YYYYMMDD.text.gz, .bz2 or .xz).'''
+    filename = "./gps_"+f"{year:04}"+f"{month:02}"+f"{day:02}"+".text"
+    if not os.path.exists(filename):
+        for (_, extension, _) in utils.COMPRESSED_FORMATS:
+            if os.path.exists(filename + extension):
+                return filename + extension
+    return filename
+
+def open_day(year, month, day, chunk_size=1 << 22, prefetch=False):
+    ''' Opens the GPS file of the given day, and skips its header.
+
+    Compressed files are decompressed as they are read (see
+    utils.open_text). If prefetch, returns a background.PrefetchReader,
+    which reads (and decompresses) the file ahead, chunk_size characters
+    at a time, in a separate thread.
+    '''
+    read_f = utils.open_text(day_filename(year, month, day))
+    read_f.readline() # Skip header
+    if prefetch:
+        return background.PrefetchReader(read_f, block_size=chunk_size)
+    return read_f
+
+def process_day(year, month, day, vdata, fdata, vdata_next_mo, fdata_next_mo, trips, width=10, height=20, n=4, V=False, chunk_size=1 << 22, engine="numpy", tz_offset=utils.TZ_OFFSET, grid=None, times=metrics.NO_TIMES, table=None, read_f=None, prefetch=False, shards=1, shard_pool=None):
+    ''' Processes a single day of GPS data, ./gps_YYYYMMDD.text (see
+        day_filename), into the given arrays (which are updated in place).
+
+    Returns (invalid_count, unparsable_count, line_number).
+
+    # Arguments:
+        engine: String, one of ENGINES. 'numpy' parses the file in
+            columnar batches; 'line' uses utils.process_entry per line.
+        tz_offset: Integer, the local time's offset from UTC in seconds.
+            Days and time slots are in local time.
+        grid: Optional gridindex.GridIndex for the width x height grid,
+            to look up the cells of the trips with.
+        times: metrics.StageTimes to record the time spent reading,
+            parsing, validating and aggregating in, and the bytes read.
+        table: Optional triptable.TripTable to add every trip to.
+        read_f: Optional file of the day, already opened with open_day.
+            (The caller closes it.)
+        prefetch: Boolean; if True, read the file ahead in a background
+            thread (see open_day).
+        shards: Integer; if more than 1, parse the file in this many
+            processes (see process_file_sharded). Needs the 'numpy'
+            engine; compressed files are still parsed in one pass.
+        shard_pool: Optional multiprocessing.Pool of shards processes to
+            parse in. (A new one is made for the day if None.)
+        (See process and utils.update_data for the rest.)
+    '''
+    load_filename = day_filename(year, month, day)
+    print(load_filename)
+    # load_filename = "./demoData.text"
+
+    if V:
+        print("Starting on",year,month)
+        print_time()
+
+    times.count("bytes_read", os.path.getsize(load_filename))
+    if shards > 1 and sharding.is_plain(load_filename):
+        if engine != "numpy":
+            raise ValueError("Parsing in shards needs the 'numpy' engine, not " + repr(engine))
+        return process_file_sharded(load_filename, year=year, month=month, day=day,
+                                    vdata=vdata, fdata=fdata,
+                                    vdata_next_mo=vdata_next_mo, fdata_next_mo=fdata_next_mo,
+                                    trips=trips, width=width, height=height, n=n,
+                                    V=V, chunk_size=chunk_size, shards=shards, tz_offset=tz_offset, grid=grid, times=times, table=table,
+                                    pool=shard_pool)
+    with (open_day(year, month, day, chunk_size=chunk_size, prefetch=prefetch) if read_f is None
+          else contextlib.nullcontext(read_f)) as read_f:
+        return ENGINES[engine](read_f, year=year, month=month, day=day,
+                               vdata=vdata, fdata=fdata,
+                               vdata_next_mo=vdata_next_mo, fdata_next_mo=fdata_next_mo,
+                               trips=trips, width=width, height=height, n=n,
+                               V=V, chunk_size=chunk_size, tz_offset=tz_offset, grid=grid, times=times, table=table)
+
+def process_one_day(date, width=10, height=20, n=4, V=False, chunk_size=1 << 22, engine="numpy", sparse=False, tz_offset=utils.TZ_OFFSET, grid=None, timed=False, profile=False, save_trips=False, read_f=None, prefetch=False, shards=1, shard_pool=None):
+    ''' Processes the day date = (year, month, day) into new arrays.
+        Runs in the worker processes when process is given workers > 1.
+
+    Returns (vdata, fdata, vdata_next_mo, fdata_next_mo, trips, errors, times),
+    where times is the metrics.StageTimes of the day.
+
+    # Arguments:
+        grid: Optional gridindex.GridIndex to look up cells with.
+        timed: Boolean; if True, time each stage. (Counts are always kept.)
+        profile: Boolean; if True, save a cProfile of the day to
+            YYYYMMDD-profile.prof.
+        save_trips: Boolean; if True, save the trips of the day to
+            YYYYMMDD-trips.npz (see triptable).
+        read_f, prefetch, shards, shard_pool: See process_day.
+    '''
+    (year, month, day) = date
+    trips = np.zeros((2, 2)) # Statistical info about the trips this month. (See README)
+    vdata = utils.gen_empty_vdata(w=width, h=height, n=n)
+    fdata = utils.gen_empty_fdata(w=width, h=height, n=n, sparse=sparse)
+    vdata_next_mo = utils.gen_empty_vdata(w=width, h=height, n=n)
+    fdata_next_mo = utils.gen_empty_fdata(w=width, h=height, n=n, sparse=sparse)
+
+    times = metrics.StageTimes(enabled=timed)
+    table = triptable.TripTable() if save_trips else None
+    with metrics.profiled(date_string(*date) + "-profile.prof" if profile else None):
+        (invalid_count, unparsable_count, line_number) = process_day(
+            year=year, month=month, day=day,
+            vdata=vdata, fdata=fdata,
+            vdata_next_mo=vdata_next_mo, fdata_next_mo=fdata_next_mo,
+            trips=trips, width=width, height=height, n=n,
+            V=V, chunk_size=chunk_size, engine=engine, tz_offset=tz_offset, grid=grid, times=times, table=table,
+            read_f=read_f, prefetch=prefetch, shards=shards, shard_pool=shard_pool)
+    print("    Line", line_number)
+    times.count("lines", line_number)
+    times.count("valid_trips", int(trips.sum()))
+    times.count("invalid_trips", invalid_count)
+    times.count("unparsable_lines", unparsable_count)
+    if table is not None:
+        with times.stage("save"):
+            triptable.save_trips(triptable.trips_filename(year, month, day), table.columns(),
+                                 unparsable=unparsable_count, tz_offset=tz_offset)
+
+    return (vdata, fdata, vdata_next_mo, fdata_next_mo, trips, np.array([invalid_count, unparsable_count]), times)
+
+def prefetched_days(process_date, dates, chunk_size=1 << 22):
+    ''' Like map(process_date, dates), but opens the file of each day
+        while the day before is processed, so that it is read ahead
+        (see open_day). process_date is given the file as read_f.'''
+    def open_ahead(date):
+        try:
+            return open_day(*date, chunk_size=chunk_size, prefetch=True)
+        except OSError:
+            return None # process_date opens it, and raises the error in turn
+
+    next_f = open_ahead(dates[0]) if dates else None
+    try:
+        for (ii, date) in enumerate(dates):
+            (read_f, next_f) = (next_f, open_ahead(dates[ii + 1]) if ii + 1 < len(dates) else None)
+            with (read_f if read_f is not None else contextlib.nullcontext()):
+                result = process_date(date, read_f=read_f)
+            yield result
+    finally:
+        if next_f is not None:
+            next_f.close()
+
+def date_string(year, month, day):
+    ''' Returns e.g. "20161001", as used in the file names.'''
+    return f"{year:04}"+f"{month:02}"+f"{day:02}"
+
+def save_checkpoint(date, completed, vdata_next_mo, fdata_next_mo, params):
+    ''' Saves the state needed to resume after the given day: the
+        arrays carried over to the next day, and the manifest of
+        completed days (CHECKPOINT_FILENAME).
+
+    The carry-over is written to its own file first, and the manifest
+    is replaced atomically afterwards, so a crash at any point leaves a
+    consistent checkpoint.
+
+    # Arguments:
+        date: (year, month, day), the day that was just saved.
+        completed: List of date strings of all the saved days.
+        vdata_next_mo, fdata_next_mo: The arrays carried over to the
+            day after date.
+        params: Dict of the settings the arrays depend on.
+    '''
+    carry_filename = "checkpoint-" + date_string(*date) + ".npz"
+    np.savez(carry_filename + ".tmp.npz", vdata=vdata_next_mo, **utils.fdata_arrays(fdata_next_mo))
+    os.replace(carry_filename + ".tmp.npz", carry_filename)
+
+    old_manifest = load_checkpoint_manifest()
+    manifest = {'params': params,
+                'completed': sorted(completed),
+                'carry_date': date_string(*date),
+                'carry_filename': carry_filename}
+    with open(CHECKPOINT_FILENAME + ".tmp", "w") as write_f:
+        json.dump(manifest, write_f, indent=1)
+    os.replace(CHECKPOINT_FILENAME + ".tmp", CHECKPOINT_FILENAME)
+
+    if old_manifest is not None and old_manifest['carry_filename'] != carry_filename:
+        if os.path.exists(old_manifest['carry_filename']):
+            os.remove(old_manifest['carry_filename'])
+
+def load_checkpoint_manifest():
+    ''' Returns the manifest saved by save_checkpoint, or None.'''
+    if not os.path.exists(CHECKPOINT_FILENAME):
+        return None
+    with open(CHECKPOINT_FILENAME, "r") as read_f:
+        return json.load(read_f)
+
+def load_checkpoint(dates, params):
+    ''' Finds where to resume processing the given dates.
+
+    Returns (dates, completed, vdata_next_mo, fdata_next_mo): the dates
+    from the first incomplete one onward, the date strings already
+    completed, and the carried-over arrays (None if starting afresh).
+    Raises a ValueError if the checkpoint can't be resumed from.
+    '''
+    manifest = load_checkpoint_manifest()
+    if manifest is None:
+        return dates, [], None, None
+    if manifest['params'] != params:
+        raise ValueError("Checkpoint was made with different settings: " + str(manifest['params']))
+
+    completed = manifest['completed']
+    remaining = [ii for (ii, date) in enumerate(dates) if date_string(*date) not in completed]
+    if not remaining:
+        return [], completed, None, None
+    first = remaining[0]
+    if first == 0:
+        return dates, completed, None, None
+
+    # Resuming mid-range: need the trips carried over from the day before.
+    if manifest['carry_date'] != date_string(*dates[first - 1]):
+        raise ValueError("Checkpoint has the carry-over from " + manifest['carry_date'] +
+                         ", not " + date_string(*dates[first - 1]) + "; use --restart from that day instead.")
+    with np.load(manifest['carry_filename']) as data:
+        vdata_next_mo = data['vdata']
+        fdata_next_mo = utils.load_fdata(data, dense=not params['sparse'], directory=os.path.dirname(manifest['carry_filename']))
+    return dates[first:], completed, vdata_next_mo, fdata_next_mo
+
 def process( startyear  = 2016,
              startmonth = 10,
              startday   = 1,
@@ -19,7 +398,21 @@ def process( startyear  = 2016,
              height     = 20,
              n          = 4,
              V          = False,
-             restart    = False ):
+             restart    = False,
+             chunk_size = 1 << 22,
+             engine     = "numpy",
+             workers    = 1,
+             sparse     = False,
+             resume     = False,
+             tz_offset  = utils.TZ_OFFSET,
+             grid_index = True,
+             metrics_filename = None,
+             profile    = False,
+             save_trips = False,
+             codec      = writers.DEFAULT_CODEC,
+             compress_level = None,
+             pipeline   = False,
+             shards     = 1 ):
     ''' Processes data from FOIL201*/trip_data_*.csv into compressed .npz files.
 
     Returns nothing. Processes month-by-month.
@@ -33,83 +426,136 @@ def process( startyear  = 2016,
         V: Boolean; if True, print extra information to console.
         restart: Boolean; if True, don't save the processed data for
             the first year, month.
+        chunk_size: Integer, the number of characters read from the
+            input file at a time. Bounds the memory used for reading.
+        engine: String, the parse engine to use. (See ENGINES)
+        workers: Integer; if more than 1, process this many days at once
+            in a pool of worker processes. The output is identical.
+        sparse: Boolean; if True, keep and save fdata as a SparseFlow.
+            (Load it with utils.load_fdata.)
+        resume: Boolean; if True, skip the days already completed
+            according to the checkpoint (see save_checkpoint), and
+            continue from the first incomplete day.
+        tz_offset: Integer, the offset of local time from UTC in seconds.
+            Days and time slots are counted in local time.
+        grid_index: Boolean; if True, look up the cells of the trips in
+            a precomputed index (see gridindex.GridIndex), built once
+            for all the days. The output is the same.
+        metrics_filename: String; if given, time each stage of each day
+            and save the times and counts (see metrics.StageTimes) to
+            this file: a Prometheus textfile if it ends in .prom, or
+            one JSON line per day otherwise.
+        profile: Boolean; if True, save a cProfile of each day to
+            YYYYMMDD-profile.prof.
+        save_trips: Boolean; if True, also save the trips of each day to
+            YYYYMMDD-trips.npz, from which script_grid.py can build the
+            data for other grid sizes and n without reparsing.
+        codec: String, how to compress the saved -data.npz files (see
+            writers.CODECS). Every codec gives a file np.load reads.
+        compress_level: Integer from 1 (fastest) to 9 (smallest), or
+            None for the codec's default. Only for the codecs in
+            writers.LEVELED_CODECS.
+        pipeline: Boolean; if True, overlap reading and saving with
+            processing: each day's file is read ahead in a background
+            thread (the next day's is opened while the current one is
+            processed), and the output of each day is saved in another
+            thread while the next day is processed. The output is the same.
+        shards: Integer; if more than 1, parse each day's file in this
+            many processes, split at order boundaries (see sharding.py),
+            so that one large day uses several cores. (Use instead of
+            workers.) The output is the same for sorted files. Unsorted
+            files are held in memory, spread across the processes.
     '''
+    if workers > 1 and shards > 1:
+        raise ValueError("Give either workers (days at once) or shards (processes per day), not both")
+    writers.check_codec(codec, compress_level)
     # List of year-month dates to iterate over.
     dates = utils.generate_dates(startyear, startmonth, startday, endyear, endmonth, endday)
-
-    # Generate empty arrays for the 'next month' of data.
-    vdata_next_mo = utils.gen_empty_vdata(w=width, h=height, n=n)
-    fdata_next_mo = utils.gen_empty_fdata(w=width, h=height, n=n)
-
-    for (year, month, day) in dates:
-        trips = np.zeros((2, 2)) # Statistical info about the trips this month. (See README)
-        invalid_count = 0    # Entries that are parsable, but are not a valid trip
-        unparsable_count = 0 # Entries that raise an error on parsing
-        line_number = 0
-
-        # Shift the vdata, fdata that are in-focus to this month
-        vdata = vdata_next_mo
-        fdata = fdata_next_mo
-
-        # Generate new, empty 'next-month' arrays
-        #   (For trips that cross the boundary, e.g. 2-28 at 11:59 to 3:01 at 0:02
-        vdata_next_mo = utils.gen_empty_vdata(w=width, h=height, n=n)
-        fdata_next_mo = utils.gen_empty_fdata(w=width, h=height, n=n)
-
-        load_filename = "./gps_"+f"{year:04}"+f"{month:02}"+f"{day:02}"+".text"
-        print(load_filename)
-        # load_filename = "./demoData.text"
-
+    params = {'width': width, 'height': height, 'n': n, 'sparse': sparse, 'tz_offset': tz_offset}
+    completed = []
+    carry = (None, None)
+    if resume:
+        (dates, completed, *carry) = load_checkpoint(dates, params)
         if V:
-            print("Starting on",year,month)
-            print_time()
-
-        with open(load_filename, "r", encoding='UTF-8') as read_f:
-            read_f.readline() # Skip header
-            lines = read_f.readlines()
-            start_entry = {"id": EMPTY_ID}
-
-            for line in lines:
-                line_number += 1
-                if V and ((line_number % 1000000) == 0):
-                    print("    Line", line_number)
-                try:
-                    # This is where the processing happens.
-                    (entry, is_next) = utils.process_entry(line=line, start_entry=start_entry, n=n, is_last=(line is lines[-1]))
-                    if is_next:
-                        if not start_entry["id"] == EMPTY_ID:
-                            if utils.check_valid(entry=entry, start_entry=start_entry, year=year, month=month, day=day):
-                                utils.update_data(entry=entry,
-                                                start_entry=start_entry,
-                                                vdata=vdata,
-                                                fdata=fdata,
-                                                vdata_next_mo=vdata_next_mo,
-                                                fdata_next_mo=fdata_next_mo,
-                                                trips=trips,
-                                                w=width,
-                                                h=height,
-                                                n=n)
-                            else:
-                                invalid_count += 1
-
-                        start_entry = entry
-                except:
-                    unparsable_count += 1
-                    print("  ERROR - could not parse line", line_number)
-
-        print("    Line", line_number)
-
-        if restart and year == startyear and month == startmonth and day == startday:
+            print("Resuming from", dates[0] if dates else "the end; all days are complete.")
+    # Built in memory (in well under a second) rather than cached in a file
+    grid = gridindex.GridIndex(width, height) if grid_index else None
+    process_date = functools.partial(process_one_day, width=width, height=height, n=n,
+                                     V=V, chunk_size=chunk_size, engine=engine, sparse=sparse,
+                                     tz_offset=tz_offset, grid=grid, timed=metrics_filename is not None, profile=profile,
+                                     save_trips=save_trips, prefetch=pipeline and shards == 1, shards=shards)
+    total_times = metrics.StageTimes() # Running totals, for the Prometheus textfile
+
+    def save_day(date, vdata, fdata, trips, errors, times, vdata_next_mo, fdata_next_mo):
+        # Saves a processed day, its checkpoint and its metrics.
+        #   Runs in the background with pipeline, one day at a time.
+        nonlocal completed
+        (year, month, day) = date
+        if restart and carry[0] is None and year == startyear and month == startmonth and day == startday:
             if V:
                 print("Not saving for", year, month, day, "due to restart flag.")
         else:
             # Save the file
-            save_filename_date = f"{year:04}"+f"{month:02}"+f"{day:02}"
+            save_filename_date = date_string(year, month, day)
 
             if V:
                 print("Saving",save_filename_date)
                 print_time()
-            np.savez_compressed(save_filename_date + "-data.npz", vdata = vdata, fdata = fdata, trips = trips, errors = np.array([invalid_count, unparsable_count]))
+            with times.stage("save"):
+                writers.save_arrays(save_filename_date + "-data.npz", dict(vdata = vdata, trips = trips, errors = errors, **utils.fdata_arrays(fdata)),
+                                    codec=codec, level=compress_level)
+            times.count("bytes_written", os.path.getsize(save_filename_date + "-data.npz"))
+
+            completed = sorted(set(completed) | {save_filename_date})
+            with times.stage("checkpoint"):
+                save_checkpoint((year, month, day), completed, vdata_next_mo, fdata_next_mo, params)
+
+        if metrics_filename is not None:
+            record = times.record(day=date_string(year, month, day))
+            if metrics_filename.endswith(".prom"):
+                total_times.merge(times)
+                total_times.count("days", 1)
+                metrics.write_prometheus(metrics_filename, record, total_times.record())
+            else:
+                metrics.write_json_line(metrics_filename, record)
+
+    # Generate empty arrays for the 'next month' of data.
+    vdata_next_mo = utils.gen_empty_vdata(w=width, h=height, n=n)
+    fdata_next_mo = utils.gen_empty_fdata(w=width, h=height, n=n, sparse=sparse)
+    if carry[0] is not None:
+        (vdata_next_mo, fdata_next_mo) = carry
+
+    with (multiprocessing.Pool(workers) if workers > 1 else contextlib.nullcontext()) as pool, \
+         (multiprocessing.Pool(shards) if shards > 1 else contextlib.nullcontext()) as shard_pool, \
+         (background.OrderedWorker() if pipeline else contextlib.nullcontext()) as saver:
+        # Days are processed independently (in parallel, with workers > 1),
+        # and come back in order.
+        if shard_pool is not None:
+            # One pool for every day's shards
+            process_date = functools.partial(process_date, shard_pool=shard_pool)
+        if pool is not None:
+            days = pool.imap(process_date, dates)
+        elif pipeline and shards == 1:
+            days = prefetched_days(process_date, dates, chunk_size=chunk_size)
+        else:
+            days = map(process_date, dates)
+
+        for (date, (vdata, fdata, vdata_next, fdata_next, trips, errors, times)) in zip(dates, days):
+            # Add the trips that started on the previous day and end on this one
+            #   (For trips that cross the boundary, e.g. 2-28 at 11:59 to 3:01 at 0:02
+            vdata += vdata_next_mo
+            fdata += fdata_next_mo
+            vdata_next_mo = vdata_next
+            fdata_next_mo = fdata_next
+
+            if saver is None:
+                save_day(date, vdata, fdata, trips, errors, times, vdata_next_mo, fdata_next_mo)
+            else:
+                # Sparse arrays are coalesced here, so the saving thread only reads them
+                for data in (fdata, fdata_next_mo):
+                    if isinstance(data, SparseFlow):
+                        data.coalesce()
+                saver.submit(save_day, date, vdata, fdata, trips, errors, times, vdata_next_mo, fdata_next_mo)
 
     if V:
         print("All finished!")
@@ -149,7 +595,49 @@ if __name__ == '__main__':
                         help="",
                         action="store_true")
     parser.add_argument("--restart", "-r",
-                        help="Does not save the first month of data. Used to restart code when it crashes. (E.g. 2010 08 can have trips starting in 2010 07 that end in 2010 08)",
+                        help="Does not save the first month of data. Used to restart code when it crashes. (E.g. 2010 08 can have trips starting in 2010 07 that end in 2010 08) Prefer --resume.",
+                        action="store_true")
+    parser.add_argument("--resume", "-R",
+                        help="Continue from the first day not yet completed, according to " + CHECKPOINT_FILENAME + ", using the saved carry-over instead of reprocessing the day before.",
+                        action="store_true")
+    parser.add_argument("--chunksize", "-c",
+                        help="Number of characters to read from the input file at a time. (Default 4194304)",
+                        type=int, nargs=1)
+    parser.add_argument("--engine", "-e",
+                        help="Parse engine: 'numpy' (columnar batches, default) or 'line' (one line at a time).",
+                        choices=sorted(ENGINES), nargs=1)
+    parser.add_argument("--workers", "-w",
+                        help="Number of days to process in parallel, in separate processes. (Default 1)",
+                        type=int, nargs=1)
+    parser.add_argument("--sparse", "-s",
+                        help="Store and save the flow data (fdata) sparsely, as index/count arrays. Load with utils.load_fdata.",
+                        action="store_true")
+    parser.add_argument("--utcoffset", "-u",
+                        help="Offset of the local time from UTC, in hours. Days and time slots are in local time. (Default 8, China Standard Time)",
+                        type=float, nargs=1)
+    parser.add_argument("--nogridindex", "-G",
+                        help="Compute the cell of each trip from its coordinates, instead of looking it up in the grid index. (The output is the same.)",
+                        action="store_true")
+    parser.add_argument("--metrics", "-m",
+                        help="Save the time spent in each stage and the line, trip and byte counts of each day to this file: a Prometheus textfile if it ends in .prom, JSON lines otherwise.",
+                        type=str, nargs=1)
+    parser.add_argument("--profile", "-p",
+                        help="Save a cProfile of each day to YYYYMMDD-profile.prof (read with python -m pstats).",
+                        action="store_true")
+    parser.add_argument("--savetrips", "-t",
+                        help="Also save the trips of each day to YYYYMMDD-trips.npz, to build other grid sizes from with script_grid.py.",
+                        action="store_true")
+    parser.add_argument("--codec", "-z",
+                        help="How to compress the saved -data.npz files: 'npz-zlib' (default, as np.savez_compressed), 'npz' (uncompressed), 'npz-bz2', 'npz-lzma' or 'npz-chunked' (dense fdata in a .fchunks file alongside, see chunkstore.py). All are read with np.load and utils.load_fdata.",
+                        choices=sorted(writers.CODECS), nargs=1)
+    parser.add_argument("--compresslevel", "-Z",
+                        help="Compression level, from 1 (fastest) to 9 (smallest). (Default: the codec's default)",
+                        type=int, nargs=1)
+    parser.add_argument("--shards", "-S",
+                        help="Parse each day's file in this many processes, split at order boundaries, to use several cores on one day. (Instead of --workers; see sharding.py. An unsorted file is held in memory, spread across the processes.)",
+                        type=int, nargs=1)
+    parser.add_argument("--pipeline", "-P",
+                        help="Read each day's file ahead and save the output in background threads, overlapping I/O with processing. (The output is the same.)",
                         action="store_true")
 
     args = parser.parse_args()
@@ -166,6 +654,20 @@ if __name__ == '__main__':
     n           = 4     if args.nslotsperhour is None else args.nslotsperhour[0]
     V = args.verbose
     restart = args.restart
+    chunk_size  = 1 << 22 if args.chunksize is None else args.chunksize[0]
+    engine      = "numpy" if args.engine    is None else args.engine[0]
+    workers     = 1     if args.workers     is None else args.workers[0]
+    sparse = args.sparse
+    resume = args.resume
+    tz_offset   = utils.TZ_OFFSET if args.utcoffset is None else int(round(args.utcoffset[0]*3600))
+    grid_index = not args.nogridindex
+    metrics_filename = None if args.metrics is None else args.metrics[0]
+    profile = args.profile
+    save_trips = args.savetrips
+    codec       = writers.DEFAULT_CODEC if args.codec is None else args.codec[0]
+    compress_level = None if args.compresslevel is None else args.compresslevel[0]
+    pipeline = args.pipeline
+    shards      = 1     if args.shards      is None else args.shards[0]
 
     print("NYCDataProcessing/main.py started.")
 
@@ -188,5 +690,19 @@ if __name__ == '__main__':
              height     = height,
              n          = n,
              V          = V,
-             restart    = restart)
+             restart    = restart,
+             chunk_size = chunk_size,
+             engine     = engine,
+             workers    = workers,
+             sparse     = sparse,
+             resume     = resume,
+             tz_offset  = tz_offset,
+             grid_index = grid_index,
+             metrics_filename = metrics_filename,
+             profile    = profile,
+             save_trips = save_trips,
+             codec      = codec,
+             compress_level = compress_level,
+             pipeline   = pipeline,
+             shards     = shards)
 
@@ -0,0 +1,170 @@
+''' Metrics for the processing stages (read, parse, validate, aggregate,
+save), and ways to emit them: JSON lines, or a Prometheus textfile.'''
+
+import os
+import time
+import json
+import cProfile
+import contextlib
+
+class StageTimes:
+    ''' Accumulates the wall and CPU time spent in each named stage,
+        and named counts (lines, trips, bytes, ...).
+
+    Use as:
+        times = StageTimes()
+        with times.stage("parse"):
+            ...
+        times.count("lines", 1000)
+        times.seconds      # {"parse": 0.12, ...}
+        times.cpu_seconds  # {"parse": 0.11, ...}
+        times.counts       # {"lines": 1000}
+
+    # Arguments:
+        enabled: Boolean; if False, stage() does nothing (see NO_TIMES).
+            Counts are kept either way.
+    '''
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.seconds = {}
+        self.cpu_seconds = {}
+        self.counts = {}
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+            self.cpu_seconds[name] = self.cpu_seconds.get(name, 0.0) + time.process_time() - cpu_start
+
+    def stage(self, name):
+        ''' Context manager; adds the time spent inside it to stage name.'''
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timed(name)
+
+    def iterate(self, name, iterable):
+        ''' Returns an iterator over iterable that adds the time spent
+            producing each item (e.g. reading the next chunk of a file)
+            to stage name.'''
+        if not self.enabled:
+            return iter(iterable)
+        return self._iterate(name, iterable)
+
+    def _iterate(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, value):
+        ''' Adds value to the count name.'''
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def merge(self, other):
+        ''' Adds the times and counts of another StageTimes to this one.'''
+        for (mine, theirs) in ((self.seconds, other.seconds),
+                               (self.cpu_seconds, other.cpu_seconds),
+                               (self.counts, other.counts)):
+            for (name, value) in theirs.items():
+                mine[name] = mine.get(name, 0) + value
+
+    def record(self, **labels):
+        ''' Returns the metrics as a dict for write_json_line and
+            write_prometheus, e.g. record(day="20161001").'''
+        return dict(labels, seconds=dict(self.seconds), cpu_seconds=dict(self.cpu_seconds), counts=dict(self.counts))
+
+# Used when no timing is wanted
+NO_TIMES = StageTimes(enabled=False)
+
+# Descriptions of the counts main.py records for each day (and, in
+# its running totals, for all of them)
+COUNTS = {
+    'lines': "Lines read from the GPS file.",
+    'valid_trips': "Trips added to vdata and fdata.",
+    'invalid_trips': "Trips rejected by check_valid.",
+    'unparsable_lines': "Lines that could not be parsed.",
+    'bytes_read': "Size of the GPS file, as stored (compressed or not).",
+    'bytes_written': "Size of the saved -data.npz file.",
+    'days': "Days processed.",
+}
+
+def write_json_line(filename, record):
+    ''' Appends record (see StageTimes.record) to filename as one line
+        of JSON.'''
+    with open(filename, "a") as write_f:
+        write_f.write(json.dumps(record, sort_keys=True) + "\n")
+
+def _prometheus_labels(labels):
+    return "{" + ",".join('%s="%s"' % (key, str(value).replace('"', '\\"')) for (key, value) in sorted(labels.items())) + "}"
+
+def _prometheus_series(lines, prefix, record, kind):
+    # Adds the stage times and counts of record to lines, as gauges, or
+    # as counters (named ..._total)
+    suffix = "_total" if kind == "counter" else ""
+    for (name, help_text, key) in (("stage_seconds", "Wall time spent in each stage.", 'seconds'),
+                                   ("stage_cpu_seconds", "CPU time spent in each stage.", 'cpu_seconds')):
+        lines.append("# HELP %s_%s%s %s" % (prefix, name, suffix, help_text))
+        lines.append("# TYPE %s_%s%s %s" % (prefix, name, suffix, kind))
+        for (stage, seconds) in sorted(record[key].items()):
+            lines.append("%s_%s%s%s %r" % (prefix, name, suffix, _prometheus_labels({'stage': stage}), seconds))
+    for (name, value) in sorted(record['counts'].items()):
+        lines.append("# HELP %s_%s%s %s" % (prefix, name, suffix, COUNTS.get(name, name)))
+        lines.append("# TYPE %s_%s%s %s" % (prefix, name, suffix, kind))
+        lines.append("%s_%s%s %d" % (prefix, name, suffix, value))
+
+def write_prometheus(filename, latest, totals, prefix="gps"):
+    ''' Writes metrics to filename in the Prometheus text format, for
+        node_exporter's textfile collector. The file is replaced
+        atomically.
+
+    The series don't have a label per day, so that there are as many
+    whichever the number of days:
+        gps_stage_seconds{stage="parse"}, gps_stage_cpu_seconds{...},
+        gps_<count>, and gps_<label> for the other keys of latest (e.g.
+        gps_day 20161001): gauges, for the last day.
+        gps_stage_seconds_total{stage="parse"}, ..., gps_<count>_total:
+        counters, for all the days so far.
+
+    # Arguments:
+        latest: Dict, the record (see StageTimes.record) of the last
+            day, with numeric labels.
+        totals: Dict, the record of the running totals.
+    '''
+    lines = []
+    for (label, value) in sorted(latest.items()):
+        if not isinstance(value, dict):
+            lines.append("# HELP %s_%s The %s of the gauges below, e.g. YYYYMMDD." % (prefix, label, label))
+            lines.append("# TYPE %s_%s gauge" % (prefix, label))
+            lines.append("%s_%s %d" % (prefix, label, int(value)))
+    _prometheus_series(lines, prefix, latest, "gauge")
+    _prometheus_series(lines, prefix, totals, "counter")
+
+    with open(filename + ".tmp", "w") as write_f:
+        write_f.write("\n".join(lines) + "\n")
+    os.replace(filename + ".tmp", filename)
+
+def profiled(filename=None):
+    ''' Context manager; runs its body under cProfile and saves the
+        stats to filename (read them with pstats). Does nothing if
+        filename is None.'''
+    if filename is None:
+        return contextlib.nullcontext()
+    return _profiled(filename)
+
+@contextlib.contextmanager
+def _profiled(filename):
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        profile.dump_stats(filename)
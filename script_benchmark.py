@@ -0,0 +1,182 @@
+import io
+import os
+import json
+import time
+import random
+import argparse
+import datetime
+import resource
+import tempfile
+import contextlib
+import multiprocessing
+import numpy as np
+import utils
+import metrics
+import writers
+import main
+
+'''
+Benchmarks the parse -> validate -> aggregate -> save pipeline of main.py
+on synthetic GPS data.
+
+A day of data is generated in the same format as gps_20161001.text,
+    [driver, order, timestamp, lon, lat]
+and processed once for every combination of engine, grid size and n.
+Each run happens in a fresh process, and reports lines/sec, trips/sec,
+peak RSS and the time spent in each stage. With --codecs, each run also
+saves its output with every given codec (see writers.py), and reports
+the time and size of each.
+
+E.g. compare the engines at two grid sizes, on 100k orders:
+    python3.6 script_benchmark.py --orders 100000 --grids 10x20 5x10 -n 4 2
+or the output codecs, with zlib at two levels:
+    python3.6 script_benchmark.py -e numpy --codecs npz npz-zlib npz-lzma --levels 1 6
+'''
+
+STAGES = ("read", "parse", "validate", "aggregate", "save")
+
+def write_gps_day(filename, year, month, day, orders=1000, max_pings=40, bad_fraction=0.001, seed=0):
+    ''' Writes a day of random GPS data to filename, in the format of
+        gps_YYYYMMDD.text. Returns the number of lines written.
+
+    Orders are contiguous, as in the real data. Some trips cross
+    midnight, some leave the grid, and about bad_fraction of the lines
+    can't be parsed.
+
+    # Arguments:
+        orders: Integer, the number of orders (trips) to write.
+        max_pings: Integer, each order has 1 to max_pings lines.
+        bad_fraction: Float, the fraction of unparsable lines.
+        seed: The random seed.
+    '''
+    rng = random.Random(seed)
+    local = datetime.timezone(datetime.timedelta(seconds=utils.TZ_OFFSET))
+    base = int(datetime.datetime(year, month, day, tzinfo=local).timestamp())
+    lines = 0
+    with open(filename, "w", encoding="UTF-8") as write_f:
+        write_f.write("[driver, order, timestamp, lon, lat]\n")
+        for _ in range(orders):
+            driver = "%032x" % rng.getrandbits(128)
+            order = "%032x" % rng.getrandbits(128)
+            timestamp = base + rng.randint(-600, 86400 + 600)
+            lon = rng.uniform(103.5, 104.5)
+            lat = rng.uniform(30.0, 31.0)
+            for _ in range(rng.randint(1, max_pings)):
+                if rng.random() < bad_fraction:
+                    write_f.write("['%s', '%s', 'unknown', '', '']\n" % (driver, order))
+                else:
+                    write_f.write("['%s', '%s', '%d', '%.5f', '%.5f']\n" % (driver, order, timestamp, lon, lat))
+                lines += 1
+                timestamp += rng.randint(1, 30)
+                lon += rng.uniform(-0.002, 0.002)
+                lat += rng.uniform(-0.002, 0.002)
+    return lines
+
+def run_once(directory, date, engine="numpy", width=10, height=20, n=4, sparse=False, chunk_size=1 << 22, codecs=None, levels=(None,)):
+    ''' Processes gps_YYYYMMDD.text in directory for date, then saves it
+        as main.process would. Meant to run in a fresh process, so that
+        the peak RSS is that of this run alone.
+
+    Returns a dict of the results. If codecs are given (see
+    writers.compare_codecs), its 'codecs' are the time and size of
+    saving the output with each.
+    '''
+    os.chdir(directory)
+    (year, month, day) = date
+    times = metrics.StageTimes()
+    vdata = utils.gen_empty_vdata(w=width, h=height, n=n)
+    fdata = utils.gen_empty_fdata(w=width, h=height, n=n, sparse=sparse)
+    vdata_next_mo = utils.gen_empty_vdata(w=width, h=height, n=n)
+    fdata_next_mo = utils.gen_empty_fdata(w=width, h=height, n=n, sparse=sparse)
+    trips = np.zeros((2, 2))
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        (invalid_count, unparsable_count, line_number) = main.process_day(
+            year=year, month=month, day=day,
+            vdata=vdata, fdata=fdata,
+            vdata_next_mo=vdata_next_mo, fdata_next_mo=fdata_next_mo,
+            trips=trips, width=width, height=height, n=n,
+            chunk_size=chunk_size, engine=engine, times=times)
+    with times.stage("save"):
+        save_filename = "benchmark-%d.npz" % os.getpid()
+        arrays = dict(vdata=vdata, trips=trips, errors=np.array([invalid_count, unparsable_count]), **utils.fdata_arrays(fdata))
+        writers.save_arrays(save_filename, arrays)
+    seconds = time.perf_counter() - start
+    saved_bytes = os.path.getsize(save_filename)
+    os.remove(save_filename)
+    codec_results = [] if codecs is None else writers.compare_codecs(arrays, codecs=codecs, levels=levels)
+
+    trip_count = int(trips.sum()) + invalid_count
+    return {'engine': engine, 'width': width, 'height': height, 'n': n, 'sparse': sparse,
+            'lines': line_number,
+            'trips': trip_count,
+            'seconds': seconds,
+            'lines_per_sec': line_number / seconds,
+            'trips_per_sec': trip_count / seconds,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'saved_bytes': saved_bytes,
+            'stages': {stage: times.seconds.get(stage, 0.0) for stage in STAGES},
+            'codecs': codec_results}
+
+def run_benchmark(orders=100000, max_pings=40, grids=((10, 20),), ns=(4,), engines=("numpy", "line"), sparse=False, chunk_size=1 << 22, seed=0, codecs=None, levels=(None,), V=True):
+    ''' Generates a day of data and runs every combination of engine,
+        grid and n on it. Returns a list of result dicts (see run_once).'''
+    date = (2016, 10, 1)
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "gps_%04d%02d%02d.text" % date)
+        lines = write_gps_day(filename, *date, orders=orders, max_pings=max_pings, seed=seed)
+        if V:
+            print("Generated", lines, "lines,", os.path.getsize(filename) // (1 << 20), "MB")
+        for engine in engines:
+            for (width, height) in grids:
+                for n in ns:
+                    with context.Pool(1) as pool:
+                        result = pool.apply(run_once, (directory, date),
+                                            dict(engine=engine, width=width, height=height, n=n,
+                                                 sparse=sparse, chunk_size=chunk_size,
+                                                 codecs=codecs, levels=levels))
+                    results.append(result)
+                    if V:
+                        print_result(result)
+    return results
+
+def print_result(result):
+    ''' Prints one result of run_once as a line of a table.'''
+    stages = " ".join("%s %.2fs" % (stage, result['stages'][stage]) for stage in STAGES)
+    print("%-6s %3dx%-3d n=%d%s: %9.0f lines/s %8.0f trips/s %7.1f MB peak  %s" % (
+          result['engine'], result['width'], result['height'], result['n'],
+          " sparse" if result['sparse'] else "",
+          result['lines_per_sec'], result['trips_per_sec'], result['peak_rss_mb'], stages))
+    for codec in result.get('codecs', []):
+        level = "" if codec['level'] is None else " -%d" % codec['level']
+        print("    %-12s save %6.3fs %10d bytes" % (codec['codec'] + level, codec['seconds'], codec['bytes']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the GPS processing pipeline")
+    parser.add_argument("--orders", "-o", help="Number of orders (trips) to generate. Default 100000", type=int, default=100000)
+    parser.add_argument("--maxpings", "-p", help="Each order has 1 to this many lines. Default 40", type=int, default=40)
+    parser.add_argument("--grids", "-g", help="Grid sizes, as WxH. Default 10x20", nargs="+", default=["10x20"])
+    parser.add_argument("--nslotsperhour", "-n", help="Values of n to try. Default 4", type=int, nargs="+", default=[4])
+    parser.add_argument("--engines", "-e", help="Engines to compare. Default numpy line", nargs="+",
+                        choices=sorted(main.ENGINES), default=["numpy", "line"])
+    parser.add_argument("--sparse", "-s", help="Store fdata sparsely.", action="store_true")
+    parser.add_argument("--chunksize", "-c", help="Characters read at a time. Default 4194304", type=int, default=1 << 22)
+    parser.add_argument("--seed", help="Random seed for the generated data. Default 0", type=int, default=0)
+    parser.add_argument("--codecs", help="Also time saving the output with each of these codecs.", nargs="+",
+                        choices=sorted(writers.CODECS))
+    parser.add_argument("--levels", help="Compression levels to try the codecs at. Default: the codec's default", type=int, nargs="+")
+    parser.add_argument("--output", help="Also save the results to this JSON file.", type=str)
+
+    args = parser.parse_args()
+    grids = [tuple(int(size) for size in grid.lower().split("x")) for grid in args.grids]
+
+    results = run_benchmark(orders=args.orders, max_pings=args.maxpings, grids=grids,
+                            ns=args.nslotsperhour, engines=args.engines, sparse=args.sparse,
+                            chunk_size=args.chunksize, seed=args.seed, codecs=args.codecs,
+                            levels=(None,) if args.levels is None else args.levels)
+    if args.output:
+        with open(args.output, "w") as write_f:
+            json.dump(results, write_f, indent=1)
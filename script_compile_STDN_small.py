@@ -1,42 +1,28 @@
-import numpy as np
-from utils import generate_dates
+from utils import generate_dates, compile_arrays
 
 ''' Use this to take all the individual STDN files in data/
     and put them into four large numpy arrays
-'''
 
+    The outputs are uncompressed, memory-mapped .npy files; load them
+    with np.load("data/STDN-volume.npy", mmap_mode="r").
+'''
 
-# First batch of filenames
-fns_f = ["STDN-flow-2013-01.npz",
-        "STDN-flow-2013-02.npz"]
 
-fns_v = ["STDN-volume-2013-01.npz",
-        "STDN-volume-2013-02.npz"]
+# First batch of filenames: the first two days, as script_data_to_stdn
+# names them
+datestrs = ["%04d%02d%02d" % date for date in generate_dates(2016, 10, 1, 2016, 10, 3)]
+fns_f = ["STDN-flow-" + datestr + ".npz" for datestr in datestrs]
+fns_v = ["STDN-volume-" + datestr + ".npz" for datestr in datestrs]
 
 # vdata
-# Load from the first line
-print("Loading from", fns_v[0])
-vdata = np.load("data/" + fns_v[0])['arr_0']
-# And then concate from the rest of the lines
-for fname in fns_v[1:]:
-    print("Loading from", fname)
-    vdata = np.concatenate((vdata, np.load("data/" + fname)['arr_0']), axis=0)
-
-print("Saving to STDN-volume.npz")
-np.savez_compressed("data/STDN-volume.npz",vdata)
+# Preallocate the full output from the file headers, then write each
+# day into it in place.
+print("Saving to STDN-volume.npy")
+vdata = compile_arrays(["data/" + fname for fname in fns_v], "data/STDN-volume.npy", axis=0)
 del(vdata) # Free from memory!
 
 
 # fdata
-# Load from the first line
-fdata = np.load("data/" + fns_f[0])['arr_0']
-
-# And then concate from the rest of the lines
-for fname in fns_f[1:]:
-    print("Loading from",fname)
-    fdata = np.concatenate((fdata, np.load("data/" + fname)['arr_0']), axis=1)
-
-print("Saving to STDN-flow.npz")
-np.savez_compressed("data/STDN-flow.npz",fdata)
+print("Saving to STDN-flow.npy")
+fdata = compile_arrays(["data/" + fname for fname in fns_f], "data/STDN-flow.npy", axis=1)
 del(fdata) # Free from memory!
-
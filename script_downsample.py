@@ -0,0 +1,211 @@
+import os
+import queue
+import argparse
+import threading
+import numpy as np
+import utils
+import main
+import script_pipeline
+from sparseflow import SparseFlow
+
+'''
+Coarsens processed days to a smaller grid and fewer time slots per hour:
+    data/YYYYMMDD-data.npz (e.g. 10x20, n=4)  ->  out/YYYYMMDD-data.npz (e.g. 5x10, n=2)
+
+The width, height and n must divide those of the input. Each block of
+cells and time slots is summed, so vdata, the spatial axes of fdata,
+trips and errors are exactly what main.py would give at the coarser
+setting, without reparsing anything.
+
+Axis 0 of fdata (same slot / earlier slot) can't always be recovered:
+a flow from an earlier fine slot may start in the same coarse slot.
+Those flows stay in 'earlier slot', and are counted as ambiguous.
+Similarly, main.py keeps the flow of a trip that ends in the same slot
+of the next day (i.e. lasts almost a day) on the day it starts, so such
+a flow can end up a day later here. For an exact fdata, build from trip
+tables with script_grid.py instead.
+
+Days are loaded in a background thread, at most --buffer days ahead,
+so the whole range is never in memory.
+'''
+
+def block_sum(array, factors):
+    ''' Sums array over blocks of factors[ii] consecutive elements along
+        each axis ii (missing factors are 1). Returns an int64 array.'''
+    factors = tuple(factors) + (1,)*(array.ndim - len(factors))
+    for (size, factor) in zip(array.shape, factors):
+        if size % factor != 0:
+            raise ValueError("Can't sum blocks of %s over an array of shape %s" % (factors, array.shape))
+    shape = []
+    for (size, factor) in zip(array.shape, factors):
+        shape += [size // factor, factor]
+    return array.reshape(shape).sum(axis=tuple(range(1, 2*array.ndim, 2)), dtype=np.int64)
+
+def _narrow(array, dtype):
+    ''' Casts an int64 array back to dtype, unless it would overflow.'''
+    info = np.iinfo(dtype)
+    if array.size and (array.max() > info.max or array.min() < info.min):
+        raise ValueError("Downsampled counts don't fit in " + str(np.dtype(dtype)))
+    return array.astype(dtype)
+
+def downsample_vdata(vdata, kx, ky, kt):
+    ''' Sums vdata (see utils.gen_empty_vdata) over blocks of kx by ky
+        cells and kt time slots.'''
+    return _narrow(block_sum(vdata, (kt, kx, ky)), vdata.dtype)
+
+def downsample_fdata(fdata, kx, ky, kt):
+    ''' Sums fdata (a dense array or a SparseFlow, see
+        utils.gen_empty_fdata) over blocks of kx by ky cells and kt time
+        slots, keeping axis 0.
+
+    Returns (fdata, ambiguous), where ambiguous is the number of flows
+    from an earlier slot that may have started in the same coarse slot
+    (they end in a fine slot that isn't the first of its block).
+    '''
+    factors = (1, kt, kx, ky, kx, ky)
+    if any(size % factor for (size, factor) in zip(fdata.shape, factors)):
+        raise ValueError("Can't sum blocks of %s over fdata of shape %s" % (factors, fdata.shape))
+
+    if isinstance(fdata, SparseFlow):
+        coords = list(np.unravel_index(fdata.index, fdata.shape))
+        count = fdata.count
+        ambiguous = int(count[(coords[0] == 1) & (coords[1] % kt != 0)].sum())
+        for (axis, factor) in enumerate(factors):
+            coords[axis] = coords[axis] // factor
+        shape = tuple(size // factor for (size, factor) in zip(fdata.shape, factors)) + fdata.shape[6:]
+        coarse = SparseFlow(shape, dtype=fdata.dtype)
+        coarse.add(tuple(coords), count)
+        _narrow(coarse.count, fdata.dtype)
+        return coarse, ambiguous
+
+    earlier = fdata[1].reshape((fdata.shape[1] // kt, kt) + fdata.shape[2:])
+    ambiguous = int(earlier[:, 1:].sum(dtype=np.int64))
+    return _narrow(block_sum(fdata, factors), fdata.dtype), ambiguous
+
+def downsample_day(data, width, height, n, directory="."):
+    ''' Downsamples the arrays of a loaded -data.npz file to a
+        width x height grid with n time slots per hour. directory is
+        the folder of the file (see utils.load_fdata).
+
+    Returns (arrays, ambiguous): the dict of arrays to save (fdata in
+    the same format as the input), and the number of ambiguous flows
+    (see downsample_fdata).
+    '''
+    vdata = data['vdata']
+    (T, w, h) = vdata.shape[:3]
+    if T % 24 != 0 or (T // 24) % n != 0 or w % width != 0 or h % height != 0:
+        raise ValueError("Can't downsample %dx%d, n=%d to %dx%d, n=%d" % (w, h, T // 24, width, height, n))
+    (kx, ky, kt) = (w // width, h // height, (T // 24) // n)
+    (fdata, ambiguous) = downsample_fdata(utils.load_fdata(data, dense=False, directory=directory), kx, ky, kt)
+    arrays = {'vdata': downsample_vdata(vdata, kx, ky, kt),
+              'trips': data['trips'],
+              'errors': data['errors']}
+    arrays.update(utils.fdata_arrays(fdata))
+    return arrays, ambiguous
+
+def iter_loaded(filenames, buffer=2):
+    ''' Yields (filename, dict of arrays) for each .npz file, loading
+        them in a background thread at most buffer files ahead.'''
+    loaded = queue.Queue(maxsize=max(1, buffer))
+    stop = threading.Event()
+
+    def load_all():
+        try:
+            for filename in filenames:
+                if stop.is_set():
+                    return
+                with np.load(filename) as data:
+                    loaded.put((filename, dict(data)))
+            loaded.put(None)
+        except Exception as error:
+            loaded.put(error)
+
+    thread = threading.Thread(target=load_all, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = loaded.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Unblock the loader if we stopped early
+        stop.set()
+        while thread.is_alive():
+            try:
+                loaded.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+def downsample(dates, data_dir="data", out_dir="data-5x10-2", width=5, height=10, n=2, buffer=2, V=False):
+    ''' Downsamples the -data.npz files in data_dir for the given
+        (year, month, day) dates into out_dir.
+
+    Returns the total number of ambiguous flows (see downsample_fdata).
+
+    # Arguments:
+        dates: List of (year, month, day) tuples, e.g. from
+            utils.generate_dates.
+        data_dir, out_dir: Strings, the input and output folders.
+        width, height, n: The grid size and time slots per hour to
+            downsample to. Must divide those of the input.
+        buffer: Integer, the number of days to load ahead.
+        V: Boolean; if True, print extra information to console.
+    '''
+    filenames = [script_pipeline.day_filename(data_dir, *date) for date in dates]
+    missing = [filename for filename in filenames if not os.path.exists(filename)]
+    if missing:
+        raise FileNotFoundError("Missing processed days: " + ", ".join(missing))
+    if os.path.abspath(data_dir) == os.path.abspath(out_dir):
+        raise ValueError("The output folder must differ from the input folder")
+
+    os.makedirs(out_dir, exist_ok=True)
+    total_ambiguous = 0
+    for (date, (filename, data)) in zip(dates, iter_loaded(filenames, buffer=buffer)):
+        (arrays, ambiguous) = downsample_day(data, width, height, n, directory=os.path.dirname(filename))
+        save_filename = os.path.join(out_dir, main.date_string(*date) + "-data.npz")
+        np.savez_compressed(save_filename, **arrays)
+        total_ambiguous += ambiguous
+        if V:
+            print("Saved", save_filename, "(%d ambiguous flows)" % ambiguous)
+    return total_ambiguous
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Downsample processed days to a coarser grid and time resolution")
+    parser.add_argument("--startyear", "-sy", help="Year to start from. Default 2016", type=int, nargs=1)
+    parser.add_argument("--startmonth", "-sm", help="Month to start from. Default 10.", type=int, nargs=1)
+    parser.add_argument("--startday", "-sd", help="Day to start from. Default 1.", type=int, nargs=1)
+    parser.add_argument("--endyear", "-ey", help="Year to finish on. Default 2016.", type=int, nargs=1)
+    parser.add_argument("--endmonth", "-em", help="Month to finish on. Default 10.", type=int, nargs=1)
+    parser.add_argument("--endday", "-ed", help="Day to finish on (exclusive, as in main.py). Default 2.", type=int, nargs=1)
+    parser.add_argument("--width", "-x", help="Width of the coarse grid; must divide the input's. (Default 5)", type=int, nargs=1)
+    parser.add_argument("--height", "-y", help="Height of the coarse grid; must divide the input's. (Default 10)", type=int, nargs=1)
+    parser.add_argument("--nslotsperhour", "-n", help="Time slots per hour; must divide the input's. (Default 2)", type=int, nargs=1)
+    parser.add_argument("--datadir", "-i", help="Folder with the YYYYMMDD-data.npz files. Default data", type=str, nargs=1)
+    parser.add_argument("--outdir", "-o", help="Folder to save the downsampled files to. Default data-WxH-n", type=str, nargs=1)
+    parser.add_argument("--buffer", "-b", help="Number of days to load ahead. (Default 2)", type=int, nargs=1)
+    parser.add_argument("--verbose", "-v", help="", action="store_true")
+
+    args = parser.parse_args()
+
+    startyear   = 2016   if args.startyear  is None else args.startyear[0]
+    startmonth  = 10     if args.startmonth is None else args.startmonth[0]
+    startday    = 1      if args.startday   is None else args.startday[0]
+    endyear     = 2016   if args.endyear    is None else args.endyear[0]
+    endmonth    = 10     if args.endmonth   is None else args.endmonth[0]
+    endday      = 2      if args.endday     is None else args.endday[0]
+    width       = 5      if args.width      is None else args.width[0]
+    height      = 10     if args.height     is None else args.height[0]
+    n           = 2      if args.nslotsperhour is None else args.nslotsperhour[0]
+    data_dir    = "data" if args.datadir    is None else args.datadir[0]
+    out_dir     = "data-%dx%d-%d" % (width, height, n) if args.outdir is None else args.outdir[0]
+    buffer      = 2      if args.buffer     is None else args.buffer[0]
+
+    dates = utils.generate_dates(startyear, startmonth, startday, endyear, endmonth, endday)
+    ambiguous = downsample(dates, data_dir=data_dir, out_dir=out_dir, width=width, height=height, n=n,
+                           buffer=buffer, V=args.verbose)
+    if ambiguous:
+        print(ambiguous, "flows from an earlier time slot may have started in the same coarse slot;",
+              "they are kept in fdata[1]. Use script_grid.py for an exact split.")
@@ -0,0 +1,99 @@
+import os
+import argparse
+import numpy as np
+import utils
+import main
+import gridindex
+import triptable
+
+'''
+Builds YYYYMMDD-data.npz files for any grid size and n from the trip
+tables saved by main.py --savetrips (YYYYMMDD-trips.npz), without
+reparsing the GPS text.
+
+The output is the same as main.py with the same settings would give,
+including the trips carried over midnight into the next day. E.g. to
+sample at 5x10 with n=2 from tables saved while sampling at 10x20:
+    python3.6 main.py -sy 2016 -sm 10 -sd 1 -ey 2016 -em 11 -ed 1 --savetrips
+    python3.6 script_grid.py -sy 2016 -sm 10 -sd 1 -ey 2016 -em 11 -ed 1 -x 5 -y 10 -n 2 -o grid-5x10
+'''
+
+def grid(dates, trips_dir=".", out_dir=".", width=10, height=20, n=4, sparse=False, grid_index=True, V=False):
+    ''' Builds the -data.npz files in out_dir for the given
+        (year, month, day) dates, from the -trips.npz files in trips_dir.
+
+    Returns the list of files saved.
+
+    # Arguments:
+        dates: List of (year, month, day) tuples, e.g. from
+            utils.generate_dates.
+        trips_dir, out_dir: Strings, the input and output folders.
+        width, height, n: The grid size and time slots per hour.
+        sparse: Boolean; if True, save fdata sparsely (see main.process).
+        grid_index: Boolean; if True, look up cells in a
+            gridindex.GridIndex cached in out_dir.
+        V: Boolean; if True, print extra information to console.
+    '''
+    filenames = [triptable.trips_filename(*date, directory=trips_dir) for date in dates]
+    missing = [filename for filename in filenames if not os.path.exists(filename)]
+    if missing:
+        raise FileNotFoundError("Missing trip tables (run main.py with --savetrips): " + ", ".join(missing))
+
+    os.makedirs(out_dir, exist_ok=True)
+    index = gridindex.GridIndex.cached(width, height, directory=out_dir) if grid_index else None
+    vdata_next_mo = utils.gen_empty_vdata(w=width, h=height, n=n)
+    fdata_next_mo = utils.gen_empty_fdata(w=width, h=height, n=n, sparse=sparse)
+    saved = []
+    for (date, filename) in zip(dates, filenames):
+        if V:
+            print("Loading from", filename)
+        (columns, unparsable, tz_offset) = triptable.load_trips(filename)
+        (vdata, fdata, vdata_next, fdata_next, trips, errors) = triptable.grid_trips(
+            columns, w=width, h=height, n=n, tz_offset=tz_offset, sparse=sparse, grid=index)
+        errors[1] = unparsable
+
+        # As in main.process: add the trips that crossed midnight from the day before
+        vdata += vdata_next_mo
+        fdata += fdata_next_mo
+        vdata_next_mo = vdata_next
+        fdata_next_mo = fdata_next
+
+        save_filename = os.path.join(out_dir, main.date_string(*date) + "-data.npz")
+        np.savez_compressed(save_filename, vdata=vdata, trips=trips, errors=errors, **utils.fdata_arrays(fdata))
+        saved.append(save_filename)
+    return saved
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build processed days for a grid size from saved trip tables")
+    parser.add_argument("--startyear", "-sy", help="Year to start from. Default 2016", type=int, nargs=1)
+    parser.add_argument("--startmonth", "-sm", help="Month to start from. Default 10.", type=int, nargs=1)
+    parser.add_argument("--startday", "-sd", help="Day to start from. Default 1.", type=int, nargs=1)
+    parser.add_argument("--endyear", "-ey", help="Year to finish on. Default 2016.", type=int, nargs=1)
+    parser.add_argument("--endmonth", "-em", help="Month to finish on. Default 10.", type=int, nargs=1)
+    parser.add_argument("--endday", "-ed", help="Day to finish on (exclusive, as in main.py). Default 2.", type=int, nargs=1)
+    parser.add_argument("--width", "-x", help="Width of grid (default 10)", type=int, nargs=1)
+    parser.add_argument("--height", "-y", help="Height of grid (default 20)", type=int, nargs=1)
+    parser.add_argument("--nslotsperhour", "-n", help="Discretize time into n slots per hour. Must be integer divisor of 60. (Default 4)", type=int, nargs=1)
+    parser.add_argument("--tripsdir", "-i", help="Folder with the YYYYMMDD-trips.npz files. Default .", type=str, nargs=1)
+    parser.add_argument("--outdir", "-o", help="Folder to save the YYYYMMDD-data.npz files to. Default .", type=str, nargs=1)
+    parser.add_argument("--sparse", "-s", help="Store and save the flow data (fdata) sparsely.", action="store_true")
+    parser.add_argument("--nogridindex", "-G", help="Compute cells exactly instead of with the cached grid index.", action="store_true")
+    parser.add_argument("--verbose", "-v", help="", action="store_true")
+
+    args = parser.parse_args()
+
+    startyear   = 2016 if args.startyear  is None else args.startyear[0]
+    startmonth  = 10   if args.startmonth is None else args.startmonth[0]
+    startday    = 1    if args.startday   is None else args.startday[0]
+    endyear     = 2016 if args.endyear    is None else args.endyear[0]
+    endmonth    = 10   if args.endmonth   is None else args.endmonth[0]
+    endday      = 2    if args.endday     is None else args.endday[0]
+    width       = 10   if args.width      is None else args.width[0]
+    height      = 20   if args.height     is None else args.height[0]
+    n           = 4    if args.nslotsperhour is None else args.nslotsperhour[0]
+    trips_dir   = "."  if args.tripsdir   is None else args.tripsdir[0]
+    out_dir     = "."  if args.outdir     is None else args.outdir[0]
+
+    dates = utils.generate_dates(startyear, startmonth, startday, endyear, endmonth, endday)
+    grid(dates, trips_dir=trips_dir, out_dir=out_dir, width=width, height=height, n=n,
+         sparse=args.sparse, grid_index=not args.nogridindex, V=args.verbose)
@@ -0,0 +1,252 @@
+import os
+import json
+import argparse
+import numpy as np
+import utils
+import chunkstore
+
+'''
+Converts and compiles the output of main.py in one pass:
+    data/YYYYMMDD-data.npz  ->  data/STDN-volume.npy, data/STDN-flow.npy
+
+This does what script_data_to_stdn and script_compile_STDN do, without
+the intermediate files. The set of input files comes from the date
+range (see utils.generate_dates). Each day is streamed into the
+memory-mapped outputs, so the whole range never has to fit in memory.
+
+A manifest (data/STDN-manifest.json) records the size and modification
+time of every input. When the outputs exist and cover the same days,
+a re-run only rewrites the slabs of the days whose input changed.
+
+With --chunked, the flow is also saved as data/STDN-flow.fchunks (see
+chunkstore.py): compressed in chunks of time slots, so reading an hour
+of it only inflates that hour. dataset.STDNDataset reads either file.
+
+With --append, the given days are added to the end of a store built
+with --chunked, in place: STDN-volume.npy and STDN-flow.fchunks grow by
+one day's slabs each, and the manifest gets the new days. Nothing
+already there is read or rewritten, so a daily run takes the same time
+however long the store is. STDN-flow.npy can't grow that way (time is
+its second axis), so the first append removes it.
+'''
+
+MANIFEST_FILENAME = "STDN-manifest.json"
+VOLUME_FILENAME = "STDN-volume.npy"
+FLOW_FILENAME = "STDN-flow.npy"
+FLOW_CHUNKS_FILENAME = "STDN-flow.fchunks"
+
+def day_filename(data_dir, year, month, day):
+    ''' The file main.py saves the given day to.'''
+    return os.path.join(data_dir, f"{year:04}"+f"{month:02}"+f"{day:02}" + "-data.npz")
+
+def file_stamp(filename):
+    ''' [size, mtime in ns], used to tell if a file has changed.'''
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def stdn_shapes(filename):
+    ''' Returns (vshape, fshape, dtype): the shapes of the arrays
+        utils.stdn_arrays would return for filename, reading only the
+        file headers.'''
+    (vshape, dtype) = utils.npz_array_info(filename, key='vdata')
+    with np.load(filename) as data:
+        if 'fdata' in data:
+            (fshape, _) = utils.npz_array_info(filename, key='fdata')
+        else:
+            fshape = tuple(data['fdata_shape'].tolist())
+    # Drop the passenger/trip count axis of the older format
+    return tuple(vshape[:4]), tuple(fshape[:6]), dtype
+
+def load_manifest(out_dir):
+    ''' Returns the manifest saved in out_dir, or None.'''
+    filename = os.path.join(out_dir, MANIFEST_FILENAME)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "r") as read_f:
+        return json.load(read_f)
+
+def save_manifest(out_dir, manifest):
+    ''' Saves the manifest to out_dir, replacing it atomically.'''
+    filename = os.path.join(out_dir, MANIFEST_FILENAME)
+    with open(filename + ".tmp", "w") as write_f:
+        json.dump(manifest, write_f, indent=1)
+    os.replace(filename + ".tmp", filename)
+
+def build(dates, data_dir="data", out_dir="data", force=False, chunked=False, V=False):
+    ''' Builds STDN-volume.npy and STDN-flow.npy in out_dir from the
+        -data.npz files in data_dir for the given (year, month, day) dates.
+
+    Returns the list of input files that were (re)written.
+
+    # Arguments:
+        dates: List of (year, month, day) tuples, e.g. from
+            utils.generate_dates.
+        data_dir, out_dir: Strings, the input and output folders.
+        force: Boolean; if True, rebuild everything.
+        chunked: Boolean; if True, also save the flow as
+            STDN-flow.fchunks, whenever it changes.
+        V: Boolean; if True, print extra information to console.
+    '''
+    filenames = [day_filename(data_dir, *date) for date in dates]
+    missing = [filename for filename in filenames if not os.path.exists(filename)]
+    if missing:
+        raise FileNotFoundError("Missing processed days: " + ", ".join(missing))
+
+    volume_filename = os.path.join(out_dir, VOLUME_FILENAME)
+    flow_filename = os.path.join(out_dir, FLOW_FILENAME)
+    manifest = load_manifest(out_dir)
+    stamps = [file_stamp(filename) for filename in filenames]
+
+    up_to_date = (not force and manifest is not None
+                  and [entry['filename'] for entry in manifest['files']] == filenames
+                  and os.path.exists(volume_filename) and os.path.exists(flow_filename))
+
+    if up_to_date:
+        # Same days as last time; only rewrite the days that changed.
+        files = manifest['files']
+        stale = [ii for (ii, entry) in enumerate(files) if entry['stamp'] != stamps[ii]]
+        vdata = np.load(volume_filename, mmap_mode="r+")
+        fdata = np.load(flow_filename, mmap_mode="r+")
+    else:
+        if manifest is not None:
+            # The outputs are about to be rewritten from scratch
+            os.remove(os.path.join(out_dir, MANIFEST_FILENAME))
+        shapes = [stdn_shapes(filename) for filename in filenames]
+        files = []
+        offset = 0
+        for (filename, (vshape, _, _)) in zip(filenames, shapes):
+            files.append({'filename': filename, 'offset': offset, 'length': vshape[0], 'stamp': None})
+            offset += vshape[0]
+        (vshape, fshape, dtype) = shapes[0]
+        vdata = np.lib.format.open_memmap(volume_filename, mode="w+", dtype=dtype,
+                                          shape=(offset,) + vshape[1:])
+        fdata = np.lib.format.open_memmap(flow_filename, mode="w+", dtype=dtype,
+                                          shape=fshape[:1] + (offset,) + fshape[2:])
+        stale = list(range(len(filenames)))
+
+    if V:
+        print(len(stale), "of", len(filenames), "days to convert")
+
+    for ii in stale:
+        entry = files[ii]
+        if V:
+            print("Loading from", entry['filename'])
+        with np.load(entry['filename']) as data:
+            (day_vdata, day_fdata) = utils.stdn_arrays(data, directory=os.path.dirname(entry['filename']))
+        if day_vdata.shape[0] != entry['length']:
+            raise ValueError(entry['filename'] + " changed shape; rerun with --force")
+        start, end = entry['offset'], entry['offset'] + entry['length']
+        vdata[start:end] = day_vdata
+        fdata[:, start:end] = day_fdata
+        entry['stamp'] = stamps[ii]
+
+    vdata.flush()
+    fdata.flush()
+    chunks_filename = os.path.join(out_dir, FLOW_CHUNKS_FILENAME)
+    if chunked and (stale or not os.path.exists(chunks_filename)):
+        if V:
+            print("Saving", chunks_filename)
+        # Reads fdata a chunk at a time, from the memory map
+        chunkstore.save_chunked(chunks_filename, fdata, time_chunk=files[0]['length'] // 24 or 1)
+    # Saved last, so an interrupted run is redone on the next run.
+    save_manifest(out_dir, {'volume': VOLUME_FILENAME, 'flow': FLOW_FILENAME,
+                            'flow_chunks': FLOW_CHUNKS_FILENAME if chunked else None, 'files': files})
+
+    return [files[ii]['filename'] for ii in stale]
+
+def append(dates, data_dir="data", out_dir="data", V=False):
+    ''' Appends the -data.npz files in data_dir for the given dates to the
+        end of the store in out_dir, which build(..., chunked=True) made.
+
+    Days the manifest already covers are skipped, so re-running with the
+    same dates does nothing. The other days must come after the last
+    one covered. Returns the list of input files appended.
+
+    # Arguments:
+        dates: List of (year, month, day) tuples, e.g. from
+            utils.generate_dates.
+        data_dir, out_dir: Strings, the input and output folders.
+        V: Boolean; if True, print extra information to console.
+    '''
+    manifest = load_manifest(out_dir)
+    if manifest is None or not manifest.get('flow_chunks'):
+        raise ValueError("No chunked store in " + out_dir + "; build one first with --chunked")
+    files = manifest['files']
+    covered = {os.path.basename(entry['filename']) for entry in files}
+    filenames = [filename for filename in (day_filename(data_dir, *date) for date in dates)
+                 if os.path.basename(filename) not in covered]
+    missing = [filename for filename in filenames if not os.path.exists(filename)]
+    if missing:
+        raise FileNotFoundError("Missing processed days: " + ", ".join(missing))
+    last = max(os.path.basename(entry['filename']) for entry in files)
+    earlier = [filename for filename in filenames if os.path.basename(filename) < last]
+    if earlier:
+        raise ValueError("Can only append days after " + last + ", not " + ", ".join(earlier))
+
+    volume_filename = os.path.join(out_dir, manifest['volume'])
+    chunks_filename = os.path.join(out_dir, manifest['flow_chunks'])
+    offset = files[-1]['offset'] + files[-1]['length']
+    if (utils.npz_array_info(volume_filename)[0][0] != offset
+            or chunkstore.ChunkedArray(chunks_filename).shape[1] != offset):
+        raise ValueError("The store in " + out_dir + " doesn't match its manifest; rebuild it with --force")
+    if filenames and manifest['flow'] is not None:
+        flow_filename = os.path.join(out_dir, manifest['flow'])
+        if os.path.exists(flow_filename):
+            if V:
+                print("Removing", flow_filename, "(use", chunks_filename + ")")
+            os.remove(flow_filename)
+        manifest['flow'] = None
+        save_manifest(out_dir, manifest)
+
+    for filename in filenames:
+        if V:
+            print("Appending", filename)
+        with np.load(filename) as data:
+            (day_vdata, day_fdata) = utils.stdn_arrays(data, directory=os.path.dirname(filename))
+        utils.append_npy(volume_filename, day_vdata)
+        try:
+            chunkstore.append_chunked(chunks_filename, day_fdata)
+        except BaseException:
+            # append_chunked restored the flow; match it
+            utils.truncate_npy(volume_filename, offset)
+            raise
+        files.append({'filename': filename, 'offset': offset, 'length': day_vdata.shape[0], 'stamp': file_stamp(filename)})
+        offset += day_vdata.shape[0]
+        # After each day, so an interrupted run keeps the days it did
+        save_manifest(out_dir, manifest)
+
+    return filenames
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert and compile processed days into STDN arrays")
+    parser.add_argument("--startyear", "-sy", help="Year to start from. Default 2016", type=int, nargs=1)
+    parser.add_argument("--startmonth", "-sm", help="Month to start from. Default 10.", type=int, nargs=1)
+    parser.add_argument("--startday", "-sd", help="Day to start from. Default 1.", type=int, nargs=1)
+    parser.add_argument("--endyear", "-ey", help="Year to finish on. Default 2016.", type=int, nargs=1)
+    parser.add_argument("--endmonth", "-em", help="Month to finish on. Default 10.", type=int, nargs=1)
+    parser.add_argument("--endday", "-ed", help="Day to finish on (exclusive, as in main.py). Default 2.", type=int, nargs=1)
+    parser.add_argument("--datadir", "-i", help="Folder with the YYYYMMDD-data.npz files. Default data", type=str, nargs=1)
+    parser.add_argument("--outdir", "-o", help="Folder to save the STDN arrays to. Default data", type=str, nargs=1)
+    parser.add_argument("--force", "-f", help="Rebuild everything, even if up to date.", action="store_true")
+    parser.add_argument("--chunked", "-C", help="Also save the flow in chunks of an hour, as STDN-flow.fchunks (see chunkstore.py).",
+                        action="store_true")
+    parser.add_argument("--append", "-a", help="Add the days to the end of a store built with --chunked, in place, rather than rebuilding it.",
+                        action="store_true")
+    parser.add_argument("--verbose", "-v", help="", action="store_true")
+
+    args = parser.parse_args()
+
+    startyear   = 2016   if args.startyear  is None else args.startyear[0]
+    startmonth  = 10     if args.startmonth is None else args.startmonth[0]
+    startday    = 1      if args.startday   is None else args.startday[0]
+    endyear     = 2016   if args.endyear    is None else args.endyear[0]
+    endmonth    = 10     if args.endmonth   is None else args.endmonth[0]
+    endday      = 2      if args.endday     is None else args.endday[0]
+    data_dir    = "data" if args.datadir    is None else args.datadir[0]
+    out_dir     = "data" if args.outdir     is None else args.outdir[0]
+
+    dates = utils.generate_dates(startyear, startmonth, startday, endyear, endmonth, endday)
+    if args.append:
+        append(dates, data_dir=data_dir, out_dir=out_dir, V=args.verbose)
+    else:
+        build(dates, data_dir=data_dir, out_dir=out_dir, force=args.force, chunked=args.chunked, V=args.verbose)
@@ -0,0 +1,264 @@
+import os
+import argparse
+import multiprocessing
+import numpy as np
+import utils
+import main
+import writers
+import script_pipeline
+
+'''
+Reduces the daily output of main.py into month or range aggregates:
+    data/YYYYMMDD-data.npz  ->  out/YYYYMM-sum.npz             (--by month)
+                                out/YYYYMMDD-YYYYMMDD-sum.npz  (--by range)
+
+--mode sum adds up vdata, fdata, trips and errors over the days (as
+int64, so the totals don't overflow, or float64 for trips). The time axes stay 24n slots
+long: the result is the total for each time of day.
+
+--mode concat joins the days along the time axes instead, into
+uncompressed .npy files (load them with np.load(..., mmap_mode="r")):
+    LABEL-vdata.npy (days*24n, w, h, 2), LABEL-fdata.npy (2, days*24n, w, h, w, h),
+    LABEL-trips.npy (days, 2, 2), LABEL-errors.npy (days, 2)
+
+Both run in a pool of worker processes. For sums, each worker adds up
+a run of consecutive days, about one run per worker, and each partial
+sum is added to its aggregate's total as it arrives. For
+concatenation, each worker writes its days straight into the
+memory-mapped outputs. A worker holds one day (and one partial sum) at
+a time. Inputs saved uncompressed (main.py --codec
+npz) are memory-mapped rather than loaded (see utils.npz_memmap).
+'''
+
+KEYS = ('vdata', 'fdata', 'trips', 'errors')
+
+def load_day(filename):
+    ''' Returns the arrays of a -data.npz file, memory-mapped where
+        possible, with fdata dense whichever way it was saved.'''
+    with np.load(filename) as data:
+        keys = set(data.keys())
+        arrays = {key: data[key] for key in ('trips', 'errors')}
+        if 'fdata' not in keys:
+            arrays['fdata'] = utils.load_fdata(data, directory=os.path.dirname(filename))
+    arrays['vdata'] = utils.npz_memmap(filename, 'vdata')
+    if 'fdata' in keys:
+        arrays['fdata'] = utils.npz_memmap(filename, 'fdata')
+    return arrays
+
+def sum_days(filenames):
+    ''' Returns the sum of the arrays of the given -data.npz files.
+        Integer arrays are summed as int64.'''
+    total = None
+    for filename in filenames:
+        arrays = load_day(filename)
+        if total is None:
+            total = {key: np.zeros(np.shape(arrays[key]), dtype=np.result_type(arrays[key].dtype, np.int64))
+                     for key in KEYS}
+        for key in KEYS:
+            total[key] += arrays[key]
+    return total
+
+def sum_run(task):
+    ''' Sums a run of files with sum_days. task is (index, filenames);
+        returns (index, sum).'''
+    (index, filenames) = task
+    return index, sum_days(filenames)
+
+def split_runs(items, count):
+    ''' Splits a list into at most count runs of consecutive items.'''
+    count = max(1, min(count, len(items)))
+    bounds = np.linspace(0, len(items), count + 1).astype(int)
+    return [items[start:end] for (start, end) in zip(bounds[:-1], bounds[1:])]
+
+def plan_runs(groups, workers):
+    ''' Splits the files of each group (a list of lists of filenames)
+        into runs of consecutive days, about workers runs in all, but
+        at least one per group. Returns a list of (group index, run).'''
+    days = sum(len(filenames) for filenames in groups)
+    runs = []
+    for (index, filenames) in enumerate(groups):
+        count = workers * len(filenames) // max(1, days)
+        runs += [(index, run) for run in split_runs(filenames, count)]
+    return runs
+
+def parallel_sum(pool, groups, workers=1):
+    ''' Sums the files of each group (a list of lists of filenames).
+
+    The runs of plan_runs are summed in parallel, and each partial sum
+    is added to its group's total as it arrives, so that no more than
+    one is held per run. Yields (index, total) for each group once it
+    is complete, in any order.
+    '''
+    runs = plan_runs(groups, workers)
+    left = [0] * len(groups)
+    for (index, _) in runs:
+        left[index] += 1
+    totals = {}
+    for (index, partial) in pool.imap_unordered(sum_run, runs):
+        if index in totals:
+            for key in KEYS:
+                totals[index][key] += partial[key]
+        else:
+            totals[index] = partial
+        del partial
+        left[index] -= 1
+        if not left[index]:
+            yield index, totals.pop(index)
+
+def day_shapes(filename):
+    ''' Returns the shapes and dtypes of vdata and fdata in a -data.npz
+        file, reading only the headers.'''
+    (vshape, vdtype) = utils.npz_array_info(filename, key='vdata')
+    with np.load(filename) as data:
+        if 'fdata' in data:
+            (fshape, fdtype) = utils.npz_array_info(filename, key='fdata')
+        else:
+            (fshape, fdtype) = (tuple(data['fdata_shape'].tolist()), vdtype)
+    return (tuple(vshape), vdtype), (tuple(fshape), fdtype)
+
+def concat_filenames(out_dir, label):
+    ''' The files concatenate writes for label, by key.'''
+    return {key: os.path.join(out_dir, "%s-%s.npy" % (label, key)) for key in KEYS}
+
+def write_days(task):
+    ''' Writes a run of days into the concatenated outputs, which
+        concatenate has already created.'''
+    (filenames, first_day, outputs, slots) = task
+    out = {key: np.load(filename, mmap_mode="r+") for (key, filename) in outputs.items()}
+    for (ii, filename) in enumerate(filenames):
+        arrays = load_day(filename)
+        start = (first_day + ii) * slots
+        out['vdata'][start:start + slots] = arrays['vdata']
+        out['fdata'][:, start:start + slots] = arrays['fdata']
+        out['trips'][first_day + ii] = arrays['trips']
+        out['errors'][first_day + ii] = arrays['errors']
+    for array in out.values():
+        array.flush()
+    return len(filenames)
+
+def concatenate(pool_map, groups, labels, out_dir, workers=1):
+    ''' Concatenates the days of each group along the time axes, into
+        the files given by concat_filenames. Returns their names.'''
+    tasks = []
+    saved = []
+    for (filenames, label) in zip(groups, labels):
+        ((vshape, vdtype), (fshape, fdtype)) = day_shapes(filenames[0])
+        days = len(filenames)
+        outputs = concat_filenames(out_dir, label)
+        for (key, shape, dtype) in (('vdata', (days*vshape[0],) + vshape[1:], vdtype),
+                                    ('fdata', fshape[:1] + (days*fshape[1],) + fshape[2:], fdtype),
+                                    ('trips', (days, 2, 2), np.float64),
+                                    ('errors', (days, 2), np.int64)):
+            np.lib.format.open_memmap(outputs[key], mode="w+", dtype=dtype, shape=shape).flush()
+        first_day = 0
+        for run in split_runs(filenames, workers):
+            tasks.append((run, first_day, outputs, vshape[0]))
+            first_day += len(run)
+        saved += list(outputs.values())
+    pool_map(write_days, tasks)
+    return saved
+
+def group_dates(dates, by="month"):
+    ''' Groups (year, month, day) dates by month, or all together if by
+        is "range". Returns a list of (label, dates).'''
+    if by == "range":
+        return [(main.date_string(*dates[0]) + "-" + main.date_string(*dates[-1]), dates)]
+    groups = {}
+    for date in dates:
+        groups.setdefault("%04d%02d" % date[:2], []).append(date)
+    return sorted(groups.items())
+
+class _NoPool:
+    ''' Stands in for a multiprocessing.Pool when workers is 1.'''
+    def map(self, function, items):
+        return list(map(function, items))
+
+    def imap_unordered(self, function, items):
+        return map(function, items)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+def reduce_days(dates, data_dir="data", out_dir="data", by="month", mode="sum", workers=1, codec=writers.DEFAULT_CODEC, V=False):
+    ''' Reduces the -data.npz files in data_dir for the given dates into
+        month or range aggregates in out_dir.
+
+    Returns the list of files saved.
+
+    # Arguments:
+        dates: List of (year, month, day) tuples, e.g. from
+            utils.generate_dates.
+        data_dir, out_dir: Strings, the input and output folders.
+        by: String; "month" for one aggregate per month, or "range" for
+            one over all the dates.
+        mode: String; "sum" or "concat". (See the top of this file.)
+        workers: Integer, the number of processes to use.
+        codec: String, how to compress the sums (see writers.CODECS).
+        V: Boolean; if True, print extra information to console.
+    '''
+    if not dates:
+        return []
+    filenames = {date: script_pipeline.day_filename(data_dir, *date) for date in dates}
+    missing = [filename for filename in filenames.values() if not os.path.exists(filename)]
+    if missing:
+        raise FileNotFoundError("Missing processed days: " + ", ".join(missing))
+    os.makedirs(out_dir, exist_ok=True)
+
+    grouped = group_dates(dates, by=by)
+    labels = [label for (label, _) in grouped]
+    groups = [[filenames[date] for date in group] for (_, group) in grouped]
+    if V:
+        print("Reducing", len(dates), "days into", len(groups), "aggregates")
+
+    with (multiprocessing.Pool(workers) if workers > 1 else _NoPool()) as pool:
+        if mode == "concat":
+            return concatenate(pool.map, groups, labels, out_dir, workers=workers)
+        if mode != "sum":
+            raise ValueError("Unknown mode " + repr(mode))
+        saved = {}
+        for (index, total) in parallel_sum(pool, groups, workers=workers):
+            saved[index] = os.path.join(out_dir, labels[index] + "-sum.npz")
+            writers.save_arrays(saved[index], dict(total, days=np.array(len(groups[index]))), codec=codec)
+            if V:
+                print("Saved", saved[index])
+        return [saved[index] for index in sorted(saved)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sum or concatenate processed days into month or range aggregates")
+    parser.add_argument("--startyear", "-sy", help="Year to start from. Default 2016", type=int, nargs=1)
+    parser.add_argument("--startmonth", "-sm", help="Month to start from. Default 10.", type=int, nargs=1)
+    parser.add_argument("--startday", "-sd", help="Day to start from. Default 1.", type=int, nargs=1)
+    parser.add_argument("--endyear", "-ey", help="Year to finish on. Default 2016.", type=int, nargs=1)
+    parser.add_argument("--endmonth", "-em", help="Month to finish on. Default 11.", type=int, nargs=1)
+    parser.add_argument("--endday", "-ed", help="Day to finish on (exclusive, as in main.py). Default 1.", type=int, nargs=1)
+    parser.add_argument("--by", "-b", help="One aggregate per 'month' (default), or one for the whole 'range'.",
+                        choices=["month", "range"], nargs=1)
+    parser.add_argument("--mode", "-M", help="'sum' the days (default) or 'concat' them along the time axes.",
+                        choices=["sum", "concat"], nargs=1)
+    parser.add_argument("--workers", "-w", help="Number of processes to use. (Default: all cores)", type=int, nargs=1)
+    parser.add_argument("--codec", "-z", help="How to compress the sums. (Default npz-zlib, see writers.py)",
+                        choices=sorted(writers.CODECS), nargs=1)
+    parser.add_argument("--datadir", "-i", help="Folder with the YYYYMMDD-data.npz files. Default data", type=str, nargs=1)
+    parser.add_argument("--outdir", "-o", help="Folder to save the aggregates to. Default data", type=str, nargs=1)
+    parser.add_argument("--verbose", "-v", help="", action="store_true")
+
+    args = parser.parse_args()
+
+    startyear   = 2016    if args.startyear  is None else args.startyear[0]
+    startmonth  = 10      if args.startmonth is None else args.startmonth[0]
+    startday    = 1       if args.startday   is None else args.startday[0]
+    endyear     = 2016    if args.endyear    is None else args.endyear[0]
+    endmonth    = 11      if args.endmonth   is None else args.endmonth[0]
+    endday      = 1       if args.endday     is None else args.endday[0]
+    by          = "month" if args.by         is None else args.by[0]
+    mode        = "sum"   if args.mode       is None else args.mode[0]
+    workers     = multiprocessing.cpu_count() if args.workers is None else args.workers[0]
+    codec       = writers.DEFAULT_CODEC if args.codec is None else args.codec[0]
+    data_dir    = "data"  if args.datadir    is None else args.datadir[0]
+    out_dir     = "data"  if args.outdir     is None else args.outdir[0]
+
+    dates = utils.generate_dates(startyear, startmonth, startday, endyear, endmonth, endday)
+    reduce_days(dates, data_dir=data_dir, out_dir=out_dir, by=by, mode=mode, workers=workers, codec=codec, V=args.verbose)
@@ -0,0 +1,251 @@
+''' Parsing one day's GPS file in parallel worker processes.
+
+The parse engines of main.py read a day's file in one sequential pass,
+because a trip is found where the driver and order fields change from
+one line to the next (see utils.find_boundaries). When the file is
+sorted, so that the lines of each order are together, it can instead be
+split at byte offsets where those fields change (order_offsets): each
+shard then finds the same entries as the sequential pass would, and
+their entries, in order, give the same trips.
+
+When the file is not sorted, the lines of an order can be scattered
+through it, and the sequential pass makes a separate entry of each run
+of them. parse_file detects this (an order with two entries), and falls
+back to partitioning the lines by a hash of the driver: each partition
+is parsed on its own, with the lines of each order brought together, in
+the order the orders first appear. Every order then gives one entry.
+Bringing the lines together means each worker holds its whole partition
+in memory, so unlike the sorted path (which streams through
+utils.read_chunks) the fallback holds the whole day in memory, spread
+across the workers.
+'''
+
+import os
+import codecs
+import zlib
+import shutil
+import tempfile
+import functools
+import contextlib
+import multiprocessing
+import numpy as np
+import utils
+import metrics
+
+def is_plain(filename):
+    ''' Whether filename is uncompressed, so that it can be split at byte
+        offsets. (Compressed files, see utils.open_text, can't.)'''
+    with open(filename, "rb") as read_f:
+        start = read_f.read(8)
+    return not any(start.startswith(magic) for (magic, _, _) in utils.COMPRESSED_FORMATS)
+
+def _key_bytes(line):
+    # The driver and order fields of a line, as bytes (see utils.key_prefix)
+    second_comma = line.find(b",", line.find(b",") + 1)
+    return line[:second_comma + 1] if second_comma > 0 else None
+
+def order_offsets(filename, shards):
+    ''' Splits a GPS file (after its header line) into at most shards
+        byte ranges of about the same size, each starting on a line
+        whose driver and order fields differ from those of the last line
+        before it that has them.
+
+    Returns the list of (start, end) byte offsets.
+    '''
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as read_f:
+        read_f.readline() # Skip header
+        offsets = [read_f.tell()]
+        for ii in range(1, shards):
+            target = offsets[0] + (size - offsets[0]) * ii // shards
+            if target <= offsets[-1]:
+                continue
+            read_f.seek(target - 1)
+            read_f.readline() # To the start of the next line
+            previous = None
+            while True:
+                offset = read_f.tell()
+                line = read_f.readline()
+                if not line:
+                    break
+                key = _key_bytes(line)
+                # Lines without a key are unparsable, and don't end an
+                # order (see utils.find_boundaries)
+                if key is None:
+                    continue
+                if previous is not None and key != previous:
+                    break
+                previous = key
+            if offsets[-1] < offset < size:
+                offsets.append(offset)
+    return list(zip(offsets, offsets[1:] + [size]))
+
+class _RangeReader:
+    ''' Reads the text between two byte offsets of a file, with read(size)
+        as used by utils.read_chunks.'''
+    def __init__(self, filename, start, end, encoding='UTF-8'):
+        self._read_f = open(filename, "rb")
+        self._read_f.seek(start)
+        self._left = end - start
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+
+    def read(self, size=-1):
+        text = ''
+        while not text:
+            data = self._read_f.read(self._left if size < 0 else min(size, self._left))
+            self._left -= len(data)
+            text = self._decoder.decode(data, final=not data)
+            if not data:
+                break
+        return text
+
+    def close(self):
+        self._read_f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _empty_entries(n, tz_offset):
+    return utils.make_entries(utils.parse_lines([]), np.zeros(0, dtype=np.int64), n=n, tz_offset=tz_offset)
+
+def _parse_chunks(chunks, is_last, n, tz_offset, times=metrics.NO_TIMES):
+    ''' Finds the entries in (lines, is_last_chunk) chunks, as the numpy
+        engine does. Returns (entries, unparsable_lines, line_count),
+        with the unparsable lines numbered from 0. The time spent getting
+        the chunks goes to the "read" stage of times.'''
+    start_key = None
+    line_number = 0
+    unparsable_lines = []
+    parts = [_empty_entries(n, tz_offset)]
+    for (lines, last_chunk) in times.iterate("read", chunks):
+        with times.stage("parse"):
+            batch = utils.parse_lines(lines)
+            (boundary, unparsable, start_key) = utils.find_boundaries(batch, start_key=start_key, is_last=is_last and last_chunk)
+            unparsable_lines += (line_number + np.flatnonzero(unparsable)).tolist()
+            line_number += len(lines)
+            parts.append(utils.make_entries(batch, np.flatnonzero(boundary), n=n, tz_offset=tz_offset))
+    return functools.reduce(utils.concat_entries, parts), unparsable_lines, line_number
+
+def parse_range(task):
+    ''' Finds the entries in a byte range of a GPS file (see order_offsets).
+        task is (filename, start, end, is_last, n, tz_offset, chunk_size,
+        timed), where is_last is True for the range that ends the file.
+        Returns the result of _parse_chunks, and its metrics.StageTimes.'''
+    (filename, start, end, is_last, n, tz_offset, chunk_size, timed) = task
+    times = metrics.StageTimes(enabled=timed)
+    with _RangeReader(filename, start, end) as read_f:
+        return _parse_chunks(utils.read_chunks(read_f, chunk_size=chunk_size), is_last, n, tz_offset, times=times) + (times,)
+
+def _part_filename(directory, part, index):
+    return os.path.join(directory, "%d-%d.text" % (part, index))
+
+def partition_range(task):
+    ''' Writes the lines of a byte range of a GPS file to one file per
+        partition, by a hash of their driver field. task is (filename,
+        start, end, parts, directory, index, chunk_size, timed). Returns
+        the number of lines written to each partition, and the
+        metrics.StageTimes of reading the range and partitioning it.'''
+    (filename, start, end, parts, directory, index, chunk_size, timed) = task
+    times = metrics.StageTimes(enabled=timed)
+    counts = [0] * parts
+    write_fs = [open(_part_filename(directory, part, index), "w", encoding="UTF-8") for part in range(parts)]
+    try:
+        with _RangeReader(filename, start, end) as read_f:
+            for (lines, _) in times.iterate("read", utils.read_chunks(read_f, chunk_size=chunk_size)):
+                with times.stage("partition"):
+                    buckets = [[] for _ in range(parts)]
+                    for line in lines:
+                        # crc32 rather than hash, which differs between processes
+                        buckets[zlib.crc32(line.split(",", 1)[0].strip().encode("UTF-8")) % parts].append(line + "\n")
+                    for (part, bucket) in enumerate(buckets):
+                        write_fs[part].writelines(bucket)
+                        counts[part] += len(bucket)
+    finally:
+        for write_f in write_fs:
+            write_f.close()
+    return counts, times
+
+def parse_part(task):
+    ''' Finds the entries in a partition written by partition_range, with
+        the lines of each order brought together. task is (directory,
+        part, ranges, is_last, n, tz_offset, chunk_size, timed). Returns
+        as parse_range does. The whole partition is held in memory (about
+        1/shards of the day) to group it by order.'''
+    (directory, part, ranges, is_last, n, tz_offset, chunk_size, timed) = task
+    times = metrics.StageTimes(enabled=timed)
+    orders = {}
+    for index in range(ranges):
+        with open(_part_filename(directory, part, index), "r", encoding="UTF-8") as read_f:
+            for (lines, _) in times.iterate("read", utils.read_chunks(read_f, chunk_size=chunk_size)):
+                with times.stage("partition"):
+                    for line in lines:
+                        # Dicts keep the order the orders first appear in
+                        orders.setdefault(utils.key_prefix(line) or (None, len(orders)), []).append(line)
+    lines = [line for order_lines in orders.values() for line in order_lines]
+    del orders
+    lines_per_chunk = max(1, chunk_size // 100)
+    chunks = [(lines[start:start + lines_per_chunk], start + lines_per_chunk >= len(lines))
+              for start in range(0, len(lines), lines_per_chunk)]
+    return _parse_chunks(chunks, is_last, n, tz_offset, times=times) + (times,)
+
+def is_sorted(results):
+    ''' Whether no order has more than one entry in the results of
+        parse_range, but for the last line of the file, which is always
+        an entry.'''
+    ids = [key for (entries, _, _) in results for key in entries['id']][:-1]
+    return len(set(ids)) == len(ids)
+
+def parse_file(filename, shards=None, n=4, tz_offset=utils.TZ_OFFSET, chunk_size=1 << 22, presorted=None, pool=None, times=metrics.NO_TIMES, V=False):
+    ''' Finds the entries (see utils.make_entries) of a GPS file in
+        parallel worker processes.
+
+    Returns a list of (entries, unparsable_lines, line_count), one per
+    shard in file order: the entries of the whole file are their
+    concatenation. unparsable_lines are numbered from 0 within each
+    shard, or are None when they can't be (partitioned input).
+
+    # Arguments:
+        filename: String, an uncompressed GPS file (see is_plain).
+        shards: Integer, the number of processes. Default all cores.
+        presorted: Boolean, whether the lines of each order are together
+            in the file. None to find out (at the cost of a second pass
+            if they aren't). Unsorted files are parsed by partition, each
+            held whole in memory: the whole day, spread across the
+            processes, rather than a chunk per process.
+        pool: Optional multiprocessing.Pool to run in, e.g. to reuse
+            one for several files. Default a new one of shards processes.
+        times: metrics.StageTimes to add the time the processes spend
+            reading, partitioning and parsing to. (So these are summed
+            over the processes.)
+    '''
+    def merged(results):
+        # Adds the metrics.StageTimes that end each result to times
+        for result in results:
+            times.merge(result[-1])
+        return [result[:-1] for result in results]
+
+    shards = multiprocessing.cpu_count() if shards is None else shards
+    ranges = order_offsets(filename, shards)
+    with (multiprocessing.Pool(shards) if pool is None else contextlib.nullcontext(pool)) as pool:
+        if presorted is not False:
+            results = merged(pool.map(parse_range, [(filename, start, end, ii == len(ranges) - 1, n, tz_offset, chunk_size, times.enabled)
+                                                    for (ii, (start, end)) in enumerate(ranges)]))
+            if presorted or is_sorted(results):
+                return results
+            if V:
+                print("  Orders are not sorted; partitioning by driver")
+
+        directory = tempfile.mkdtemp(prefix="partitions-", dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            counts = merged(pool.map(partition_range, [(filename, start, end, shards, directory, ii, chunk_size, times.enabled)
+                                                       for (ii, (start, end)) in enumerate(ranges)]))
+            sizes = [sum(part_counts) for part_counts in zip(*[part_counts for (part_counts,) in counts])]
+            last = max([part for (part, size) in enumerate(sizes) if size > 0], default=-1)
+            results = merged(pool.map(parse_part, [(directory, part, len(ranges), part == last, n, tz_offset, chunk_size, times.enabled)
+                                                   for part in range(shards)]))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    return [(entries, [None] * len(unparsable_lines), line_count) for (entries, unparsable_lines, line_count) in results]
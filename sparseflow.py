@@ -0,0 +1,106 @@
+''' A sparse store for 'fdata' (flow data).
+
+Almost all origin-destination cells of fdata are zero, so instead of the
+dense (2, 24*n, w, h, w, h) array this keeps a COO list: the raveled
+index of each non-zero cell and its count.
+'''
+
+import numpy as np
+
+class SparseFlow:
+    ''' Sparse (COO) version of the array from utils.gen_empty_fdata.
+
+    Memory scales with the number of distinct trips (origin, destination,
+    time slot), not with (w*h)^2.
+
+    # Arguments:
+        shape: Tuple, the shape of the equivalent dense array.
+        index, count: Optional int64 arrays; the raveled indices of the
+            non-zero cells and their counts.
+        dtype: The dtype of the equivalent dense array.
+    '''
+    # Coalesce once this many separate additions are pending
+    max_pending = 1 << 16
+
+    def __init__(self, shape, index=None, count=None, dtype=np.int16):
+        self.shape = tuple(int(ii) for ii in shape)
+        self.dtype = np.dtype(dtype)
+        self._index = np.zeros(0, dtype=np.int64) if index is None else np.asarray(index, dtype=np.int64)
+        self._count = np.zeros(0, dtype=np.int64) if count is None else np.asarray(count, dtype=np.int64)
+        self._pending_index = []
+        self._pending_count = []
+
+    def add(self, index, counts=1):
+        ''' Adds counts at the given tuple of indices (integers or
+            arrays, as for a dense array). Repeated indices all count.'''
+        flat = np.atleast_1d(np.ravel_multi_index(index, self.shape)).astype(np.int64)
+        self._pending_index.append(flat)
+        self._pending_count.append(np.broadcast_to(np.asarray(counts, dtype=np.int64), flat.shape))
+        if len(self._pending_index) >= self.max_pending:
+            self.coalesce()
+
+    def coalesce(self):
+        ''' Merges pending additions, leaving one sorted entry per
+            non-zero cell. Returns self.'''
+        if self._pending_index:
+            index = np.concatenate([self._index] + self._pending_index)
+            count = np.concatenate([self._count] + self._pending_count)
+            self._pending_index = []
+            self._pending_count = []
+            (self._index, inverse) = np.unique(index, return_inverse=True)
+            self._count = np.zeros(len(self._index), dtype=np.int64)
+            np.add.at(self._count, inverse.reshape(-1), count)
+            nonzero = self._count != 0
+            self._index = self._index[nonzero]
+            self._count = self._count[nonzero]
+        return self
+
+    @property
+    def index(self):
+        ''' int64 array; the raveled indices of the non-zero cells.'''
+        return self.coalesce()._index
+
+    @property
+    def count(self):
+        ''' int64 array; the count in each non-zero cell.'''
+        return self.coalesce()._count
+
+    @property
+    def nnz(self):
+        ''' The number of non-zero cells.'''
+        return len(self.index)
+
+    def __iadd__(self, other):
+        ''' fdata += other, for another SparseFlow or a dense array.'''
+        if isinstance(other, SparseFlow):
+            self._pending_index.append(other.index)
+            self._pending_count.append(other.count)
+        else:
+            flat = np.asarray(other).reshape(-1)
+            nonzero = np.flatnonzero(flat)
+            self._pending_index.append(nonzero.astype(np.int64))
+            self._pending_count.append(flat[nonzero].astype(np.int64))
+        return self
+
+    def to_dense(self):
+        ''' Returns the equivalent dense array, as from
+            utils.gen_empty_fdata. (Counts wrap around as in the dense
+            array if they overflow dtype.)'''
+        dense = np.zeros(self.shape, dtype=self.dtype)
+        dense.reshape(-1)[self.index] = self.count.astype(self.dtype)
+        return dense
+
+    def to_arrays(self, name="fdata"):
+        ''' Returns a dict of arrays for np.savez, see from_arrays.'''
+        return {name + "_index": self.index,
+                name + "_count": self.count,
+                name + "_shape": np.array(self.shape, dtype=np.int64)}
+
+    @classmethod
+    def from_arrays(cls, arrays, name="fdata", dtype=np.int16):
+        ''' Builds a SparseFlow from the arrays saved with to_arrays
+            (e.g. the result of np.load on a -data.npz file).'''
+        return cls(shape=arrays[name + "_shape"],
+                   index=arrays[name + "_index"],
+                   count=arrays[name + "_count"],
+                   dtype=dtype)
@@ -1,8 +1,36 @@
 import unittest as ut
+import io
+import gzip
+import bz2
+import lzma
+import json
+import pstats
+import os
+import tempfile
+import multiprocessing
+import contextlib
 import numpy as np
 import random
-from GPSUtils import gps_to_xy, pgps_to_xy, gps_distance
+import runpy
+import datetime
+from GPSUtils import gps_to_xy, pgps_to_xy, gps_distance, pgps_to_xy_array, gps_distance_array, origin_array, inv_basis
 import utils
+import main
+import script_pipeline
+import script_benchmark
+import script_grid
+import script_downsample
+import script_reduce
+import dataset
+import chunkstore
+import sharding
+import triptable
+import writers
+import background
+from sparseflow import SparseFlow
+import gridindex
+import metrics
+from gridindex import GridIndex
 
 class GPSUtilsTest(ut.TestCase):
     ''' Meant to test the function according to our Manhattan grid.'''
@@ -112,6 +140,34 @@ class GPSUtilsTest(ut.TestCase):
         self.assertTrue(max_difference >= d_or_to_tr)
         self.assertTrue(max_difference >= d_br_to_tl)
 
+class GPSUtilsArrayTest(ut.TestCase):
+    ''' The array versions must agree exactly with the scalar versions.'''
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.lon1 = rng.uniform(101, 106, 1000)
+        self.lat1 = rng.uniform(28, 32, 1000)
+        self.lon2 = self.lon1 + rng.uniform(-0.1, 0.1, 1000)
+        self.lat2 = self.lat1 + rng.uniform(-0.1, 0.1, 1000)
+
+    def tearDown(self):
+        pass
+
+    def test_pgps_to_xy_array(self):
+        x, y = pgps_to_xy_array(self.lon1, self.lat1)
+        self.assertEqual(x.shape, (1000,))
+        for (ii, (lon, lat)) in enumerate(zip(self.lon1, self.lat1)):
+            self.assertEqual((x[ii], y[ii]), pgps_to_xy(lon, lat))
+            # And close to the un-prebaked version
+            (gx, gy) = gps_to_xy(lon, lat)
+            self.assertAlmostEqual(x[ii], gx, places=4)
+            self.assertAlmostEqual(y[ii], gy, places=4)
+
+    def test_gps_distance_array(self):
+        d = gps_distance_array(self.lat1, self.lon1, self.lat2, self.lon2)
+        for ii in range(1000):
+            self.assertEqual(d[ii], gps_distance((self.lat1[ii], self.lon1[ii]), (self.lat2[ii], self.lon2[ii])))
+        self.assertEqual(round(gps_distance_array(48.1372, 11.5756, 52.5186, 13.4083), -2), 504200)
+
 class UtilsMiscTest(ut.TestCase):
     # Test the simpler utils
     def setUp(self):
@@ -461,10 +517,1233 @@ class UtilsUpdateDataTest(ut.TestCase):
     
         # TODO: More extensive tests could be good. (E.g. trips outside manhattan, trips that start outside and end up inside, vice versa, etc.)
 
+class UtilsReadChunksTest(ut.TestCase):
+    def setUp(self):
+        self.text = "".join("line %d\n" % ii for ii in range(100))
+
+    def tearDown(self):
+        pass
+
+    def test_iter_lines_matches_readlines(self):
+        expected = io.StringIO(self.text).readlines()
+        for chunk_size in (1, 3, 7, 64, 10000):
+            result = list(utils.iter_lines(io.StringIO(self.text), chunk_size=chunk_size))
+            self.assertEqual([line for (line, _) in result], [line.strip() for line in expected])
+            # Only the final line is flagged as last
+            self.assertEqual([is_last for (_, is_last) in result], [False]*99 + [True])
+
+    def test_iter_lines_no_trailing_newline(self):
+        result = list(utils.iter_lines(io.StringIO("a\nb\nc"), chunk_size=2))
+        self.assertEqual(result, [("a", False), ("b", False), ("c", True)])
+
+    def test_iter_lines_empty(self):
+        self.assertEqual(list(utils.iter_lines(io.StringIO(""))), [])
+
+    def test_open_text(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for (name, opener) in (("plain.text", open), ("a.text.gz", gzip.open), ("a.text.bz2", bz2.open),
+                                   ("a.text.xz", lzma.open), ("misnamed.text", gzip.open)):
+                filename = os.path.join(directory, name)
+                with opener(filename, "wt", encoding="UTF-8") as write_f:
+                    write_f.write(self.text)
+                with utils.open_text(filename) as read_f:
+                    self.assertEqual([line for (line, _) in utils.iter_lines(read_f, chunk_size=7)],
+                                     [line.strip() for line in self.text.splitlines()])
+
+class UtilsParseLinesTest(ut.TestCase):
+    ''' Compare the batch parser against process_entry, line by line.'''
+    def setUp(self):
+        driver_1 = "3a7013bfbbdcb48f7f203ed5d30c8e01"
+        driver_2 = "8f7f203ed5d30c8e013a7013bfbbdcb4"
+        order_1 = "464b015cf95322f3c07df5abb908f61f"
+        order_2 = "c07df5abb908f61f464b015cf95322f3"
+        line = "['%s', '%s', '%s', '104.05279', '30.65322']"
+        self.lines = [line % (driver_1, order_1, "1475299222"),
+                      line % (driver_1, order_1, "1475299225"),
+                      line % (driver_1, order_1, "bad"),         # Same id; skipped silently
+                      "garbage",                                 # Unparsable
+                      line % (driver_2, order_1, "bad"),         # New id; unparsable
+                      line % (driver_1, order_1, "1475299230"),
+                      line % (driver_1, order_2, "1475299300"),
+                      line % (driver_2, order_2, "1475299400"),
+                      line % (driver_2, order_2, "1475299500")]  # Last line; always an entry
+
+    def tearDown(self):
+        pass
+
+    def expected(self, lines):
+        start_entry = utils.Entry(id="EMPTY_ID")
+        boundary = []
+        unparsable = []
+        for (index, line) in enumerate(lines):
+            try:
+                (entry, is_next) = utils.process_entry(line=line, start_entry=start_entry, is_last=(index == len(lines) - 1))
+                boundary.append(is_next)
+                unparsable.append(False)
+                if is_next:
+                    start_entry = entry
+            except:
+                boundary.append(False)
+                unparsable.append(True)
+        return boundary, unparsable
+
+    def test_find_boundaries(self):
+        (boundary, unparsable) = self.expected(self.lines)
+        batch = utils.parse_lines(self.lines)
+        (b, u, _) = utils.find_boundaries(batch, start_key="EMPTY_ID", is_last=True)
+        self.assertEqual(b.tolist(), boundary)
+        self.assertEqual(u.tolist(), unparsable)
+
+    def test_find_boundaries_across_batches(self):
+        (boundary, unparsable) = self.expected(self.lines)
+        for split in range(len(self.lines)): # read_chunks never yields an empty last chunk
+            start_key = "EMPTY_ID"
+            b = []
+            u = []
+            for (lines, is_last) in ((self.lines[:split], False), (self.lines[split:], True)):
+                (bb, uu, start_key) = utils.find_boundaries(utils.parse_lines(lines), start_key=start_key, is_last=is_last)
+                b += bb.tolist()
+                u += uu.tolist()
+            self.assertEqual(b, boundary)
+            self.assertEqual(u, unparsable)
+
+    def test_find_boundaries_random_lines(self):
+        rng = np.random.default_rng(0)
+        keys = ["'%s', '%s'" % pair for pair in (("a1", "b1"), ("a1", "b2"), ("a2", "b1"))]
+        keys += ["['a1', 'b1'", "a1,b1 ", "  'a1',  'b1'"] # Same ids as the first, formatted differently
+        values = ["'1475299222', '104.05279', '30.65322']", "'bad', '104', '30']", "'1475299300', '104.1', '30.7']",
+                  "'1475299400']", "'1', '2', '3', '4']", "'99999999999999999999', '1', '2']",
+                  "'1475299500', 'inf', '30.7']", "'1475299500', '104.1', 'nan']"]
+        for _ in range(50):
+            lines = []
+            for _ in range(rng.integers(1, 60)):
+                if rng.random() < 0.05:
+                    lines.append(str(rng.choice(["garbage", "", "x,"])))
+                else:
+                    lines.append(str(rng.choice(keys[:3] if rng.random() < 0.8 else keys)) + ", "
+                                 + str(rng.choice(values, p=[0.5, 0.2, 0.16, 0.04, 0.03, 0.03, 0.02, 0.02])))
+            # Runs of the same line, as in the real data
+            lines = [line for line in lines for _ in range(rng.integers(1, 4))]
+            (boundary, unparsable) = self.expected(lines)
+            (b, u, _) = utils.find_boundaries(utils.parse_lines(lines), start_key="EMPTY_ID", is_last=True)
+            self.assertEqual(b.tolist(), boundary)
+            self.assertEqual(u.tolist(), unparsable)
+
+    def test_non_finite_coordinates(self):
+        # Unparsable in both engines, so the trip goes on from the line before
+        for bad in ("inf", "-inf", "nan"):
+            lines = ["['d1', 'o1', '1475280000', '104.05', '30.65']",
+                     "['d1', 'o2', '1475281000', '%s', '30.70']" % bad,
+                     "['d1', 'o2', '1475281100', '104.10', '30.71']",
+                     "['d1', 'o3', '1475282000', '104.20', '30.80']"]
+            counts = []
+            for engine in (main.process_lines_by_entry, main.process_lines_numpy):
+                (vdata, fdata) = (np.zeros((96, 10, 20, 2)), np.zeros((2, 96, 10, 20, 10, 20)))
+                trips = np.zeros((2, 2))
+                with contextlib.redirect_stdout(io.StringIO()):
+                    counts.append(engine(io.StringIO("\n".join(lines) + "\n"), 2016, 10, 1, vdata, fdata,
+                                         np.zeros_like(vdata), np.zeros_like(fdata), trips,
+                                         width=10, height=20, n=4, V=False, chunk_size=1 << 20) + (trips[0, 0],))
+            self.assertEqual(counts, [(0, 1, 4, 2.0)] * 2, bad)
+
+    def test_make_entries(self):
+        batch = utils.parse_lines(self.lines)
+        entries = utils.make_entries(batch, np.array([0, 6]), n=4)
+        for (index, row) in ((0, 0), (1, 6)):
+            (entry, _) = utils.process_entry(line=self.lines[row], start_entry=utils.Entry(id="EMPTY_ID"), n=4)
+            self.assertEqual(utils.entry_at(entries, index), entry)
+
+class UtilsEntryTest(ut.TestCase):
+    def setUp(self):
+        self.line = "['3a7013bfbbdcb48f7f203ed5d30c8e01', '464b015cf95322f3c07df5abb908f61f', '1475299222', '104.05279', '30.65322']"
+
+    def tearDown(self):
+        pass
+
+    def test_entry(self):
+        (entry, is_next) = utils.process_entry(line=self.line, start_entry=utils.Entry(id="EMPTY_ID"))
+        self.assertTrue(is_next)
+        self.assertIsInstance(entry, utils.Entry)
+        self.assertFalse(hasattr(entry, "__dict__"))
+        self.assertEqual(sorted(entry.as_dict()), sorted(utils.ENTRY_FIELDS))
+        self.assertEqual(entry['lon'], entry.lon)
+        self.assertRaises(KeyError, entry.__getitem__, 'passengers')
+        self.assertEqual(utils.Entry(**entry.as_dict()), entry)
+        self.assertNotEqual(utils.Entry(**dict(entry.as_dict(), t=entry.t + 1)), entry)
+        # The same id is skipped
+        self.assertEqual(utils.process_entry(line=self.line, start_entry=entry), (None, False))
+
+class UtilsTripKeyTest(ut.TestCase):
+    def setUp(self):
+        self.driver = "3a7013bfbbdcb48f7f203ed5d30c8e01"
+        self.order = "464b015cf95322f3c07df5abb908f61f"
+
+    def tearDown(self):
+        pass
+
+    def test_trip_key(self):
+        key = utils.trip_key(self.driver, self.order)
+        self.assertEqual(key, bytes.fromhex(self.driver) + bytes.fromhex(self.order))
+        self.assertEqual(len(key), 32)
+        # Keys that aren't lowercase hex hashes stay strings, and never collide
+        self.assertEqual(utils.trip_key("a1", "b1"), "a1_b1")
+        self.assertEqual(utils.trip_key(self.driver.upper(), self.order), self.driver.upper() + "_" + self.order)
+        self.assertNotEqual(utils.trip_key(self.driver.upper(), self.order), key)
+
+    def test_key_prefix(self):
+        line = "['%s', '%s', '1475299222', '104.05279', '30.65322']" % (self.driver, self.order)
+        prefix = utils.key_prefix(line)
+        self.assertEqual(prefix, "['%s', '%s'," % (self.driver, self.order))
+        self.assertIsNone(utils.key_prefix("garbage, no second comma"))
+
+    def test_driver_codes(self):
+        other = "8f7f203ed5d30c8e013a7013bfbbdcb4"
+        ids = [utils.trip_key(self.driver, self.order), utils.trip_key(other, self.order),
+               "a1_b1", utils.trip_key(self.driver, other)]
+        (codes, drivers) = utils.driver_codes(ids)
+        self.assertEqual(codes.dtype, np.int32)
+        self.assertEqual(codes.tolist(), [0, 1, -1, 0])
+        self.assertEqual(drivers, [bytes.fromhex(self.driver), bytes.fromhex(other)])
+        self.assertEqual(np.bincount(codes[codes >= 0]).tolist(), [2, 1])
+
+class UtilsTimeTest(ut.TestCase):
+    ''' Compare the integer time arithmetic against datetime.'''
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        self.timestamps = np.concatenate((rng.integers(-2*10**9, 4*10**9, 2000),
+                                          (1475251200 + np.arange(-2, 3)*86400 + np.array([[-1], [0], [1]])).ravel()))
+
+    def tearDown(self):
+        pass
+
+    def test_time_fields(self):
+        for tz_offset in (0, 8*3600, -5*3600, 5*3600 + 1800):
+            local = datetime.timezone(datetime.timedelta(seconds=tz_offset))
+            fields = utils.time_fields(self.timestamps, n=4, tz_offset=tz_offset)
+            for (ii, timestamp) in enumerate(self.timestamps.tolist()):
+                time = datetime.datetime.fromtimestamp(timestamp, local)
+                expected = (time.year, time.month, time.day, time.hour, time.minute, time.second)
+                self.assertEqual(utils.local_time(timestamp, tz_offset=tz_offset), expected)
+                self.assertEqual(tuple(fields[key][ii] for key in ('year', 'month', 'day', 'hour', 'min', 'sec')), expected)
+                self.assertEqual(fields['t'][ii], utils.get_t(hour=time.hour, minute=time.minute, n=4))
+
+    def test_timestamp_to_slot(self):
+        # Midnight, 23:59:59 and 8:00 on 2016-10-01, China Standard Time
+        (days, t) = utils.timestamp_to_slot(np.array([1475251200, 1475251200 + 86399, 1475251200 + 8*3600]), n=2, tz_offset=8*3600)
+        self.assertEqual(days.tolist(), [17075, 17075, 17075])
+        self.assertEqual(t.tolist(), [0, 47, 16])
+
+    def test_out_of_range(self):
+        self.assertRaises(ValueError, utils.local_time, utils.MAX_TIMESTAMP + 1)
+        self.assertRaises(ValueError, utils.local_time, utils.MIN_TIMESTAMP - 1)
+        utils.local_time(utils.MAX_TIMESTAMP, tz_offset=86400)
+
+class UtilsCheckValidBulkTest(ut.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        N = 2000
+        def random_entries():
+            return {'lon': 104 + rng.uniform(-0.02, 0.02, N),
+                    'lat': 30.6 + rng.uniform(-0.02, 0.02, N),
+                    'timestamp': 1475299222 + rng.integers(-120, 3000, N),
+                    'year': np.full(N, 2016),
+                    'month': np.full(N, 10),
+                    'day': rng.integers(1, 3, N)}
+        self.entries = random_entries()
+        self.start_entries = random_entries()
+
+    def tearDown(self):
+        pass
+
+    def test_bulk_equals_scalar(self):
+        valid = utils.check_valid_bulk(entries=self.entries, start_entries=self.start_entries, year=2016, month=10, day=1)
+        expected = [utils.check_valid(entry=utils.entry_at(self.entries, ii),
+                                      start_entry=utils.entry_at(self.start_entries, ii),
+                                      year=2016, month=10, day=1)
+                    for ii in range(len(valid))]
+        self.assertEqual(valid.tolist(), expected)
+        self.assertTrue(0 < np.count_nonzero(valid) < len(valid))
+
+class GridIndexTest(ut.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        N = 100000
+        basis = np.linalg.inv(inv_basis)
+        # Points on and next to the cell edges, and spread over the bounding box
+        x = np.round(rng.uniform(-0.1, 1.1, N)*20)/20 + rng.choice([0, 1e-12, -1e-12, 1e-6], N)
+        y = rng.uniform(-0.1, 1.1, N)
+        edges = origin_array + np.stack((np.concatenate((x, y)), np.concatenate((y, x))), axis=1) @ basis
+        self.lon = np.concatenate((edges[:, 0], np.round(rng.uniform(102, 106, N), 5), [np.nan, np.inf, -np.inf, 0]))
+        self.lat = np.concatenate((edges[:, 1], np.round(rng.uniform(28.5, 33, N), 5), [30, 30, np.nan, 0]))
+
+    def tearDown(self):
+        pass
+
+    def test_cells_match_exact(self):
+        for (w, h) in ((10, 20), (5, 10), (1, 1), (7, 3)):
+            index = GridIndex(w, h)
+            self.assertTrue(np.array_equal(index.cells(self.lon, self.lat), gridindex.exact_cells(self.lon, self.lat, w, h)))
+            self.assertEqual(index.cell(104.05279, 30.65322), gridindex.exact_cells(104.05279, 30.65322, w, h))
+
+    def test_grid_coordinates(self):
+        finite = np.isfinite(self.lon) & np.isfinite(self.lat)
+        (lon, lat) = (self.lon[finite], self.lat[finite])
+        (x, y) = pgps_to_xy_array(lon, lat)
+        entries = {'lon': lon, 'lat': lat, 'x': x, 'y': y}
+        (inside, gx, gy) = utils.grid_coordinates(entries, w=10, h=20)
+        (grid_inside, grid_gx, grid_gy) = utils.grid_coordinates(entries, w=10, h=20, grid=GridIndex(10, 20))
+        self.assertTrue(np.array_equal(inside, grid_inside))
+        self.assertTrue(np.array_equal(gx[inside], grid_gx[inside]))
+        self.assertTrue(np.array_equal(gy[inside], grid_gy[inside]))
+
+    def test_cached(self):
+        with tempfile.TemporaryDirectory() as directory:
+            index = GridIndex.cached(10, 20, directory=directory)
+            self.assertTrue(os.path.exists(gridindex.cache_filename(10, 20, directory)))
+            loaded = GridIndex.cached(10, 20, directory=directory)
+            self.assertTrue(np.array_equal(index.table, loaded.table))
+            self.assertTrue(np.array_equal(loaded.cells(self.lon, self.lat), index.cells(self.lon, self.lat)))
+            self.assertIsNone(GridIndex.load(os.path.join(directory, "missing.npz")))
+
+class SparseFlowTest(ut.TestCase):
+    def setUp(self):
+        self.shape = (2, 8, 3, 4, 3, 4)
+
+    def tearDown(self):
+        pass
+
+    def test_matches_dense(self):
+        rng = np.random.default_rng(2)
+        dense = np.zeros(self.shape, dtype=np.int16)
+        sparse = SparseFlow(self.shape)
+        for _ in range(50):
+            index = tuple(rng.integers(0, size, 20) for size in self.shape)
+            np.add.at(dense, index, 1)
+            sparse.add(index)
+        sparse.add((1, 2, 0, 0, 2, 3))
+        dense[1, 2, 0, 0, 2, 3] += 1
+        self.assertTrue(np.array_equal(sparse.to_dense(), dense))
+        self.assertEqual(sparse.nnz, np.count_nonzero(dense))
+
+        # Merging with +=, and saving/loading
+        other = SparseFlow(self.shape)
+        other += dense
+        other += sparse
+        loaded = SparseFlow.from_arrays(other.to_arrays("fdata"), "fdata")
+        self.assertTrue(np.array_equal(loaded.to_dense(), 2*dense))
+
+    def test_overflow_wraps_like_dense(self):
+        dense = np.zeros(self.shape, dtype=np.int16)
+        sparse = SparseFlow(self.shape)
+        index = (np.zeros(40000, dtype=np.int64),)*6
+        np.add.at(dense, index, 1)
+        sparse.add(index)
+        self.assertTrue(np.array_equal(sparse.to_dense(), dense))
+
+class UtilsCompileArraysTest(ut.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def save_arrays(self, axis):
+        ''' Saves random int16 arrays of different lengths along axis.'''
+        rng = np.random.default_rng(3)
+        arrays = []
+        filenames = []
+        for (ii, length) in enumerate((5, 1, 7)):
+            shape = [2, 3, 4]
+            shape[axis] = length
+            arrays.append(rng.integers(0, 100, shape).astype(np.int16))
+            filenames.append(os.path.join(self.tmp.name, "%d-%d.npz" % (axis, ii)))
+            np.savez_compressed(filenames[-1], arrays[-1])
+        return arrays, filenames
+
+    def test_npz_array_info(self):
+        (arrays, filenames) = self.save_arrays(axis=0)
+        for (filename, array) in zip(filenames, arrays):
+            self.assertEqual(utils.npz_array_info(filename), (array.shape, array.dtype))
+
+    def test_npz_memmap(self):
+        array = np.arange(24, dtype=np.int16).reshape(2, 3, 4)
+        for (codec, level, mapped) in (("npz", None, True), ("npz-zlib", None, False), ("npz-zlib", 1, False)):
+            filename = os.path.join(self.tmp.name, "%s-%s.npz" % (codec, level))
+            writers.save_arrays(filename, {'first': np.ones(3), 'vdata': array}, codec=codec, level=level)
+            result = utils.npz_memmap(filename, 'vdata')
+            self.assertEqual(isinstance(result, np.memmap), mapped)
+            self.assertEqual(result.dtype, array.dtype)
+            self.assertTrue(np.array_equal(result, array))
+
+    def test_compile_nothing(self):
+        with self.assertRaises(ValueError):
+            utils.compile_arrays([], os.path.join(self.tmp.name, "out.npy"))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "out.npy")))
+
+    def test_append_npy(self):
+        filename = os.path.join(self.tmp.name, "grow.npy")
+        arrays = [np.arange(24, dtype=np.int16).reshape(2, 3, 4) + 100*ii for ii in range(12)]
+        np.save(filename, arrays[0])
+        size = os.path.getsize(filename)
+        for array in arrays[1:]:
+            utils.append_npy(filename, array)
+        self.assertEqual(os.path.getsize(filename), size + 11*arrays[0].nbytes)
+        self.assertTrue(np.array_equal(np.load(filename, mmap_mode="r"), np.concatenate(arrays)))
+        with self.assertRaises(ValueError):
+            utils.append_npy(filename, np.zeros((2, 3, 5), dtype=np.int16))
+        with self.assertRaises(ValueError):
+            utils.append_npy(filename, np.zeros((2, 3, 4), dtype=np.int32))
+        self.assertEqual(np.load(filename).shape, (24, 3, 4))
+
+        self.assertEqual(utils.truncate_npy(filename, 10), (10, 3, 4))
+        self.assertEqual(os.path.getsize(filename), size + 4*arrays[0].nbytes)
+        self.assertTrue(np.array_equal(np.load(filename), np.concatenate(arrays[:5])))
+        with self.assertRaises(ValueError):
+            utils.truncate_npy(filename, 11)
+
+    def test_compile_arrays(self):
+        for axis in (0, 1):
+            (arrays, filenames) = self.save_arrays(axis=axis)
+            save_filename = os.path.join(self.tmp.name, "out%d.npy" % axis)
+            with contextlib.redirect_stdout(io.StringIO()):
+                out = utils.compile_arrays(filenames, save_filename, axis=axis)
+            expected = np.concatenate(arrays, axis=axis)
+            self.assertTrue(np.array_equal(out, expected))
+            del out
+            loaded = np.load(save_filename, mmap_mode="r")
+            self.assertEqual(loaded.dtype, np.int16)
+            self.assertTrue(np.array_equal(loaded, expected))
+
+class PipelineTest(ut.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dates = utils.generate_dates(2016, 10, 30, 2016, 11, 2)
+        self.shape = (3, 4, 2)
+        for (ii, date) in enumerate(self.dates):
+            self.save_day(date, seed=ii, sparse=(ii == 1))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def save_day(self, date, seed, sparse=False):
+        rng = np.random.default_rng(seed)
+        (w, h, n) = self.shape
+        vdata = rng.integers(0, 10, (24*n, w, h, 2)).astype(np.int16)
+        fdata = rng.integers(0, 10, (2, 24*n, w, h, w, h)).astype(np.int16)
+        filename = script_pipeline.day_filename(self.tmp.name, *date)
+        if sparse:
+            sparse_fdata = SparseFlow(fdata.shape)
+            sparse_fdata += fdata
+            np.savez_compressed(filename, vdata=vdata, **sparse_fdata.to_arrays("fdata"))
+        else:
+            np.savez_compressed(filename, vdata=vdata, fdata=fdata)
+        return vdata, fdata
+
+    def expected(self):
+        days = [utils.stdn_arrays(np.load(script_pipeline.day_filename(self.tmp.name, *date))) for date in self.dates]
+        return np.concatenate([v for (v, _) in days]), np.concatenate([f for (_, f) in days], axis=1)
+
+    def outputs(self):
+        return (np.load(os.path.join(self.tmp.name, script_pipeline.VOLUME_FILENAME)),
+                np.load(os.path.join(self.tmp.name, script_pipeline.FLOW_FILENAME)))
+
+    def test_build(self):
+        self.assertEqual(len(self.dates), 3)
+        converted = script_pipeline.build(self.dates, data_dir=self.tmp.name, out_dir=self.tmp.name)
+        self.assertEqual(len(converted), 3)
+        for (result, expected) in zip(self.outputs(), self.expected()):
+            self.assertTrue(np.array_equal(result, expected))
+
+        # Nothing changed, so nothing to do
+        self.assertEqual(script_pipeline.build(self.dates, data_dir=self.tmp.name, out_dir=self.tmp.name), [])
+
+        # Only the changed day is converted again
+        self.save_day(self.dates[2], seed=100)
+        converted = script_pipeline.build(self.dates, data_dir=self.tmp.name, out_dir=self.tmp.name)
+        self.assertEqual(converted, [script_pipeline.day_filename(self.tmp.name, *self.dates[2])])
+        for (result, expected) in zip(self.outputs(), self.expected()):
+            self.assertTrue(np.array_equal(result, expected))
+
+    def test_missing_day(self):
+        dates = utils.generate_dates(2016, 10, 30, 2016, 11, 3)
+        with self.assertRaises(FileNotFoundError):
+            script_pipeline.build(dates, data_dir=self.tmp.name, out_dir=self.tmp.name)
+
+    def test_dataset(self):
+        script_pipeline.build(self.dates, data_dir=self.tmp.name, out_dir=self.tmp.name)
+        (vdata, fdata) = self.expected()
+        store = dataset.STDNDataset(self.tmp.name)
+        self.assertIsInstance(store.vdata, np.memmap)
+        self.assertEqual(len(store), vdata.shape[0])
+        self.assertTrue(np.array_equal(store.volume(5, 80), vdata[5:80]))
+        self.assertTrue(np.array_equal(store.flow(5, 80), fdata[:, 5:80]))
+        self.assertEqual(store.day_slots(*self.dates[1]), (48, 96))
+        with self.assertRaises(KeyError):
+            store.day_slots(2016, 12, 1)
+
+        windows = list(store.windows(look_back=3, start=10, stop=20, step=4))
+        self.assertEqual([t for (t, _, _, _) in windows], [10, 14, 18])
+        (t, volume, flow, target) = windows[1]
+        self.assertTrue(np.array_equal(volume, vdata[11:14]))
+        self.assertTrue(np.array_equal(flow, fdata[:, 11:14]))
+        self.assertTrue(np.array_equal(target, vdata[14]))
+        self.assertEqual(len(list(store.windows(look_back=7))), len(store) - 7)
+
+        # The older .npz stores
+        for (save, mapped) in ((np.savez, True), (np.savez_compressed, False)):
+            directory = os.path.join(self.tmp.name, save.__name__)
+            os.mkdir(directory)
+            save(os.path.join(directory, "STDN-volume.npz"), vdata)
+            save(os.path.join(directory, "STDN-flow.npz"), fdata)
+            store = dataset.STDNDataset(directory)
+            self.assertEqual(isinstance(store.fdata, np.memmap), mapped)
+            self.assertTrue(np.array_equal(store.flow(40, 50), fdata[:, 40:50]))
+        with self.assertRaises(FileNotFoundError):
+            dataset.STDNDataset(os.path.join(self.tmp.name, "missing"))
+
+    def test_append(self):
+        with self.assertRaises(ValueError):
+            script_pipeline.append(self.dates, data_dir=self.tmp.name, out_dir=self.tmp.name)
+        script_pipeline.build(self.dates[:1], data_dir=self.tmp.name, out_dir=self.tmp.name, chunked=True)
+        volume_filename = os.path.join(self.tmp.name, script_pipeline.VOLUME_FILENAME)
+        chunks_filename = os.path.join(self.tmp.name, script_pipeline.FLOW_CHUNKS_FILENAME)
+        # The data already there is not rewritten
+        with open(volume_filename, "rb") as read_f:
+            volume_start = read_f.read()[128:]
+        with open(chunks_filename, "rb") as read_f:
+            chunks_start = read_f.read(chunkstore.ChunkedArray(chunks_filename).chunks[-1][4])
+
+        appended = script_pipeline.append(self.dates, data_dir=self.tmp.name, out_dir=self.tmp.name)
+        self.assertEqual(appended, [script_pipeline.day_filename(self.tmp.name, *date) for date in self.dates[1:]])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, script_pipeline.FLOW_FILENAME)))
+        with open(volume_filename, "rb") as read_f:
+            self.assertTrue(read_f.read()[128:].startswith(volume_start))
+        with open(chunks_filename, "rb") as read_f:
+            self.assertEqual(read_f.read(len(chunks_start)), chunks_start)
+        (vdata, fdata) = self.expected()
+        store = dataset.STDNDataset(self.tmp.name)
+        self.assertTrue(np.array_equal(store.volume(0, len(store)), vdata))
+        self.assertTrue(np.array_equal(store.flow(0, len(store)), fdata))
+        self.assertEqual(store.day_slots(*self.dates[2]), (96, 144))
+
+        # Covered days are skipped; earlier ones can't be appended
+        self.assertEqual(script_pipeline.append(self.dates, data_dir=self.tmp.name, out_dir=self.tmp.name), [])
+        self.save_day((2016, 10, 29), seed=5)
+        with self.assertRaises(ValueError):
+            script_pipeline.append([(2016, 10, 29)], data_dir=self.tmp.name, out_dir=self.tmp.name)
+        self.assertEqual(len(dataset.STDNDataset(self.tmp.name)), 144)
+
+        # A flow that can't be appended leaves the volume as it was
+        (vdata, fdata) = self.save_day((2016, 11, 2), seed=6)
+        np.savez_compressed(script_pipeline.day_filename(self.tmp.name, 2016, 11, 2), vdata=vdata, fdata=fdata.astype(np.int32))
+        with self.assertRaises(ValueError):
+            script_pipeline.append([(2016, 11, 2)], data_dir=self.tmp.name, out_dir=self.tmp.name)
+        self.assertEqual(np.load(volume_filename, mmap_mode="r").shape[0], 144)
+        self.assertEqual(len(dataset.STDNDataset(self.tmp.name)), 144)
+
+    def test_data_to_stdn(self):
+        # An npz-chunked day in data/, converted from the folder above it
+        (vdata, fdata) = self.save_day(self.dates[0], seed=0)
+        os.mkdir(os.path.join(self.tmp.name, "data"))
+        writers.save_arrays(os.path.join(self.tmp.name, "data", "20161030-data.npz"),
+                            {'vdata': vdata, 'fdata': fdata}, codec="npz-chunked")
+        cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        try:
+            runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), "script_data_to_stdn.py"))
+        finally:
+            os.chdir(cwd)
+        with np.load(os.path.join(self.tmp.name, "data", "STDN-flow-20161030.npz")) as data:
+            self.assertTrue(np.array_equal(data['arr_0'], fdata))
+        with np.load(os.path.join(self.tmp.name, "data", "STDN-volume-20161030.npz")) as data:
+            self.assertTrue(np.array_equal(data['arr_0'], vdata))
+
+    def test_chunked(self):
+        script_pipeline.build(self.dates, data_dir=self.tmp.name, out_dir=self.tmp.name, chunked=True)
+        (vdata, fdata) = self.expected()
+        chunks_filename = os.path.join(self.tmp.name, script_pipeline.FLOW_CHUNKS_FILENAME)
+        self.assertTrue(np.array_equal(chunkstore.ChunkedArray(chunks_filename)[...], fdata))
+        # A chunked flow and no .npy
+        os.remove(os.path.join(self.tmp.name, script_pipeline.FLOW_FILENAME))
+        store = dataset.STDNDataset(self.tmp.name, flow_filename=script_pipeline.FLOW_CHUNKS_FILENAME)
+        self.assertIsInstance(store.fdata, chunkstore.ChunkedArray)
+        self.assertTrue(np.array_equal(store.flow(5, 80), fdata[:, 5:80]))
+        # ... which is used over a stale .npz
+        np.savez(os.path.join(self.tmp.name, "STDN-flow.npz"), fdata[:, :24])
+        self.assertIsInstance(dataset.STDNDataset(self.tmp.name).fdata, chunkstore.ChunkedArray)
+
+class UtilsUpdateDataBulkTest(ut.TestCase):
+    ''' update_data_bulk must give the same counts as update_data.'''
+    def setUp(self):
+        self.w, self.h, self.n = 3, 4, 4
+        rng = np.random.default_rng(0)
+        N = 2000
+        def random_entries():
+            # Some points sit exactly on the far edge of the grid (x or y == 1)
+            return {'x': np.where(rng.random(N) < 0.05, 1.0, rng.uniform(-0.5, 1.5, N)),
+                    'y': np.where(rng.random(N) < 0.05, 1.0, rng.uniform(-0.5, 1.5, N)),
+                    't': rng.integers(0, 24*self.n, N),
+                    'day': rng.integers(1, 3, N)}
+        self.entries = random_entries()
+        self.start_entries = random_entries()
+
+    def tearDown(self):
+        pass
+
+    def empty(self):
+        return [utils.gen_empty_vdata(w=self.w, h=self.h, n=self.n),
+                utils.gen_empty_fdata(w=self.w, h=self.h, n=self.n),
+                utils.gen_empty_vdata(w=self.w, h=self.h, n=self.n),
+                utils.gen_empty_fdata(w=self.w, h=self.h, n=self.n),
+                np.zeros((2, 2))]
+
+    def test_bulk_equals_scalar(self):
+        (vdata, fdata, vdata_next_mo, fdata_next_mo, trips) = expected = self.empty()
+        for index in range(len(self.entries['x'])):
+            utils.update_data(entry=utils.entry_at(self.entries, index),
+                              start_entry=utils.entry_at(self.start_entries, index),
+                              vdata=vdata, fdata=fdata,
+                              vdata_next_mo=vdata_next_mo, fdata_next_mo=fdata_next_mo,
+                              trips=trips, w=self.w, h=self.h, n=self.n)
+
+        (vdata, fdata, vdata_next_mo, fdata_next_mo, trips) = result = self.empty()
+        utils.update_data_bulk(entries=self.entries, start_entries=self.start_entries,
+                               vdata=vdata, fdata=fdata,
+                               vdata_next_mo=vdata_next_mo, fdata_next_mo=fdata_next_mo,
+                               trips=trips, w=self.w, h=self.h, n=self.n)
+
+        for (e, r) in zip(expected, result):
+            self.assertEqual(e.dtype, r.dtype)
+            self.assertTrue(np.array_equal(e, r))
+        # Make sure every branch was exercised
+        self.assertTrue(fdata[0].any() and fdata[1].any() and fdata_next_mo[1].any() and vdata_next_mo.any())
+
+class MainProcessTest(ut.TestCase):
+    ''' Runs main.process end-to-end on a few random days.'''
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        for day in (1, 2, 3):
+            script_benchmark.write_gps_day("gps_201610%02d.text" % day, 2016, 10, day,
+                                           orders=200, max_pings=10, seed=day)
+        self.kwargs = dict(startyear=2016, startmonth=10, startday=1,
+                           endyear=2016, endmonth=10, endday=4,
+                           width=4, height=5, n=2)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def run_process(self, directory, **kwargs):
+        ''' Runs main.process in a subdirectory, returns the saved arrays by day.'''
+        os.mkdir(directory)
+        for day in (1, 2, 3):
+            os.link("gps_201610%02d.text" % day, os.path.join(directory, "gps_201610%02d.text" % day))
+        os.chdir(directory)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                main.process(**self.kwargs, **kwargs)
+            return {day: dict(np.load("201610%02d-data.npz" % day)) for day in (1, 2, 3)}
+        finally:
+            os.chdir(self.tmp.name)
+
+    def assertSameOutput(self, expected, result):
+        for day in expected:
+            self.assertEqual(sorted(expected[day]), sorted(result[day]))
+            for key in expected[day]:
+                self.assertEqual(expected[day][key].dtype, result[day][key].dtype)
+                self.assertTrue(np.array_equal(expected[day][key], result[day][key]), (day, key))
+
+    def test_engines_agree(self):
+        self.assertSameOutput(self.run_process("line", engine="line"),
+                              self.run_process("numpy", engine="numpy", chunk_size=1000))
+
+    def test_workers(self):
+        # Some trips cross midnight, so there is data to carry over
+        with contextlib.redirect_stdout(io.StringIO()):
+            vdata_next_mo = main.process_one_day((2016, 10, 1), width=4, height=5, n=2)[2]
+        self.assertTrue(vdata_next_mo.sum() > 0)
+        expected = self.run_process("sequential")
+        self.assertSameOutput(expected, self.run_process("parallel", workers=2))
+
+    def test_resume(self):
+        expected = self.run_process("full")
+        for sparse in (False, True):
+            directory = "resumed-%s" % sparse
+            os.mkdir(directory)
+            for day in (1, 2, 3):
+                os.link("gps_201610%02d.text" % day, os.path.join(directory, "gps_201610%02d.text" % day))
+            os.chdir(directory)
+            try:
+                # A run that stops after the first two days
+                kwargs = dict(self.kwargs, endday=3, sparse=sparse)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    main.process(**kwargs)
+                # Resume the full range; only day 3 should be processed
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    main.process(**self.kwargs, sparse=sparse, resume=True)
+                self.assertNotIn("gps_20161001", output.getvalue())
+                self.assertNotIn("gps_20161002", output.getvalue())
+                self.assertIn("gps_20161003", output.getvalue())
+                self.assertEqual(main.load_checkpoint_manifest()['completed'], ["20161001", "20161002", "20161003"])
+                # Resuming again has nothing left to do
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    main.process(**self.kwargs, sparse=sparse, resume=True)
+                self.assertNotIn("gps_", output.getvalue())
+
+                result = {day: dict(np.load("201610%02d-data.npz" % day)) for day in (1, 2, 3)}
+            finally:
+                os.chdir(self.tmp.name)
+            if sparse:
+                for day in result:
+                    result[day]["fdata"] = utils.load_fdata(result[day])
+                    for key in ("fdata_index", "fdata_count", "fdata_shape"):
+                        del result[day][key]
+            self.assertSameOutput(expected, result)
+
+    def test_resume_with_different_settings(self):
+        self.run_process("settings")
+        os.chdir("settings")
+        try:
+            with self.assertRaises(ValueError):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    main.process(**dict(self.kwargs, n=4), resume=True)
+        finally:
+            os.chdir(self.tmp.name)
+
+    def test_sparse(self):
+        expected = self.run_process("dense")
+        for engine in ("line", "numpy"):
+            result = self.run_process("sparse-" + engine, engine=engine, sparse=True)
+            for day in result:
+                self.assertNotIn("fdata", result[day])
+                result[day]["fdata"] = utils.load_fdata(result[day])
+                for key in ("fdata_index", "fdata_count", "fdata_shape"):
+                    del result[day][key]
+            self.assertSameOutput(expected, result)
+
+    def test_grid_index(self):
+        self.assertSameOutput(self.run_process("exact", grid_index=False),
+                              self.run_process("indexed", grid_index=True))
+        # Nothing is left in the output folder
+        self.assertFalse(os.path.exists(os.path.join("indexed", gridindex.cache_filename(4, 5))))
+
+    def test_metrics(self):
+        expected = self.run_process("plain")
+        metrics_filename = os.path.join(self.tmp.name, "metrics.jsonl")
+        self.assertSameOutput(expected, self.run_process("json", metrics_filename=metrics_filename, workers=2))
+        with open(metrics_filename) as read_f:
+            records = [json.loads(line) for line in read_f]
+        self.assertEqual([record['day'] for record in records], ["20161001", "20161002", "20161003"])
+        for record in records:
+            day = int(record['day'][-2:])
+            self.assertEqual(sorted(record['seconds']), ["aggregate", "checkpoint", "parse", "read", "save", "validate"])
+            self.assertEqual(sorted(record['seconds']), sorted(record['cpu_seconds']))
+            counts = record['counts']
+            self.assertEqual([counts['invalid_trips'], counts['unparsable_lines']], expected[day]['errors'].tolist())
+            self.assertEqual(counts['valid_trips'], expected[day]['trips'].sum())
+            self.assertEqual(counts['bytes_read'], os.path.getsize("gps_201610%02d.text" % day))
+            self.assertEqual(counts['bytes_written'], os.path.getsize(os.path.join("json", "201610%02d-data.npz" % day)))
+
+        prom_filename = os.path.join(self.tmp.name, "metrics.prom")
+        self.run_process("prom", metrics_filename=prom_filename)
+        with open(prom_filename) as read_f:
+            text = read_f.read()
+        # The last day as gauges, and running totals, with no label per day
+        self.assertNotIn("day=", text)
+        self.assertIn("# TYPE gps_stage_seconds gauge", text)
+        self.assertIn('gps_stage_seconds{stage="parse"} ', text)
+        self.assertIn("\ngps_day 20161003\n", text)
+        self.assertIn("\ngps_lines %d\n" % records[2]['counts']['lines'], text)
+        self.assertIn("# TYPE gps_lines_total counter", text)
+        self.assertIn("\ngps_lines_total %d\n" % sum(record['counts']['lines'] for record in records), text)
+        self.assertIn("\ngps_days_total 3\n", text)
+
+    def test_profile(self):
+        self.run_process("profile", profile=True)
+        stats = pstats.Stats(os.path.join("profile", "20161002-profile.prof"))
+        self.assertTrue(any(name == "process_day" for (_, _, name) in stats.stats))
+
+    def test_save_trips(self):
+        expected = self.run_process("line", engine="line", save_trips=True)
+        self.assertSameOutput(expected, self.run_process("numpy", chunk_size=1000, save_trips=True))
+        for day in (1, 2, 3):
+            (line_columns, unparsable, tz_offset) = triptable.load_trips(os.path.join("line", "201610%02d-trips.npz" % day))
+            (numpy_columns, _, _) = triptable.load_trips(os.path.join("numpy", "201610%02d-trips.npz" % day))
+            self.assertEqual(unparsable, expected[day]['errors'][1])
+            self.assertEqual(tz_offset, utils.TZ_OFFSET)
+            self.assertEqual(np.count_nonzero(~line_columns['valid']), expected[day]['errors'][0])
+            for name in triptable.COLUMNS:
+                self.assertEqual(line_columns[name].dtype, triptable.DTYPES[name])
+                self.assertTrue(np.array_equal(line_columns[name], numpy_columns[name]), (day, name))
+
+        dates = [(2016, 10, day) for day in (1, 2, 3)]
+        def load(directory):
+            return {day: dict(np.load(os.path.join(directory, "201610%02d-data.npz" % day))) for day in (1, 2, 3)}
+        # The same settings give the same output
+        script_grid.grid(dates, trips_dir="numpy", out_dir="regrid", width=4, height=5, n=2)
+        self.assertSameOutput(expected, load("regrid"))
+        # Other settings give what main.py would with them
+        script_grid.grid(dates, trips_dir="numpy", out_dir="regrid-3x7", width=3, height=7, n=1, grid_index=False)
+        self.kwargs = dict(self.kwargs, width=3, height=7, n=1)
+        self.assertSameOutput(self.run_process("direct-3x7"), load("regrid-3x7"))
+
+    def test_downsample(self):
+        dates = [(2016, 10, day) for day in (1, 2, 3)]
+        def load(directory):
+            return {day: dict(np.load(os.path.join(directory, "201610%02d-data.npz" % day))) for day in (1, 2, 3)}
+        fine = self.run_process("fine")
+        self.run_process("fine-sparse", sparse=True)
+
+        # Merging cells only is exact
+        self.assertEqual(script_downsample.downsample(dates, data_dir="fine", out_dir="2x5-2", width=2, height=5, n=2), 0)
+        self.kwargs = dict(self.kwargs, width=2, height=5)
+        self.assertSameOutput(self.run_process("direct-2x5-2"), load("2x5-2"))
+
+        # Merging time slots is exact except for fdata axis 0
+        ambiguous = script_downsample.downsample(dates, data_dir="fine", out_dir="2x5-1", width=2, height=5, n=1, buffer=1)
+        self.assertEqual(ambiguous, script_downsample.downsample(dates, data_dir="fine-sparse", out_dir="2x5-1-sparse",
+                                                                 width=2, height=5, n=1))
+        self.kwargs = dict(self.kwargs, n=1)
+        direct = self.run_process("direct-2x5-1")
+        result = load("2x5-1")
+        sparse_result = load("2x5-1-sparse")
+        for day in direct:
+            for key in ("vdata", "trips", "errors"):
+                self.assertTrue(np.array_equal(direct[day][key], result[day][key]), (day, key))
+            self.assertTrue(np.array_equal(result[day]['fdata'], utils.load_fdata(sparse_result[day])))
+        # (Trips that last almost a day can move to the day after; see script_downsample.)
+        direct_fdata = sum(direct[day]['fdata'].astype(np.int64) for day in direct)
+        result_fdata = sum(result[day]['fdata'].astype(np.int64) for day in result)
+        self.assertTrue(np.array_equal(direct_fdata.sum(axis=0), result_fdata.sum(axis=0)))
+        self.assertTrue((result_fdata[0] <= direct_fdata[0]).all())
+        self.assertGreater(ambiguous, 0)
+        self.assertGreater(fine[1]['fdata'][1].sum(), 0)
+
+        with self.assertRaises(ValueError):
+            script_downsample.downsample(dates, data_dir="fine", out_dir="3x5", width=3, height=5, n=2)
+
+    def test_codecs(self):
+        expected = self.run_process("default")
+        for codec in ("npz", "npz-lzma"):
+            self.assertSameOutput(expected, self.run_process(codec, codec=codec))
+        self.assertSameOutput(expected, self.run_process("bz2-1", codec="npz-bz2", compress_level=1))
+        with self.assertRaises(ValueError):
+            main.process(**self.kwargs, codec="npz-lzma", compress_level=1)
+
+        result = self.run_process("chunked", codec="npz-chunked")
+        self.assertTrue(os.path.exists(os.path.join("chunked", "20161001-data.fchunks")))
+        for day in result:
+            with np.load(os.path.join("chunked", "201610%02d-data.npz" % day)) as data:
+                result[day]["fdata"] = utils.load_fdata(data, directory="chunked")
+            for key in ("fdata_chunks", "fdata_shape"):
+                del result[day][key]
+        self.assertSameOutput(expected, result)
+
+    def test_chunked_elsewhere(self):
+        # The .fchunks are found next to the .npz, not in the current folder
+        expected = self.run_process("plain")
+        self.run_process("chunked", codec="npz-chunked")
+        dates = [(2016, 10, day) for day in (1, 2, 3)]
+        self.assertEqual(script_downsample.downsample(dates, data_dir="chunked", out_dir="2x5-2", width=2, height=5, n=2), 0)
+        self.kwargs = dict(self.kwargs, width=2, height=5)
+        direct = self.run_process("direct-2x5-2")
+        for day in direct:
+            with np.load(os.path.join("2x5-2", "201610%02d-data.npz" % day)) as data:
+                self.assertTrue(np.array_equal(data['fdata'], direct[day]['fdata']), day)
+        saved = script_reduce.reduce_days(dates, data_dir="chunked", out_dir="reduced", by="month")
+        with np.load(saved[0]) as data:
+            self.assertTrue(np.array_equal(data['fdata'], sum(expected[day]['fdata'].astype(np.int64) for day in expected)))
+
+    def test_pipeline(self):
+        expected = self.run_process("plain")
+        self.assertSameOutput(expected, self.run_process("pipeline", pipeline=True, chunk_size=1000))
+        self.assertSameOutput(expected, self.run_process("pipeline-line", pipeline=True, engine="line"))
+        self.assertSameOutput(expected, self.run_process("pipeline-workers", pipeline=True, workers=2))
+        result = self.run_process("pipeline-sparse", pipeline=True, sparse=True)
+        for day in result:
+            result[day]["fdata"] = utils.load_fdata(result[day])
+            for key in ("fdata_index", "fdata_count", "fdata_shape"):
+                del result[day][key]
+        self.assertSameOutput(expected, result)
+        with open(os.path.join("pipeline", main.CHECKPOINT_FILENAME)) as read_f:
+            self.assertEqual(json.load(read_f)['completed'], ["20161001", "20161002", "20161003"])
+
+    def test_shards(self):
+        expected = self.run_process("plain")
+        self.assertSameOutput(expected, self.run_process("shards", shards=3))
+        self.assertSameOutput(expected, self.run_process("shards-trips", shards=2, save_trips=True))
+        for day in (1, 2, 3):
+            (sharded, _, _) = triptable.load_trips(os.path.join("shards-trips", "201610%02d-trips.npz" % day))
+            self.assertEqual(len(sharded['valid']), expected[day]['errors'][0] + expected[day]['trips'].sum())
+        with self.assertRaises(ValueError):
+            self.run_process("both", shards=2, workers=2)
+
+        # The read stage is timed in the shard processes
+        metrics_filename = os.path.join(self.tmp.name, "shards.jsonl")
+        self.run_process("shards-metrics", shards=2, metrics_filename=metrics_filename)
+        with open(metrics_filename) as read_f:
+            for line in read_f:
+                record = json.loads(line)
+                self.assertGreater(record['seconds']['read'], 0)
+                self.assertGreater(record['cpu_seconds']['parse'], 0)
+
+    def test_compressed_input(self):
+        expected = self.run_process("plain")
+        os.mkdir("compressed")
+        for (day, (extension, opener)) in zip((1, 2, 3), ((".gz", gzip.open), (".bz2", bz2.open), (".xz", lzma.open))):
+            with open("gps_201610%02d.text" % day, "rb") as read_f, \
+                 opener(os.path.join("compressed", "gps_201610%02d.text%s" % (day, extension)), "wb") as write_f:
+                write_f.write(read_f.read())
+        os.chdir("compressed")
+        try:
+            for pipeline in (False, True):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    main.process(**self.kwargs, pipeline=pipeline)
+                self.assertSameOutput(expected, {day: dict(np.load("201610%02d-data.npz" % day)) for day in (1, 2, 3)})
+        finally:
+            os.chdir(self.tmp.name)
+
+    def test_reduce(self):
+        expected = self.run_process("plain")
+        self.run_process("raw", codec="npz", sparse=False)
+        self.run_process("sparse", sparse=True)
+        dates = [(2016, 10, day) for day in (1, 2, 3)]
+        for (directory, workers) in (("plain", 1), ("raw", 2), ("sparse", 3)):
+            out_dir = "reduced-" + directory
+            saved = script_reduce.reduce_days(dates, data_dir=directory, out_dir=out_dir, by="month", workers=workers)
+            self.assertEqual(saved, [os.path.join(out_dir, "201610-sum.npz")])
+            with np.load(saved[0]) as data:
+                self.assertEqual(int(data['days']), 3)
+                for key in script_reduce.KEYS:
+                    self.assertEqual(data[key].dtype, np.float64 if key == 'trips' else np.int64)
+                    self.assertTrue(np.array_equal(data[key], sum(expected[day][key].astype(data[key].dtype) for day in expected)), key)
+
+            saved = script_reduce.reduce_days(dates, data_dir=directory, out_dir=out_dir, by="range", mode="concat", workers=workers)
+            self.assertEqual(sorted(saved), sorted(os.path.join(out_dir, "20161001-20161003-%s.npy" % key) for key in script_reduce.KEYS))
+            vdata = np.load(os.path.join(out_dir, "20161001-20161003-vdata.npy"), mmap_mode="r")
+            fdata = np.load(os.path.join(out_dir, "20161001-20161003-fdata.npy"), mmap_mode="r")
+            trips = np.load(os.path.join(out_dir, "20161001-20161003-trips.npy"))
+            slots = expected[1]['vdata'].shape[0]
+            for day in (1, 2, 3):
+                start = (day - 1)*slots
+                self.assertTrue(np.array_equal(vdata[start:start + slots], expected[day]['vdata']))
+                self.assertTrue(np.array_equal(fdata[:, start:start + slots], expected[day]['fdata']))
+                self.assertTrue(np.array_equal(trips[day - 1], expected[day]['trips']))
+        # Uncompressed inputs are memory-mapped
+        self.assertIsInstance(script_reduce.load_day(os.path.join("raw", "20161001-data.npz"))['fdata'], np.memmap)
+
+    def test_reduce_by_month(self):
+        self.assertEqual([(label, len(dates)) for (label, dates) in
+                          script_reduce.group_dates(utils.generate_dates(2016, 9, 29, 2016, 11, 3))],
+                         [("201609", 2), ("201610", 31), ("201611", 2)])
+        self.assertEqual(script_reduce.split_runs(list(range(5)), 2), [[0, 1], [2, 3, 4]])
+        self.assertEqual(script_reduce.split_runs(list(range(2)), 4), [[0], [1]])
+        # About one run per worker, but at least one per group
+        runs = script_reduce.plan_runs([list(range(30)), list(range(31)), list(range(2))], 4)
+        self.assertEqual([index for (index, _) in runs], [0, 1, 2])
+        runs = script_reduce.plan_runs([list(range(30)), list(range(30))], 8)
+        self.assertEqual(len(runs), 8)
+        self.assertEqual([day for (index, run) in runs if index == 1 for day in run], list(range(30)))
+
+class BackgroundTest(ut.TestCase):
+    def test_prefetch_reader(self):
+        text = "".join("line %d\n" % ii for ii in range(1000))
+        for (block_size, depth, size) in ((7, 1, 100), (100, 3, 7), (1 << 20, 2, 1 << 20)):
+            with background.PrefetchReader(io.StringIO(text), block_size=block_size, depth=depth) as read_f:
+                self.assertEqual([lines for (lines, _) in utils.read_chunks(read_f, chunk_size=size)][-1][-1], "line 999")
+            read_f = background.PrefetchReader(io.StringIO(text), block_size=block_size, depth=depth)
+            self.assertEqual(read_f.read(5), "line ")
+            self.assertEqual(read_f.read(), text[5:])
+            self.assertEqual(read_f.read(10), "")
+            read_f.close()
+        # Closing early doesn't hang
+        background.PrefetchReader(io.StringIO(text), block_size=3, depth=1).close()
+
+    def test_ordered_worker(self):
+        done = []
+        with background.OrderedWorker(depth=2) as worker:
+            for ii in range(10):
+                worker.submit(done.append, ii)
+        self.assertEqual(done, list(range(10)))
+
+        def fail():
+            raise IOError("disk full")
+        with self.assertRaises(IOError):
+            with background.OrderedWorker() as worker:
+                worker.submit(fail)
+                worker.submit(done.append, 10)
+                worker.submit(done.append, 11)
+
+class WritersTest(ut.TestCase):
+    def test_save_arrays(self):
+        arrays = {'vdata': np.arange(24, dtype=np.int16).reshape(2, 3, 4), 'errors': np.array([1, 2])}
+        with tempfile.TemporaryDirectory() as directory:
+            for codec in sorted(writers.CODECS):
+                for level in (None, 1):
+                    filename = os.path.join(directory, "%s-%s.npz" % (codec, level))
+                    if level is not None and codec not in writers.LEVELED_CODECS:
+                        with self.assertRaises(ValueError):
+                            writers.save_arrays(filename, arrays, codec=codec, level=level)
+                        continue
+                    writers.save_arrays(filename, arrays, codec=codec, level=level)
+                    with np.load(filename) as data:
+                        self.assertEqual(sorted(data), sorted(arrays))
+                        for name in arrays:
+                            self.assertEqual(data[name].dtype, arrays[name].dtype)
+                            self.assertTrue(np.array_equal(data[name], arrays[name]))
+            with self.assertRaises(ValueError):
+                writers.save_arrays(os.path.join(directory, "x.npz"), arrays, codec="gzip")
+
+            os.mkdir(os.path.join(directory, "compare"))
+            results = writers.compare_codecs(arrays, directory=os.path.join(directory, "compare"), levels=(1, 9))
+            self.assertEqual(sorted((result['codec'], str(result['level'])) for result in results),
+                             [("npz", "None"), ("npz-bz2", "1"), ("npz-bz2", "9"), ("npz-chunked", "1"),
+                              ("npz-chunked", "9"), ("npz-lzma", "None"), ("npz-zlib", "1"), ("npz-zlib", "9")])
+            self.assertTrue(all(result['bytes'] > 0 for result in results))
+            self.assertEqual(os.listdir(os.path.join(directory, "compare")), [])
+
+class ChunkStoreTest(ut.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.fdata = np.random.RandomState(0).randint(0, 3, size=(2, 10, 3, 4, 3, 4)).astype(np.int16)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        for (time_chunk, by_origin) in ((4, False), (3, True), (20, False)):
+            filename = os.path.join(self.tmp.name, "%d-%s.fchunks" % (time_chunk, by_origin))
+            chunkstore.save_chunked(filename, self.fdata, time_chunk=time_chunk, by_origin=by_origin, workers=2)
+            array = chunkstore.ChunkedArray(filename)
+            self.assertEqual(array.shape, self.fdata.shape)
+            self.assertEqual(array.dtype, self.fdata.dtype)
+            self.assertEqual(len(array.chunks), -(-10 // time_chunk) * (12 if by_origin else 1))
+            self.assertTrue(np.array_equal(np.asarray(array), self.fdata))
+            for key in (np.s_[:, 2:7], np.s_[1, 9], np.s_[:, -3:, 1], np.s_[:, ::-3, 0:2, 1:4, 2],
+                        np.s_[..., 1, 1], np.s_[:, 5:5], np.s_[0, 1:8:2, 2, 3]):
+                self.assertTrue(np.array_equal(array[key], self.fdata[key]))
+            with self.assertRaises(IndexError):
+                array[:, 10]
+
+    def test_partial_read(self):
+        filename = os.path.join(self.tmp.name, "fdata.fchunks")
+        chunkstore.save_chunked(filename, self.fdata, time_chunk=2, by_origin=True)
+        array = chunkstore.ChunkedArray(filename)
+        # Corrupt every chunk but those of t in [4, 6) and origin (1, 2)
+        with open(filename, "r+b") as write_f:
+            for (t0, t1, x, y, offset, length) in array.chunks:
+                if (t0, x, y) != (4, 1, 2):
+                    write_f.seek(offset)
+                    write_f.write(b"\0" * length)
+        self.assertTrue(np.array_equal(array[:, 4:6, 1, 2], self.fdata[:, 4:6, 1, 2]))
+        with self.assertRaises(Exception):
+            array[:, 3:6, 1, 2]
+
+    def test_append(self):
+        filename = os.path.join(self.tmp.name, "fdata.fchunks")
+        for by_origin in (False, True):
+            chunkstore.save_chunked(filename, self.fdata[:, :4], time_chunk=2, by_origin=by_origin)
+            self.assertEqual(chunkstore.append_chunked(filename, self.fdata[:, 4:8]), (2, 8, 3, 4, 3, 4))
+            chunkstore.append_chunked(filename, self.fdata[:, 8:], workers=1)
+            self.assertTrue(np.array_equal(chunkstore.ChunkedArray(filename)[...], self.fdata))
+        with self.assertRaises(ValueError):
+            chunkstore.append_chunked(filename, self.fdata[:, :2, :2])
+        # A partial last chunk can't be appended to
+        chunkstore.save_chunked(filename, self.fdata[:, :3], time_chunk=2)
+        with self.assertRaises(ValueError):
+            chunkstore.append_chunked(filename, self.fdata[:, 3:])
+        self.assertTrue(np.array_equal(chunkstore.ChunkedArray(filename)[...], self.fdata[:, :3]))
+
+    def test_not_chunked(self):
+        filename = os.path.join(self.tmp.name, "fdata.npy")
+        np.save(filename, self.fdata)
+        with self.assertRaises(ValueError):
+            chunkstore.ChunkedArray(filename)
+
+class ShardingTest(ut.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, "gps_20161001.text")
+        script_benchmark.write_gps_day(self.filename, 2016, 10, 1, orders=300, max_pings=20, bad_fraction=0.02, seed=3)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def sequential_entries(self):
+        with utils.open_text(self.filename) as read_f:
+            read_f.readline()
+            return sharding._parse_chunks(utils.read_chunks(read_f, chunk_size=1000), True, 4, utils.TZ_OFFSET)
+
+    def test_order_offsets(self):
+        ranges = sharding.order_offsets(self.filename, 4)
+        self.assertEqual(len(ranges), 4)
+        with open(self.filename, "rb") as read_f:
+            data = read_f.read()
+        self.assertEqual(ranges[0][0], data.index(b"\n") + 1)
+        self.assertEqual(ranges[-1][1], len(data))
+        for ((_, end), (start, _)) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            previous = data[:start - 1].rsplit(b"\n", 1)[-1]
+            line = data[start:].split(b"\n", 1)[0]
+            self.assertNotEqual(sharding._key_bytes(previous), sharding._key_bytes(line))
+
+    def test_parse_file(self):
+        (entries, unparsable_lines, line_count) = self.sequential_entries()
+        results = sharding.parse_file(self.filename, shards=3, chunk_size=1000)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(list(np.concatenate([result[0]['id'] for result in results])), list(entries['id']))
+        self.assertTrue(np.array_equal(np.concatenate([result[0]['timestamp'] for result in results]), entries['timestamp']))
+        self.assertEqual(sum(len(result[1]) for result in results), len(unparsable_lines))
+        self.assertEqual(sum(result[2] for result in results), line_count)
+
+        # In a pool that is kept for the next file, with the processes' times
+        times = metrics.StageTimes()
+        with multiprocessing.Pool(2) as pool:
+            for _ in range(2):
+                results = sharding.parse_file(self.filename, shards=2, chunk_size=1000, pool=pool, times=times)
+                self.assertEqual(list(np.concatenate([result[0]['id'] for result in results])), list(entries['id']))
+        self.assertEqual(sorted(times.seconds), ["parse", "read"])
+    def test_unparsable_keys(self):
+        # Lines without driver and order fields don't split an order
+        with open(self.filename) as read_f:
+            lines = read_f.readlines()
+        body = []
+        for (ii, line) in enumerate(lines[1:]):
+            body.append(line)
+            if ii % 3 == 0:
+                body.append("garbage\n")
+        with open(self.filename, "w") as write_f:
+            write_f.writelines(lines[:1] + body)
+        (entries, unparsable_lines, line_count) = self.sequential_entries()
+        for shards in (3, 8, 16):
+            results = sharding.parse_file(self.filename, shards=shards, chunk_size=1000)
+            self.assertEqual(list(np.concatenate([result[0]['id'] for result in results])), list(entries['id']))
+            self.assertEqual(sum(len(result[1]) for result in results), len(unparsable_lines))
+            self.assertFalse(any(index is None for result in results for index in result[1]))
+
+    def test_unsorted(self):
+        with open(self.filename) as read_f:
+            lines = read_f.readlines()
+        body = lines[1:]
+        random.Random(0).shuffle(body)
+        with open(self.filename, "w") as write_f:
+            write_f.writelines(lines[:1] + body)
+        self.assertFalse(sharding.is_sorted([self.sequential_entries()]))
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = sharding.parse_file(self.filename, shards=3, V=True)
+        ids = [key for result in results for key in result[0]['id']]
+        # One entry per order (but the last line's)
+        self.assertEqual(len(set(ids[:-1])), len(ids) - 1)
+        self.assertEqual(sum(result[2] for result in results), len(body))
+        self.assertTrue(all(index is None for result in results for index in result[1]))
+        self.assertFalse(any(name.startswith("partitions-") for name in os.listdir(self.tmp.name)))
+
+    def test_is_plain(self):
+        self.assertTrue(sharding.is_plain(self.filename))
+        with open(self.filename, "rb") as read_f, gzip.open(self.filename + ".gz", "wb") as write_f:
+            write_f.write(read_f.read())
+        self.assertFalse(sharding.is_plain(self.filename + ".gz"))
+
+class DownsampleTest(ut.TestCase):
+    def test_block_sum(self):
+        array = np.arange(4*6*2).reshape(4, 6, 2)
+        result = script_downsample.block_sum(array, (2, 3))
+        self.assertEqual(result.shape, (2, 2, 2))
+        self.assertEqual(result[1, 0, 1], array[2:4, 0:3, 1].sum())
+        with self.assertRaises(ValueError):
+            script_downsample.block_sum(array, (3,))
+        with self.assertRaises(ValueError):
+            script_downsample.downsample_vdata(np.full((2, 2, 2, 2), 30000, dtype=np.int16), 2, 1, 1)
+
+    def test_iter_loaded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filenames = [os.path.join(directory, "%d.npz" % ii) for ii in range(5)]
+            for (ii, filename) in enumerate(filenames):
+                np.savez(filename, value=np.array(ii))
+            self.assertEqual([int(data['value']) for (_, data) in script_downsample.iter_loaded(filenames, buffer=2)],
+                             list(range(5)))
+            # Stopping early doesn't hang
+            for (_, data) in script_downsample.iter_loaded(filenames, buffer=1):
+                break
+            with self.assertRaises(FileNotFoundError):
+                list(script_downsample.iter_loaded(filenames + [os.path.join(directory, "missing.npz")]))
+
+class TripTableTest(ut.TestCase):
+    def test_add(self):
+        table = triptable.TripTable()
+        self.assertEqual(len(table), 0)
+        self.assertEqual(len(table.columns()['valid']), 0)
+        start = utils.Entry(id="a", lon=104.0, lat=30.6, timestamp=1475251200)
+        end = utils.Entry(id="b", lon=104.1, lat=30.7, timestamp=1475251800)
+        table.add_one(start, end, True)
+        table.add({'timestamp': np.array([1, 2]), 'lon': np.array([1.0, 2.0]), 'lat': np.array([3.0, 4.0])},
+                  {'timestamp': np.array([5, 6]), 'lon': np.array([5.0, 6.0]), 'lat': np.array([7.0, 8.0])},
+                  np.array([False, True]))
+        table.add_one(end, start, False)
+        self.assertEqual(len(table), 4)
+        columns = table.columns()
+        self.assertEqual(columns['start_timestamp'].tolist(), [1475251200, 1, 2, 1475251800])
+        self.assertEqual(columns['end_lat'].tolist(), [30.7, 7.0, 8.0, 30.6])
+        self.assertEqual(columns['valid'].tolist(), [True, False, True, False])
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = triptable.trips_filename(2016, 10, 1, directory=directory)
+            self.assertTrue(filename.endswith("20161001-trips.npz"))
+            triptable.save_trips(filename, columns, unparsable=3, tz_offset=0)
+            (loaded, unparsable, tz_offset) = triptable.load_trips(filename)
+            self.assertEqual((unparsable, tz_offset), (3, 0))
+            for name in triptable.COLUMNS:
+                self.assertTrue(np.array_equal(loaded[name], columns[name]))
+
+class BenchmarkTest(ut.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        self.lines = script_benchmark.write_gps_day(os.path.join(self.tmp.name, "gps_20161001.text"),
+                                                    2016, 10, 1, orders=300, max_pings=10)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_run_once(self):
+        results = [script_benchmark.run_once(self.tmp.name, (2016, 10, 1), engine=engine, width=4, height=5, n=2)
+                   for engine in ("numpy", "line")]
+        for result in results:
+            self.assertEqual(result['lines'], self.lines)
+            self.assertEqual(sorted(result['stages']), sorted(script_benchmark.STAGES))
+            self.assertGreater(result['saved_bytes'], 0)
+        self.assertEqual(results[0]['trips'], results[1]['trips'])
+        self.assertEqual(os.listdir(self.tmp.name), ["gps_20161001.text"])
+
 all_tests = [GPSUtilsTest,
+             GPSUtilsArrayTest,
              UtilsMiscTest,
              UtilsProcessEntryTest,
-             UtilsUpdateDataTest]
+             UtilsUpdateDataTest,
+             UtilsReadChunksTest,
+             UtilsParseLinesTest,
+             UtilsEntryTest,
+             UtilsTripKeyTest,
+             UtilsTimeTest,
+             UtilsCheckValidBulkTest,
+             GridIndexTest,
+             SparseFlowTest,
+             UtilsUpdateDataBulkTest,
+             UtilsCompileArraysTest,
+             PipelineTest,
+             MainProcessTest,
+             TripTableTest,
+             BackgroundTest,
+             WritersTest,
+             ChunkStoreTest,
+             ShardingTest,
+             DownsampleTest,
+             BenchmarkTest]
 
 for test in all_tests:
     ut.TextTestRunner(verbosity=2).run(ut.TestLoader().loadTestsFromTestCase(test))
@@ -0,0 +1,123 @@
+''' Per-day tables of the trips extracted from the GPS data.
+
+Parsing the GPS text is by far the slowest part of main.py, and its
+result (the trips) doesn't depend on the grid. main.py --savetrips saves
+the trips of each day to YYYYMMDD-trips.npz, one array per column:
+
+    start_timestamp, end_timestamp: int64 epoch seconds
+    start_lon, start_lat, end_lon, end_lat: float64
+    valid: bool, the result of utils.check_valid
+
+along with 'unparsable' (the count of unparsable lines) and 'tz_offset'.
+grid_trips then builds vdata and fdata for any (w, h, n) from them.
+(See script_grid.py.)
+'''
+
+import os
+import numpy as np
+import utils
+from GPSUtils import pgps_to_xy_array
+
+COLUMNS = ('start_timestamp', 'end_timestamp', 'start_lon', 'start_lat', 'end_lon', 'end_lat', 'valid')
+DTYPES = {'start_timestamp': np.int64, 'end_timestamp': np.int64,
+          'start_lon': np.float64, 'start_lat': np.float64,
+          'end_lon': np.float64, 'end_lat': np.float64,
+          'valid': bool}
+
+class TripTable:
+    ''' Accumulates the trips of a day as columns (see COLUMNS).
+
+    Use add for columnar batches (the numpy engine), and add_one for
+    single trips (the line engine). Trips keep the order they are added in.
+    '''
+    def __init__(self):
+        self._chunks = []
+        self._rows = []
+
+    def add(self, start_entries, entries, valid):
+        ''' Adds a batch of trips, from the columnar entry dicts of their
+            starts and ends (see utils.make_entries) and a boolean array.'''
+        self._flush_rows()
+        self._chunks.append({'start_timestamp': start_entries['timestamp'],
+                             'end_timestamp': entries['timestamp'],
+                             'start_lon': start_entries['lon'],
+                             'start_lat': start_entries['lat'],
+                             'end_lon': entries['lon'],
+                             'end_lat': entries['lat'],
+                             'valid': valid})
+
+    def add_one(self, start_entry, entry, valid):
+        ''' Adds one trip, from the utils.Entry of its start and end.'''
+        self._rows.append((start_entry.timestamp, entry.timestamp,
+                           start_entry.lon, start_entry.lat, entry.lon, entry.lat, valid))
+
+    def _flush_rows(self):
+        if self._rows:
+            self._chunks.append({name: np.array(column, dtype=DTYPES[name])
+                                 for (name, column) in zip(COLUMNS, zip(*self._rows))})
+            self._rows = []
+
+    def columns(self):
+        ''' Returns the trips as a dict of arrays, one per column.'''
+        self._flush_rows()
+        return {name: np.concatenate([np.zeros(0, dtype=DTYPES[name])] +
+                                     [np.asarray(chunk[name], dtype=DTYPES[name]) for chunk in self._chunks])
+                for name in COLUMNS}
+
+    def __len__(self):
+        return sum(len(chunk['valid']) for chunk in self._chunks) + len(self._rows)
+
+def trips_filename(year, month, day, directory="."):
+    ''' The file main.py --savetrips saves the trips of a day to.'''
+    return os.path.join(directory, f"{year:04}"+f"{month:02}"+f"{day:02}" + "-trips.npz")
+
+def save_trips(filename, columns, unparsable=0, tz_offset=utils.TZ_OFFSET):
+    ''' Saves a dict of trip columns (see TripTable.columns) to filename,
+        replacing it atomically.'''
+    np.savez(filename + ".tmp.npz", **columns, unparsable=np.int64(unparsable), tz_offset=np.int64(tz_offset))
+    os.replace(filename + ".tmp.npz", filename)
+
+def load_trips(filename):
+    ''' Loads a file saved by save_trips.
+        Returns (columns, unparsable, tz_offset).'''
+    with np.load(filename) as data:
+        columns = {name: data[name] for name in COLUMNS}
+        return columns, int(data['unparsable']), int(data['tz_offset'])
+
+def _endpoint_entries(timestamp, lon, lat, n, tz_offset):
+    ''' The columns of utils.make_entries that update_data_bulk uses.'''
+    (x, y) = pgps_to_xy_array(lon, lat)
+    fields = utils.time_fields(timestamp, n=n, tz_offset=tz_offset)
+    return {'lon': lon, 'lat': lat, 'x': x, 'y': y, 't': fields['t'], 'day': fields['day']}
+
+def grid_trips(columns, w=10, h=20, n=4, tz_offset=utils.TZ_OFFSET, sparse=False, grid=None):
+    ''' Builds the arrays main.process_one_day would, from the trips
+        of one day.
+
+    Returns (vdata, fdata, vdata_next_mo, fdata_next_mo, trips, errors),
+    except that errors[1] (unparsable lines) is 0; take it from the file.
+
+    # Arguments:
+        columns: Dict of trip columns, e.g. from load_trips.
+        w, h, n: The grid size and time slots per hour.
+        tz_offset: The offset from UTC the trips were extracted with.
+        sparse: Boolean; if True, fdata is a SparseFlow.
+        grid: Optional gridindex.GridIndex for a w x h grid.
+    '''
+    vdata = utils.gen_empty_vdata(w=w, h=h, n=n)
+    fdata = utils.gen_empty_fdata(w=w, h=h, n=n, sparse=sparse)
+    vdata_next_mo = utils.gen_empty_vdata(w=w, h=h, n=n)
+    fdata_next_mo = utils.gen_empty_fdata(w=w, h=h, n=n, sparse=sparse)
+    trips = np.zeros((2, 2))
+
+    valid = columns['valid']
+    start_entries = _endpoint_entries(columns['start_timestamp'][valid], columns['start_lon'][valid],
+                                      columns['start_lat'][valid], n, tz_offset)
+    entries = _endpoint_entries(columns['end_timestamp'][valid], columns['end_lon'][valid],
+                                columns['end_lat'][valid], n, tz_offset)
+    utils.update_data_bulk(entries=entries, start_entries=start_entries,
+                           vdata=vdata, fdata=fdata,
+                           vdata_next_mo=vdata_next_mo, fdata_next_mo=fdata_next_mo,
+                           trips=trips, w=w, h=h, n=n, grid=grid)
+    errors = np.array([int(np.count_nonzero(~valid)), 0])
+    return (vdata, fdata, vdata_next_mo, fdata_next_mo, trips, errors)
@@ -1,63 +1,370 @@
 ''' A number of functions used in main.py to process the data.'''
 
 import regex as re
-from datetime import datetime
-from GPSUtils import pgps_to_xy, gps_distance
-from math import floor
+from datetime import date
+from GPSUtils import pgps_to_xy, gps_distance, pgps_to_xy_array, gps_distance_array
+from sparseflow import SparseFlow
+from chunkstore import ChunkedArray
+from math import floor, isfinite
 import numpy as np
+import os
+import zipfile
+import gzip
+import bz2
+import lzma
 
 def get_t(hour, minute, n=4):
     ''' Returns the sample numbr given the day, hour, and minute.
     Day is 1-indexed, hour and minute is 0 indexed.'''
     return floor( ((hour*60) + minute)/floor((60/n)) )
 
-def process_entry(line, start_entry, n=4, is_last=False):
+# The GPS timestamps are seconds since the epoch (UTC). Days and time
+# slots are counted in local time: China Standard Time for the DiDi data.
+TZ_OFFSET = 8*60*60
+
+# Timestamps outside this range can't be parsed; as for datetime, the
+# local date must fall in the years 1 to 9999 for any offset of a day or less.
+MIN_TIMESTAMP = -62135596800 + 86400
+MAX_TIMESTAMP = 253402300800 - 86400 - 1
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def check_timestamp(timestamp):
+    ''' Raises a ValueError if timestamp is out of range.'''
+    if not MIN_TIMESTAMP <= timestamp <= MAX_TIMESTAMP:
+        raise ValueError("Timestamp out of range: " + str(timestamp))
+
+def check_coordinates(lon, lat):
+    ''' Raises a ValueError if lon or lat is infinite or NaN.'''
+    if not (isfinite(lon) and isfinite(lat)):
+        raise ValueError("Coordinates not finite: %r, %r" % (lon, lat))
+
+def local_time(timestamp, tz_offset=TZ_OFFSET):
+    ''' Returns (year, month, day, hour, minute, second) for the given
+        epoch seconds, at tz_offset seconds from UTC.'''
+    check_timestamp(timestamp)
+    (days, seconds) = divmod(timestamp + tz_offset, 86400)
+    local_date = date.fromordinal(_EPOCH_ORDINAL + days)
+    return (local_date.year, local_date.month, local_date.day,
+            seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+def timestamp_to_slot(timestamp, n=4, tz_offset=TZ_OFFSET):
+    ''' Vectorized day and time slot of an int64 array of epoch seconds,
+        at tz_offset seconds from UTC. Returns (days, t): the local day,
+        counted from 1970-01-01, and the slot in that day (as get_t).'''
+    (days, seconds) = np.divmod(np.asarray(timestamp, dtype=np.int64) + tz_offset, 86400)
+    return days, (seconds // 60) // (60 // n)
+
+def time_fields(timestamp, n=4, tz_offset=TZ_OFFSET):
+    ''' Vectorized version of local_time and get_t. Returns a dict of
+        int64 arrays: 'year', 'month', 'day', 'hour', 'min', 'sec' and
+        't', as in the entries of process_entry.'''
+    (days, t) = timestamp_to_slot(timestamp, n=n, tz_offset=tz_offset)
+    seconds = np.asarray(timestamp, dtype=np.int64) + tz_offset - days*86400
+    dates = days.astype("datetime64[D]")
+    months = dates.astype("datetime64[M]")
+    return {
+        'year'  : dates.astype("datetime64[Y]").astype(np.int64) + 1970,
+        'month' : months.astype(np.int64) % 12 + 1,
+        'day'   : (dates - months).astype(np.int64) + 1,
+        'hour'  : seconds // 3600,
+        'min'   : (seconds % 3600) // 60,
+        'sec'   : seconds % 60,
+        't'     : t,
+    }
+
+# The driver and order fields of the DiDi data are 32-digit hex hashes
+_hex_hash = re.compile("[0-9a-f]{32}")
+
+def trip_key(driver, order):
+    ''' The 'id' of an entry, given its driver and order fields.
+
+    The usual 32-digit hex hashes are packed into 32 bytes (two 128-bit
+    values). Anything else is kept as the string driver + "_" + order,
+    so different fields always give different keys.
+    '''
+    if _hex_hash.fullmatch(driver) and _hex_hash.fullmatch(order):
+        return bytes.fromhex(driver + order)
+    return driver + "_" + order
+
+def key_prefix(line):
+    ''' The start of line, up to and including its second comma: its
+        driver and order fields. Any other line that starts with it
+        has the same 'id' (see process_entry).'''
+    second_comma = line.find(",", line.find(",") + 1)
+    return line[:second_comma + 1] if second_comma > 0 else None
+
+def driver_codes(ids):
+    ''' Dictionary-encodes the drivers of a sequence of entry 'id's,
+        e.g. to count trips per driver with np.bincount.
+
+    Returns (codes, drivers): an int32 array with the index into drivers
+    of each id's driver (16 bytes), or -1 if the id isn't packed (see
+    trip_key).
+    '''
+    drivers = {}
+    codes = np.array([drivers.setdefault(key[:16], len(drivers)) if isinstance(key, bytes) else -1
+                      for key in ids], dtype=np.int32)
+    return codes, list(drivers)
+
+class Entry:
+    ''' One parsed line of the GPS file, as returned by process_entry.
+
+    A slotted record with the fields of ENTRY_FIELDS. The fields can
+    also be read by name, as entry['x'], like the dicts it replaces.
+    (Batches of entries are dicts of arrays instead; see make_entries.)
+    '''
+    __slots__ = ('id', 'lon', 'lat', 'x', 'y', 't', 'timestamp',
+                 'year', 'month', 'day', 'hour', 'min', 'sec')
+
+    def __init__(self, id=None, lon=None, lat=None, x=None, y=None, t=None, timestamp=None,
+                 year=None, month=None, day=None, hour=None, min=None, sec=None):
+        self.id = id
+        self.lon = lon
+        self.lat = lat
+        self.x = x
+        self.y = y
+        self.t = t
+        self.timestamp = timestamp
+        self.year = year
+        self.month = month
+        self.day = day
+        self.hour = hour
+        self.min = min
+        self.sec = sec
+
+    def __getitem__(self, name):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __eq__(self, other):
+        if not isinstance(other, Entry):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return "Entry(" + ", ".join("%s=%r" % (name, getattr(self, name)) for name in self.__slots__) + ")"
+
+    def as_dict(self):
+        ''' The fields as a dict.'''
+        return {name: getattr(self, name) for name in self.__slots__}
+
+ENTRY_FIELDS = Entry.__slots__
+
+def process_entry(line, start_entry, n=4, is_last=False, tz_offset=TZ_OFFSET):
     ''' Given string line from the .csv,
-        return a dict representing that entry. '''
+        return (entry, True), where entry is an Entry, or (None, False)
+        if the line has the same id as start_entry.
+        Times are local, at tz_offset seconds from UTC. '''
     entry_strings = line.strip().replace("[", "").replace("]", "").replace("'", "").split(",")
     
-    id = entry_strings[0].strip() + "_" + entry_strings[1].strip()
+    id = trip_key(entry_strings[0].strip(), entry_strings[1].strip())
 
-    if id == start_entry['id'] and not is_last:
-        return ({}, False)
+    if id == start_entry.id and not is_last:
+        return (None, False)
 
-    # Parse the times using datetime
+    # Parse the times
     timestamp = int(entry_strings[2].strip())
-    time = datetime.fromtimestamp(timestamp)
+    (year, month, day, hour, minute, second) = local_time(timestamp, tz_offset=tz_offset)
     
     # Starting and ending GPS coordinates
     lon = float(entry_strings[3].strip())
     lat = float(entry_strings[4].strip())
+    check_coordinates(lon, lat)
     
     # Starting and ending grid coordinates and straight-line (l2) distance
     # Warning: Uses prebaked Manhattan values.
     x, y = pgps_to_xy(lon, lat)
     # Get the starting and ending times
-    t = get_t( hour   = time.hour,
-               minute = time.minute,
+    t = get_t( hour   = hour,
+               minute = minute,
                n      = n)
     
     # Convention:
     # 's' stands for 'start', 'e' stands for 'end',
     # 'x' and 'y' stand for x/y coordinates respectively,
     # 't' stands for time slot or seconds.
-    entry = {
-        'id': id,
+    entry = Entry(id, lon, lat, x, y, t, timestamp,
+                  year, month, day, hour, minute, second)
+    
+    return (entry, True)
+
+# Characters removed from each line before splitting, as in process_entry
+_strip_table = str.maketrans("", "", "[]'")
+
+def _equal_ranges(buf, first, second, length):
+    ''' For each i, whether buf[first[i]:first[i]+length[i]] equals
+        buf[second[i]:second[i]+length[i]], for a uint8 array buf.
+        Compares 8 bytes at a time.'''
+    equal = np.ones(len(length), dtype=bool)
+    if len(length) == 0 or length.max() == 0:
+        return equal
+    padded = np.concatenate((buf, np.zeros(8, dtype=np.uint8)))
+    # words[i] holds the 8 bytes starting at buf[i]
+    words = np.ndarray(shape=(len(buf) + 1,), dtype="<u8", buffer=padded, strides=(1,))
+    # Ranges shorter than a word only compare their own bytes
+    mask = np.full(len(length), ~np.uint64(0))
+    short = length < 8
+    mask[short] = (np.uint64(1) << (8*length[short]).astype(np.uint64)) - np.uint64(1)
+    for offset in range(0, int(length.max()), 8):
+        # The last word of a range may overlap the one before it
+        at = np.maximum(np.minimum(offset, length - 8), 0)
+        equal &= ((words[first + at] ^ words[second + at]) & mask) == 0
+    return equal
+
+def parse_lines(lines):
+    ''' Vectorized first pass of the parsing done in process_entry.
+
+    Given a list of lines from the GPS file, returns a dict with:
+        'lines': The lines.
+        'nfields': Number of comma-separated fields on each line.
+        'same_key': Boolean array; True if the line starts with exactly
+            the same bytes as the line before, up to its second comma.
+            process_entry would then give both lines the same 'id'.
+        'rows': Cache of the lines parsed in full (see _parse_row).
+    Most lines continue the trip of the line before them, so only the
+    other lines are parsed in full, by find_boundaries and make_entries.
+    '''
+    N = len(lines)
+    nfields = np.ones(N, dtype=np.int64)
+    same_key = np.zeros(N, dtype=bool)
+    if N > 0:
+        buf = np.frombuffer(("\n".join(lines) + "\n").encode("UTF-8"), dtype=np.uint8)
+        ends = np.flatnonzero(buf == ord("\n"))
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        commas = np.flatnonzero(buf == ord(","))
+        first = np.searchsorted(commas, starts)
+        nfields = np.searchsorted(commas, ends) - first + 1
+        # The driver and order fields run up to the second comma
+        key_end = ends
+        if len(commas) > 0:
+            key_end = np.where(nfields >= 3, commas[np.minimum(first + 1, len(commas) - 1)], ends)
+        key_length = key_end - starts
+        same_key[1:] = ((key_length[1:] == key_length[:-1])
+                        & _equal_ranges(buf, starts[:-1], starts[1:], key_length[1:]))
+
+    return {
+        'lines': lines,
+        'nfields': nfields,
+        'same_key': same_key,
+        'rows': {},
+    }
+
+def _parse_row(batch, row):
+    ''' Parses line row of a batch as process_entry does.
+
+    Returns (key, values): key is None if the line has no 'id' (fewer
+    than two fields), and values is (timestamp, lon, lat), or None if
+    process_entry fails to parse the rest of the line.
+    '''
+    if row not in batch['rows']:
+        fields = batch['lines'][row].strip().translate(_strip_table).split(",")
+        key = None
+        values = None
+        if len(fields) >= 2:
+            key = trip_key(fields[0].strip(), fields[1].strip())
+            try:
+                timestamp = int(fields[2].strip())
+                check_timestamp(timestamp)
+                (lon, lat) = (float(fields[3].strip()), float(fields[4].strip()))
+                check_coordinates(lon, lat)
+                values = (timestamp, lon, lat)
+            except (IndexError, ValueError):
+                pass
+        batch['rows'][row] = (key, values)
+    return batch['rows'][row]
+
+def find_boundaries(batch, start_key, is_last=False):
+    ''' Finds the lines of a batch that process_entry would return as a
+        new entry, or fail to parse.
+
+    Only the lines whose key bytes differ from the line before (see
+    parse_lines) can do either, so only those are parsed; the rest are
+    skipped, as process_entry skips lines with the current 'id'.
+
+    # Arguments:
+        batch: Dict, as returned by parse_lines.
+        start_key: The 'id' of the current start entry
+            (carried over from the previous batch).
+        is_last: Boolean; True if the batch ends the file.
+    # Returns:
+        (boundary, unparsable, start_key): Boolean arrays marking the
+            entries and the lines that process_entry fails to parse,
+            and the start key to carry over to the next batch.
+    '''
+    N = len(batch['lines'])
+    boundary = np.zeros(N, dtype=bool)
+    unparsable = np.zeros(N, dtype=bool)
+    candidate = ~batch['same_key'] | (batch['nfields'] < 2)
+    if is_last and N > 0:
+        candidate[-1] = True # The final line always ends the current trip
+
+    for row in np.flatnonzero(candidate).tolist():
+        while True:
+            (key, values) = _parse_row(batch, row)
+            if key is None:
+                unparsable[row] = True
+            elif key != start_key or (is_last and row == N - 1):
+                if values is not None:
+                    boundary[row] = True
+                    start_key = key
+                else:
+                    unparsable[row] = True
+                    # The start entry didn't change, so the lines after
+                    # this one with the same key aren't skipped either.
+                    if row + 1 < N and not candidate[row + 1]:
+                        row += 1
+                        continue
+            break
+    return boundary, unparsable, start_key
+
+def make_entries(batch, rows, n=4, tz_offset=TZ_OFFSET):
+    ''' Columnar version of the entry dicts built by process_entry.
+        Returns a dict with the same keys, each holding an array
+        with one element per row in rows.'''
+    parsed = [_parse_row(batch, row) for row in rows.tolist()]
+    keys = [key for (key, _) in parsed]
+    values = [values for (_, values) in parsed]
+    timestamp = np.array([value[0] for value in values], dtype=np.int64)
+    lon = np.array([value[1] for value in values], dtype=np.float64)
+    lat = np.array([value[2] for value in values], dtype=np.float64)
+    x, y = pgps_to_xy_array(lon, lat)
+    fields = time_fields(timestamp, n=n, tz_offset=tz_offset)
+    return {
+        'id': _object_array(keys),
         'lon': lon,
         'lat': lat,
         'x' : x,
         'y' : y,
-        't' : t,
+        't' : fields['t'],
         'timestamp': timestamp,
-        'year'  : time.year,
-        'month' : time.month,
-        'day'   : time.day,
-        'hour'  : time.hour,
-        'min'   : time.minute,
-        'sec'   : time.second,
+        'year'  : fields['year'],
+        'month' : fields['month'],
+        'day'   : fields['day'],
+        'hour'  : fields['hour'],
+        'min'   : fields['min'],
+        'sec'   : fields['sec'],
     }
-    
-    return (entry, True)
+
+def _object_array(values):
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+def concat_entries(first, second):
+    ''' Concatenates two columnar entry dicts (see make_entries).'''
+    return {key: np.concatenate((first[key], second[key])) for key in second}
+
+def select_entries(entries, index):
+    ''' Returns the rows of a columnar entry dict selected by index
+        (a slice, an integer array or a boolean mask).'''
+    return {key: column[index] for (key, column) in entries.items()}
+
+def entry_at(entries, index):
+    ''' Returns row index of a columnar entry dict as an Entry.'''
+    row = {key: column[index] for (key, column) in entries.items()}
+    return Entry(**{key: value.item() if isinstance(value, np.generic) else value for (key, value) in row.items()})
 
 def check_valid(entry, start_entry, year, month, day, min_time=59, max_speed=36, min_distance=100):
     ''' Ensure an entry meets these following rules:
@@ -68,14 +375,14 @@ def check_valid(entry, start_entry, year, month, day, min_time=59, max_speed=36,
     
     Returns 'True' if valid, 'False' if not.
     '''
-    if not start_entry['year']  == year:   return False
-    if not start_entry['month'] == month:  return False
-    if not start_entry['day'] == day:  return False
+    if not start_entry.year  == year:   return False
+    if not start_entry.month == month:  return False
+    if not start_entry.day == day:  return False
 
-    l2distance = gps_distance((start_entry['lat'], start_entry['lon']), (entry['lat'], entry['lon']))
+    l2distance = gps_distance((start_entry.lat, start_entry.lon), (entry.lat, entry.lon))
     if not l2distance >= min_distance: return False
 
-    deltat = abs(entry['timestamp'] - start_entry['timestamp'])
+    deltat = abs(entry.timestamp - start_entry.timestamp)
     if not deltat >= min_time: return False
 
     if not (l2distance / deltat) <= max_speed: return False
@@ -83,6 +390,81 @@ def check_valid(entry, start_entry, year, month, day, min_time=59, max_speed=36,
     return True
     
 
+# Compressed formats open_text reads, by their first bytes, and the
+# extensions they are found under
+COMPRESSED_FORMATS = ((b"\x1f\x8b", ".gz", gzip.open),
+                      (b"BZh", ".bz2", bz2.open),
+                      (b"\xfd7zXZ\x00", ".xz", lzma.open))
+
+def open_text(filename, encoding='UTF-8'):
+    ''' Opens a text file for reading. gzip, bzip2 and xz files (told
+        apart by their first bytes, whatever their extension) are
+        decompressed as they are read, so they are never decompressed
+        to disk or held in memory whole.'''
+    with open(filename, "rb") as read_f:
+        magic = read_f.read(6)
+    for (prefix, _, opener) in COMPRESSED_FORMATS:
+        if magic.startswith(prefix):
+            return opener(filename, "rt", encoding=encoding)
+    return open(filename, "r", encoding=encoding)
+
+def read_chunks(read_f, chunk_size=1 << 22):
+    ''' Reads an open text file chunk_size characters at a time.
+
+    Yields (lines, is_last) tuples, where lines is the list of complete
+    lines in the chunk (newlines removed) and is_last is True only for
+    the final chunk of the file. To know which chunk is the last, each
+    one is yielded only once the next has been read, so up to two
+    chunks (plus one partial line) are held in memory at any point.
+    '''
+    tail = ''
+    pending = None
+    while True:
+        block = read_f.read(chunk_size)
+        if not block:
+            break
+        lines = (tail + block).split('\n')
+        tail = lines.pop() # Partial line, completed by the next chunk
+        if not lines:
+            continue
+        if pending is not None:
+            yield (pending, False)
+        pending = lines
+
+    if tail:
+        # The file does not end with a newline
+        pending = (pending or []) + [tail]
+    if pending is not None:
+        yield (pending, True)
+
+def iter_lines(read_f, chunk_size=1 << 22):
+    ''' Streams the lines of an open text file using read_chunks.
+
+    Yields (line, is_last) tuples; is_last is True for the final line
+    of the file, replacing the 'line is lines[-1]' check.
+    '''
+    for (lines, is_last_chunk) in read_chunks(read_f, chunk_size=chunk_size):
+        last_index = len(lines) - 1
+        for (index, line) in enumerate(lines):
+            yield (line, is_last_chunk and index == last_index)
+
+def check_valid_bulk(entries, start_entries, year, month, day, min_time=59, max_speed=36, min_distance=100):
+    ''' Batch version of check_valid, over columnar entry dicts (see
+        make_entries) with one element per trip.
+
+    Returns a boolean array; True where the trip is valid.
+    '''
+    valid = ((start_entries['year'] == year) &
+             (start_entries['month'] == month) &
+             (start_entries['day'] == day))
+
+    l2distance = gps_distance_array(start_entries['lat'], start_entries['lon'], entries['lat'], entries['lon'])
+    deltat = np.abs(entries['timestamp'] - start_entries['timestamp'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # deltat == 0 only fails the min_time rule, never this one
+        speed = l2distance / deltat
+    return valid & (l2distance >= min_distance) & (deltat >= min_time) & (speed <= max_speed)
+
 def generate_dates(start_year = 2010, start_month = 1, start_day = 1, end_year = 2013, end_month = 12, end_day = 30):
     ''' Returns a list of (year, month) tuples from
         (start_year, start_month) to (end_year, end_month), inclusive.'''
@@ -131,17 +513,40 @@ def gen_empty_vdata(w=10, h=20, n=4):
     Used to store volume data, as per the STDN.'''
     return np.zeros((24 * n, w, h, 2), dtype=np.int16)
 
-def gen_empty_fdata(w=10, h=20, n=4):
+def gen_empty_fdata(w=10, h=20, n=4, sparse=False):
     ''' Return an all-zero 'fdata' numpy array.
-    Used to store flow data, as per the STDN.'''
+    Used to store flow data, as per the STDN.
+    If sparse, return an empty SparseFlow of the same shape instead.'''
+    if sparse:
+        return SparseFlow((2, 24 * n, w, h, w, h), dtype=np.int16)
     return np.zeros((2, 24 * n, w, h, w, h), dtype=np.int16)
 
+def fdata_arrays(fdata):
+    ''' Returns a dict of the arrays to save for fdata: {'fdata': fdata},
+        or the index/count arrays of a SparseFlow (see load_fdata).'''
+    if isinstance(fdata, SparseFlow):
+        return fdata.to_arrays("fdata")
+    return {"fdata": fdata}
+
+def load_fdata(data, dense=True, directory="."):
+    ''' Returns the fdata from a loaded -data.npz file, whether it was
+        saved dense, sparse or in chunks (writers' npz-chunked codec).
+        If not dense, a sparse file gives a SparseFlow. directory is the
+        folder of the .npz, where the chunks of npz-chunked are.'''
+    if "fdata" in data:
+        return data["fdata"]
+    if "fdata_chunks" in data:
+        return ChunkedArray(os.path.join(directory, str(data["fdata_chunks"])))[...]
+    fdata = SparseFlow.from_arrays(data, "fdata")
+    return fdata.to_dense() if dense else fdata
+
 def update_data(entry, start_entry, vdata, fdata, vdata_next_mo, fdata_next_mo, trips, w=10, h=20, n=4):
     ''' Updates the given numpy arrays with data from the provided entry.
         Returns nothing.
     
     # Arguments:
-        entry: Dictionary providing pertinent values for a given trip.
+        entry, start_entry: Entry (see process_entry) for the end and
+            the start of a trip.
         vdata, fdata: Numpy arrays representing the volume and flow
             data for a given month.
         vdata_next_mo, fdata_next_mo: Numpy array representing the
@@ -154,17 +559,18 @@ def update_data(entry, start_entry, vdata, fdata, vdata_next_mo, fdata_next_mo,
     '''
     # starts_inside, ends_inside: Booleans.
     # True if the trip starts within Manhattan, false otherwise
-    start_inside = (0 <= start_entry['x'] <= 1) and (0 <= start_entry['y'] <= 1)
-    end_inside = (0 <= entry['x'] <= 1) and (0 <= entry['y'] <= 1)
+    start_inside = (0 <= start_entry.x <= 1) and (0 <= start_entry.y <= 1)
+    end_inside = (0 <= entry.x <= 1) and (0 <= entry.y <= 1)
     
-    starts_and_ends_in_same_day = (start_entry['day'] == entry['day'])
+    starts_and_ends_in_same_day = (start_entry.day == entry.day)
 
     # Variable names:
     #   s/e stands for start/end, g stands for grid, x/y are coordinates
-    sgx = floor(start_entry['x']*w) #start-x, mapped to grid coordinates
-    sgy = floor(start_entry['y']*h) #start-y, mapped to grid coordinates
-    egx = floor(entry['x']*w) #end-x, mapped to grid coordinates
-    egy = floor(entry['y']*h) #end-y, mapped to grid coordinates
+    #   (x or y == 1 is on the far edge of the grid, so it goes in the last cell.)
+    sgx = min(floor(start_entry.x*w), w - 1) #start-x, mapped to grid coordinates
+    sgy = min(floor(start_entry.y*h), h - 1) #start-y, mapped to grid coordinates
+    egx = min(floor(entry.x*w), w - 1) #end-x, mapped to grid coordinates
+    egy = min(floor(entry.y*h), h - 1) #end-y, mapped to grid coordinates
     
     # Trips is a (2,2,2) array: [starts in/outside, ends in/side, passenger/trip count]
     trips[int(not start_inside), int(not end_inside)] += 1
@@ -174,26 +580,246 @@ def update_data(entry, start_entry, vdata, fdata, vdata_next_mo, fdata_next_mo,
     #   Note: Here, Passenger count and trip count are recorded separately.
     if start_inside:
         # Update volume data for the start of the trip
-        vdata[start_entry['t'], sgx, sgy, 0] += 1
+        vdata[start_entry.t, sgx, sgy, 0] += 1
         
         if end_inside:
             # Update volume data only if the trip starts and ends within Manhattan.
-            if start_entry['t'] == entry['t']:
+            if start_entry.t == entry.t:
                 # st == et, so we don't need to check if et is in the
                 #    next month.
-                fdata[0, entry['t'], sgx, sgy, egx, egy] += 1
+                add_one(fdata, (0, entry.t, sgx, sgy, egx, egy))
             else:
-                if starts_and_ends_in_same_month:
-                    fdata[1, entry['t'], sgx, sgy, egx, egy] += 1
+                if starts_and_ends_in_same_day:
+                    add_one(fdata, (1, entry.t, sgx, sgy, egx, egy))
                 else: # End time crosses over to the next month
-                    fdata_next_mo[1, entry['t'], sgx, sgy, egx, egy] += 1
+                    add_one(fdata_next_mo, (1, entry.t, sgx, sgy, egx, egy))
 
     if end_inside:
         # Update volume data for the end of the trip.
         if starts_and_ends_in_same_day:
-            vdata[entry['t'], egx, egy, 1] += 1
+            vdata[entry.t, egx, egy, 1] += 1
         
         else: # Ends during the next month, so use the array representing the next month
-            vdata_next_mo[entry['t'], egx, egy, 1] += 1
+            vdata_next_mo[entry.t, egx, egy, 1] += 1
             
     # Returns nothing - numpy arrays are updated by reference.
+
+def add_one(array, index):
+    ''' array[index] += 1, for a numpy array or a SparseFlow.'''
+    if isinstance(array, SparseFlow):
+        array.add(index)
+    else:
+        array[index] += 1
+
+def scatter_add(array, index, counts=1):
+    ''' Adds counts to array at the given tuple of index arrays, in place.
+        Repeated indices are all counted (unlike array[index] += counts).
+        array may be a numpy array or a SparseFlow.'''
+    if isinstance(array, SparseFlow):
+        array.add(index, counts)
+        return
+    flat = array.reshape(-1) # A view, as the arrays from gen_empty_* are contiguous
+    np.add.at(flat, np.ravel_multi_index(index, array.shape), counts)
+
+def grid_coordinates(entries, w=10, h=20, grid=None):
+    ''' Returns (inside, gx, gy) for a columnar entry dict: whether each
+        entry is inside the grid, and its grid coordinates (only
+        meaningful where inside).
+
+    # Arguments:
+        grid: Optional gridindex.GridIndex for a w x h grid, to look the
+            cells up by lon/lat instead of computing them from x, y.
+            The result is the same.
+    '''
+    if grid is not None:
+        cells = grid.cells(entries['lon'], entries['lat'])
+        (gx, gy) = np.divmod(cells, h)
+        return cells >= 0, gx, gy
+    x = entries['x']
+    y = entries['y']
+    inside = (0 <= x) & (x <= 1) & (0 <= y) & (y <= 1)
+    gx = np.minimum(np.floor(x*w), w - 1).astype(np.int64)
+    gy = np.minimum(np.floor(y*h), h - 1).astype(np.int64)
+    return inside, gx, gy
+
+def update_data_bulk(entries, start_entries, vdata, fdata, vdata_next_mo, fdata_next_mo, trips, w=10, h=20, n=4, grid=None):
+    ''' Batch version of update_data.
+        Returns nothing.
+
+    # Arguments:
+        entries, start_entries: Columnar entry dicts (see make_entries)
+            with one element per trip, giving the end and start of
+            each trip respectively.
+        grid: Optional gridindex.GridIndex, see grid_coordinates.
+        (See update_data for the rest.)
+    '''
+    st = start_entries['t']
+    et = entries['t']
+
+    (start_inside, sgx, sgy) = grid_coordinates(start_entries, w=w, h=h, grid=grid)
+    (end_inside, egx, egy) = grid_coordinates(entries, w=w, h=h, grid=grid)
+    starts_and_ends_in_same_day = (start_entries['day'] == entries['day'])
+
+    scatter_add(trips, ((~start_inside).astype(np.int64), (~end_inside).astype(np.int64)))
+
+    # Volume at the start of each trip
+    s = start_inside
+    scatter_add(vdata, (st[s], sgx[s], sgy[s], np.zeros(np.count_nonzero(s), dtype=np.int64)))
+
+    # Flow, for trips that start and end inside the grid.
+    #   Axis 0 is 0 for trips within one time slot, 1 for earlier slots.
+    both = start_inside & end_inside
+    same_slot = (st == et)
+    this_day = both & (same_slot | starts_and_ends_in_same_day)
+    next_day = both & ~same_slot & ~starts_and_ends_in_same_day
+    for (data, f) in ((fdata, this_day), (fdata_next_mo, next_day)):
+        scatter_add(data, ((~same_slot[f]).astype(np.int64), et[f], sgx[f], sgy[f], egx[f], egy[f]))
+
+    # Volume at the end of each trip
+    for (data, e) in ((vdata, end_inside & starts_and_ends_in_same_day),
+                      (vdata_next_mo, end_inside & ~starts_and_ends_in_same_day)):
+        scatter_add(data, (et[e], egx[e], egy[e], np.ones(np.count_nonzero(e), dtype=np.int64)))
+
+    # Returns nothing - numpy arrays are updated by reference.
+
+def stdn_arrays(data, directory="."):
+    ''' Returns (vdata, fdata) from a loaded -data.npz file in the shape
+        used by the STDN, (T, w, h, 2) and (2, T, w, h, w, h).
+        Files in the older format, with an extra passenger/trip count
+        axis, keep only the trip count. (See load_fdata for directory.)'''
+    vdata = data['vdata']
+    fdata = load_fdata(data, directory=directory)
+    if vdata.ndim == 5:
+        vdata = vdata[:,:,:,:,1]
+    if fdata.ndim == 7:
+        fdata = fdata[:,:,:,:,:,:,1]
+    return vdata, fdata
+
+def npz_array_info(filename, key='arr_0'):
+    ''' Returns (shape, dtype) of array key in an .npz (or .npy) file,
+        reading only its header rather than decompressing the array.'''
+    if filename.endswith(".npy"):
+        read_f = open(filename, "rb")
+    else:
+        with zipfile.ZipFile(filename) as archive:
+            read_f = archive.open(key + ".npy")
+    with read_f:
+        version = np.lib.format.read_magic(read_f)
+        if version == (1, 0):
+            (shape, _, dtype) = np.lib.format.read_array_header_1_0(read_f)
+        else:
+            (shape, _, dtype) = np.lib.format.read_array_header_2_0(read_f)
+    return shape, dtype
+
+def npz_memmap(filename, key='arr_0'):
+    ''' Returns array key of an .npz file as a read-only memory map if it
+        is stored uncompressed (saved with np.savez, or main.py --codec
+        npz), so that it is read from disk only as it is used. Compressed
+        arrays are loaded into memory as usual.'''
+    with zipfile.ZipFile(filename) as archive:
+        info = archive.getinfo(key + ".npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        with np.load(filename) as data:
+            return data[key]
+    with open(filename, "rb") as read_f:
+        # The array follows the member's local header, its name and extra field
+        read_f.seek(info.header_offset)
+        header = read_f.read(30)
+        if header[:4] != b"PK\x03\x04":
+            raise ValueError("Bad zip member header in " + filename)
+        (name_length, extra_length) = np.frombuffer(header[26:30], dtype="<u2")
+        read_f.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+        version = np.lib.format.read_magic(read_f)
+        if version == (1, 0):
+            (shape, fortran_order, dtype) = np.lib.format.read_array_header_1_0(read_f)
+        else:
+            (shape, fortran_order, dtype) = np.lib.format.read_array_header_2_0(read_f)
+        offset = read_f.tell()
+    return np.memmap(filename, dtype=dtype, mode="r", shape=shape,
+                     order="F" if fortran_order else "C", offset=offset)
+
+def _read_npy_header(read_f):
+    # Returns (prefix, offset, shape, fortran_order, dtype): the offsets of
+    # the header text and of the data, and the header's fields
+    version = np.lib.format.read_magic(read_f)
+    prefix = read_f.tell() + (2 if version == (1, 0) else 4) # and the header length
+    if version == (1, 0):
+        (shape, fortran_order, dtype) = np.lib.format.read_array_header_1_0(read_f)
+    else:
+        (shape, fortran_order, dtype) = np.lib.format.read_array_header_2_0(read_f)
+    return prefix, read_f.tell(), shape, fortran_order, dtype
+
+def _write_npy_shape(write_f, filename, prefix, offset, dtype, shape):
+    # Rewrites the header of an .npy for a new shape, in its padding
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(dtype), shape)
+    if len(header) + 1 > offset - prefix:
+        raise ValueError("No room in the header of " + filename + " for a longer shape")
+    write_f.seek(prefix)
+    write_f.write((header.ljust(offset - prefix - 1) + "\n").encode("latin1"))
+
+def append_npy(filename, array):
+    ''' Appends array to the end of axis 0 of the .npy file filename, in
+        place: only the new data and the header's shape are written.
+
+    array must match the file on the other axes. numpy leaves room in
+    the header for the shape to grow; an .npy without that room raises
+    a ValueError. If writing fails, the file is restored.
+    Returns the new shape.
+    '''
+    array = np.ascontiguousarray(array)
+    with open(filename, "r+b") as write_f:
+        (prefix, offset, shape, fortran_order, dtype) = _read_npy_header(write_f)
+        if fortran_order or dtype != array.dtype or shape[1:] != array.shape[1:]:
+            raise ValueError("Can't append %s %s to %s %s" % (array.dtype, array.shape, dtype, shape))
+        shape = (shape[0] + array.shape[0],) + shape[1:]
+        end = write_f.seek(0, os.SEEK_END)
+        try:
+            write_f.write(array.tobytes())
+            write_f.flush()
+            # The shape last, so the file is never longer than it says
+            _write_npy_shape(write_f, filename, prefix, offset, dtype, shape)
+        except BaseException:
+            write_f.truncate(end)
+            raise
+    return shape
+
+def truncate_npy(filename, length):
+    ''' Shortens axis 0 of the .npy file filename to length, in place,
+        e.g. to undo append_npy. Returns the new shape.'''
+    with open(filename, "r+b") as write_f:
+        (prefix, offset, shape, fortran_order, dtype) = _read_npy_header(write_f)
+        if fortran_order or not 0 <= length <= shape[0]:
+            raise ValueError("Can't truncate %s %s to length %d" % (dtype, shape, length))
+        shape = (length,) + shape[1:]
+        # The shape first, so the file is never shorter than it says
+        _write_npy_shape(write_f, filename, prefix, offset, dtype, shape)
+        write_f.flush()
+        write_f.truncate(offset + dtype.itemsize * int(np.prod(shape)))
+    return shape
+
+def compile_arrays(filenames, save_filename, axis=0, key='arr_0', V=True):
+    ''' Concatenates array key from each file along axis into one
+        memory-mapped .npy file, save_filename.
+
+    The output is preallocated from the input headers and each file's
+    array is written in place, so only one input is in memory at a time.
+    Returns the memory-mapped output array.
+    '''
+    if not filenames:
+        raise ValueError("No files to compile into " + save_filename)
+    infos = [npz_array_info(filename, key=key) for filename in filenames]
+    shape = list(infos[0][0])
+    shape[axis] = sum(info_shape[axis] for (info_shape, _) in infos)
+
+    out = np.lib.format.open_memmap(save_filename, mode="w+", dtype=infos[0][1], shape=tuple(shape))
+    offset = 0
+    for (filename, (info_shape, _)) in zip(filenames, infos):
+        if V:
+            print("Loading from", filename)
+        slab = [slice(None)] * len(shape)
+        slab[axis] = slice(offset, offset + info_shape[axis])
+        with np.load(filename) as data:
+            out[tuple(slab)] = data[key]
+        offset += info_shape[axis]
+    out.flush()
+    return out
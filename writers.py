@@ -0,0 +1,103 @@
+''' Codecs for saving the -data.npz files.
+
+np.savez_compressed uses zlib at its default level; on the large,
+mostly-zero dense fdata a lower level saves much faster for a little
+more space. Every codec here writes an ordinary .npz (zip) file, so
+np.load, utils.load_fdata and the scripts read the output the same way
+whichever codec saved it:
+
+    npz-zlib  zlib (deflate), as np.savez_compressed. The default.
+    npz       No compression, as np.savez. Fastest to save and load.
+    npz-bz2   bzip2. Slower than zlib, and often smaller.
+    npz-lzma  LZMA (xz). Usually the smallest, and the slowest to save.
+    npz-chunked
+              As npz-zlib, but a dense fdata goes to a .fchunks file next
+              to the .npz (see chunkstore.py), compressed in chunks of
+              time slots, in parallel. utils.load_fdata reads it back.
+
+A level (1-9, from fastest to smallest) can be given for npz-zlib,
+npz-bz2 and npz-chunked; the others have none (zipfile ignores it for
+LZMA), and reject one. Use compare_codecs (or script_benchmark.py
+--codecs) to see the trade-off on real output.
+'''
+
+import os
+import time
+import zipfile
+import numpy as np
+import chunkstore
+
+CODECS = {'npz-zlib': zipfile.ZIP_DEFLATED,
+          'npz': zipfile.ZIP_STORED,
+          'npz-bz2': zipfile.ZIP_BZIP2,
+          'npz-lzma': zipfile.ZIP_LZMA,
+          'npz-chunked': zipfile.ZIP_DEFLATED}
+DEFAULT_CODEC = 'npz-zlib'
+# The codecs that take a level
+LEVELED_CODECS = ('npz-zlib', 'npz-bz2', 'npz-chunked')
+
+def check_codec(codec, level=None):
+    ''' Raises a ValueError if codec isn't one of CODECS, or if it is
+        given a level it has no use for.'''
+    if codec not in CODECS:
+        raise ValueError("Unknown codec " + repr(codec) + "; expected one of " + ", ".join(sorted(CODECS)))
+    if level is not None and codec not in LEVELED_CODECS:
+        raise ValueError("The " + codec + " codec takes no level; only " + ", ".join(LEVELED_CODECS) + " do")
+
+def chunks_filename(filename):
+    ''' The .fchunks file the npz-chunked codec saves fdata to, for an
+        .npz filename.'''
+    return os.path.splitext(filename)[0] + ".fchunks"
+
+def save_arrays(filename, arrays, codec=DEFAULT_CODEC, level=None):
+    ''' Saves a dict of arrays to filename as an .npz file, compressed
+        with codec (see CODECS) at the given level (None for the codec's
+        default).'''
+    check_codec(codec, level)
+    if codec == 'npz-chunked':
+        if 'fdata' in arrays:
+            fdata = arrays['fdata']
+            chunkstore.save_chunked(chunks_filename(filename), fdata, level=6 if level is None else level)
+            # The .npz keeps its name (relative, so the pair can be moved) and shape
+            arrays = {key: array for (key, array) in arrays.items() if key != 'fdata'}
+            arrays['fdata_chunks'] = np.array(os.path.basename(chunks_filename(filename)))
+            arrays['fdata_shape'] = np.array(np.shape(fdata))
+        codec = 'npz-zlib'
+    if level is None and codec == 'npz-zlib':
+        np.savez_compressed(filename, **arrays)
+        return
+    if level is None and codec == 'npz':
+        np.savez(filename, **arrays)
+        return
+    with zipfile.ZipFile(filename, mode="w", compression=CODECS[codec], compresslevel=level) as archive:
+        for (name, array) in arrays.items():
+            with archive.open(name + ".npy", mode="w", force_zip64=True) as write_f:
+                np.lib.format.write_array(write_f, np.asanyarray(array), allow_pickle=False)
+
+def compare_codecs(arrays, codecs=None, directory=".", levels=(None,)):
+    ''' Saves arrays once with each codec and level, and times it.
+
+    Returns a list of dicts with the 'codec', 'level', 'seconds' taken
+    to save and 'bytes' of the file. The files are removed afterwards.
+
+    # Arguments:
+        arrays: Dict of arrays, as saved by main.process.
+        codecs: List of names from CODECS. Default all of them.
+        directory: String, the folder to save the files in.
+        levels: List of levels to try each codec at. (Codecs without
+            levels, see LEVELED_CODECS, are only tried once.)
+    '''
+    results = []
+    for codec in (sorted(CODECS) if codecs is None else codecs):
+        for level in (levels if codec in LEVELED_CODECS else (None,)):
+            filename = os.path.join(directory, "codec-%d-%s-%s.npz" % (os.getpid(), codec, level))
+            start = time.perf_counter()
+            save_arrays(filename, arrays, codec=codec, level=level)
+            seconds = time.perf_counter() - start
+            size = os.path.getsize(filename)
+            if os.path.exists(chunks_filename(filename)):
+                size += os.path.getsize(chunks_filename(filename))
+                os.remove(chunks_filename(filename))
+            results.append({'codec': codec, 'level': level, 'seconds': seconds, 'bytes': size})
+            os.remove(filename)
+    return results